@@ -0,0 +1,209 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import re
+import sqlite3
+
+from dpdata import DP_REPORT_271_HEADERS
+import district_data_import
+import district_data_utils
+
+
+# Kinds of archived files. The inputs are recognized by their headers, the generated files by their names
+# (including chunked ones such as 03-donor-updates-001.csv).
+KIND_DP_REPORT = 'dp-report'
+KIND_DISTRICT_DATA = 'district-data'
+GENERATED_FILE_KINDS = [os.path.splitext(filename)[0] for filename in [
+    district_data_import.FILENAME_STUDENT_UPDATES, district_data_import.FILENAME_NEWSTUDENT,
+    district_data_import.FILENAME_DONOR_UPDATES, district_data_import.FILENAME_NEWDONOR]]
+
+RUN_DIRECTORY_PATTERN = re.compile(r'Upload-Archive-(\d{4})(\d{2})(\d{2})$')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    run_date TEXT NOT NULL,
+    directory TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS files (
+    file_id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    path TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS records (
+    file_id INTEGER NOT NULL REFERENCES files(file_id),
+    line INTEGER NOT NULL,
+    donor_id TEXT,
+    stu_number TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_by_donor_id ON records(donor_id);
+CREATE INDEX IF NOT EXISTS records_by_stu_number ON records(stu_number);
+CREATE INDEX IF NOT EXISTS records_by_file_id ON records(file_id);
+'''
+
+
+def run_date_for_directory(directory):
+    """'yyyy-mm-dd' for an Upload-Archive-<yyyymmdd> directory, None for anything else"""
+    match = RUN_DIRECTORY_PATTERN.match(os.path.basename(os.path.normpath(directory)))
+    return '%s-%s-%s' % match.groups() if match else None
+
+
+def file_kind(filename):
+    """What kind of archived file this is, or None if it isn't one we index"""
+    name = os.path.splitext(os.path.basename(filename))[0]
+    for kind in GENERATED_FILE_KINDS:
+        if name == kind or re.match(re.escape(kind) + r'-\d+$', name):
+            return kind
+    with open(filename, 'r', newline='') as csvfile:
+        headers = set(next(csv.reader(csvfile), []))
+    if headers == set(DP_REPORT_271_HEADERS):
+        return KIND_DP_REPORT
+    if headers == set(district_data_utils.DISTRICT_DATA_HEADERS):
+        return KIND_DISTRICT_DATA
+    return None
+
+
+class ArchiveIndex:
+    """The records of all archived import runs (DP reports, district data and generated files) in a sqlite
+    database, indexed by DONOR_ID and STU_NUMBER, for looking at how donors and students changed over time"""
+
+    def __init__(self, db_filename):
+        self.connection = sqlite3.connect(db_filename)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def ingest_run(self, directory, run_date=None):
+        """Index the csv files of one run directory (and its subdirectories, e.g. GeneratedFiles).
+
+        Files that are already indexed and unchanged (same size and modification time) are skipped, so this can
+        be re-run as runs are added or files are fixed. Returns the number of files (re)indexed.
+        """
+        directory = os.path.abspath(directory)
+        run_date = run_date or run_date_for_directory(directory)
+        if run_date is None:
+            raise ValueError("Cannot tell the date of the run in %s, expected an Upload-Archive-<yyyymmdd> directory" % directory)
+        with self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO runs (run_date, directory) VALUES (?, ?)', (run_date, directory))
+            run_id = self.connection.execute('SELECT run_id FROM runs WHERE directory = ?', (directory,)).fetchone()[0]
+
+        ingested = 0
+        for path in sorted(glob.glob(os.path.join(directory, '**', '*.csv'), recursive=True)):
+            stat = os.stat(path)
+            indexed = self.connection.execute('SELECT file_id, size, mtime FROM files WHERE path = ?', (path,)).fetchone()
+            if indexed is not None and (indexed['size'], indexed['mtime']) == (stat.st_size, stat.st_mtime):
+                continue
+            kind = file_kind(path)
+            if kind is None:
+                continue
+            # One transaction per file, so an interrupted ingest leaves every file either fully indexed or not at all
+            with self.connection:
+                if indexed is not None:
+                    self.connection.execute('DELETE FROM records WHERE file_id = ?', (indexed['file_id'],))
+                    self.connection.execute('DELETE FROM files WHERE file_id = ?', (indexed['file_id'],))
+                file_id = self.connection.execute(
+                    'INSERT INTO files (run_id, path, kind, size, mtime) VALUES (?, ?, ?, ?, ?)',
+                    (run_id, path, kind, stat.st_size, stat.st_mtime)).lastrowid
+                with open(path, 'r', newline='') as csvfile:
+                    reader = csv.DictReader(csvfile)
+                    self.connection.executemany(
+                        'INSERT INTO records (file_id, line, donor_id, stu_number, data) VALUES (?, ?, ?, ?, ?)',
+                        ((file_id, reader.line_num, row.get('DONOR_ID'), row.get('STU_NUMBER') or row.get('SystemID'), json.dumps(row))
+                         for row in reader))
+            ingested += 1
+        return ingested
+
+    def ingest_archive(self, archive_dir):
+        """Index every Upload-Archive-<yyyymmdd> directory under archive_dir (or archive_dir itself if it is one)"""
+        if run_date_for_directory(archive_dir):
+            directories = [archive_dir]
+        else:
+            directories = sorted(path for path in glob.glob(os.path.join(archive_dir, 'Upload-Archive-*'))
+                                 if os.path.isdir(path) and run_date_for_directory(path))
+        return sum(self.ingest_run(directory) for directory in directories)
+
+    def __history(self, key_column, key, kinds):
+        query = ('SELECT runs.run_date, files.kind, files.path, records.line, records.data FROM records '
+                 'JOIN files ON files.file_id = records.file_id JOIN runs ON runs.run_id = files.run_id '
+                 'WHERE records.%s = ?' % key_column)
+        params = [key]
+        if kinds:
+            query += ' AND files.kind IN (%s)' % ', '.join('?' * len(kinds))
+            params.extend(kinds)
+        query += ' ORDER BY runs.run_date, files.kind, files.path, records.line'
+        return [(row['run_date'], row['kind'], row['path'], json.loads(row['data']))
+                for row in self.connection.execute(query, params)]
+
+    def donor_history(self, donor_id, kinds=None):
+        """(run_date, kind, path, record) for every archived record of the donor, oldest run first"""
+        return self.__history('donor_id', donor_id, kinds)
+
+    def student_history(self, stu_number, kinds=None):
+        """(run_date, kind, path, record) for every archived record of the student (DP or district), oldest run first"""
+        return self.__history('stu_number', stu_number, kinds)
+
+    def runs(self):
+        return [(row['run_date'], row['directory'], row['files'], row['records']) for row in self.connection.execute(
+            'SELECT runs.run_date, runs.directory, COUNT(DISTINCT files.file_id) AS files, COUNT(records.file_id) AS records '
+            'FROM runs LEFT JOIN files ON files.run_id = runs.run_id LEFT JOIN records ON records.file_id = files.file_id '
+            'GROUP BY runs.run_id ORDER BY runs.run_date')]
+
+
+def field_changes(history, fields):
+    """The entries of a history where the values of the given fields differ from the previous entry of the same kind,
+    e.g. when a student became NOBSD or a donor's address changed"""
+    changes = []
+    previous_by_kind = dict()
+    for run_date, kind, path, record in history:
+        values = tuple(record.get(field) for field in fields)
+        if previous_by_kind.get(kind) != values:
+            changes.append((run_date, kind, path, record))
+        previous_by_kind[kind] = values
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index the archived import runs and look up how donors and students changed over time")
+    parser.add_argument("--db", help="sqlite database holding the index (created if needed)", default='archive-index.sqlite')
+    parser.add_argument("--ingest", help="Upload-Archive-<yyyymmdd> directory, or a directory of them, to (re)index; "
+                                         "unchanged files are skipped", action='append', default=[])
+    parser.add_argument("--donor", help="show the history of this DONOR_ID")
+    parser.add_argument("--student", help="show the history of this STU_NUMBER (SystemID in the district data)")
+    parser.add_argument("--kinds", help="only show these kinds of files: %s" % ', '.join([KIND_DP_REPORT, KIND_DISTRICT_DATA] + GENERATED_FILE_KINDS),
+                        nargs='+')
+    parser.add_argument("--fields", help="fields to show, e.g. SCHOOL GRADE or ADDRESS CITY ZIP (default: all)", nargs='+')
+    parser.add_argument("--changes-only", help="only show the runs where one of --fields changed", action='store_true')
+    parser.add_argument("--runs", help="list the indexed runs", action='store_true')
+    args = parser.parse_args()
+    if args.changes_only and not args.fields:
+        parser.error("--changes-only requires --fields")
+
+    index = ArchiveIndex(args.db)
+    try:
+        for archive_dir in args.ingest:
+            print("%s: indexed %d new or changed file(s)" % (archive_dir, index.ingest_archive(archive_dir)))
+        if args.runs:
+            for run_date, directory, file_count, record_count in index.runs():
+                print("%s  %d file(s), %d record(s)  %s" % (run_date, file_count, record_count, directory))
+        for history in ([index.donor_history(args.donor, args.kinds)] if args.donor else []) + \
+                       ([index.student_history(args.student, args.kinds)] if args.student else []):
+            if args.changes_only:
+                history = field_changes(history, args.fields)
+            for run_date, kind, path, record in history:
+                fields = args.fields or list(record)
+                print("%s  %-18s %s  (%s)" % (run_date, kind, ', '.join('%s=%s' % (field, record.get(field, '')) for field in fields),
+                                              os.path.basename(path)))
+    finally:
+        index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import contextlib
+import os
+import time
+
+from dpdata import DPData
+import district_data_import
+import utils
+
+
+BATCH_MANIFEST_HEADERS = ['dp-report', 'district-data', 'school-year', 'mode', 'split-parents', 'output-dir']
+BATCH_SUMMARY_HEADERS = ['JOB', 'OUTPUT_DIR', 'STATUS', 'LOAD_SECONDS', 'RUN_SECONDS'] + [
+    district_data_import.FILENAME_STUDENT_UPDATES,
+    district_data_import.FILENAME_NEWSTUDENT,
+    district_data_import.FILENAME_DONOR_UPDATES,
+    district_data_import.FILENAME_NEWDONOR,
+    district_data_import.FILENAME_DONOR_UPDATE_MESSAGES]
+
+MODES = ('new-year-import', 'mid-year-update')
+
+
+def load_manifest(manifest_filename):
+    """Load the batch manifest, resolving relative paths against the manifest's directory"""
+    base_dir = os.path.dirname(os.path.abspath(manifest_filename))
+    jobs = []
+    for job_number, row in enumerate(utils.load_csv_file(manifest_filename, BATCH_MANIFEST_HEADERS), start=1):
+        if row['mode'] not in MODES:
+            raise ValueError("Job %d: mode must be one of %s, not %s" % (job_number, MODES, row['mode']))
+        jobs.append({
+            'job': job_number,
+            'dp_report': os.path.join(base_dir, row['dp-report']),
+            'district_data': os.path.join(base_dir, row['district-data']),
+            'school_year': row['school-year'],
+            'new_year_import': row['mode'] == 'new-year-import',
+            'split_parents': row['split-parents'].upper() in ('Y', 'YES', 'TRUE', '1'),
+            'output_dir': os.path.join(base_dir, row['output-dir'])
+        })
+    output_dirs = [job['output_dir'] for job in jobs]
+    if len(set(output_dirs)) != len(output_dirs):
+        raise ValueError("Every job in %s needs its own output-dir" % manifest_filename)
+    return jobs
+
+
+def group_jobs_by_dp_report(jobs):
+    """Group jobs sharing a DP report so the report is parsed once per group"""
+    groups = OrderedDict()
+    for job in jobs:
+        groups.setdefault(os.path.realpath(job['dp_report']), []).append(job)
+    return list(groups.values())
+
+
+def run_job_group(jobs):
+    """Run all jobs that share one DP report. Executed in a worker process."""
+    results = []
+    dp = None
+    district_data_cache = dict()
+    for job in jobs:
+        result = {'JOB': job['job'], 'OUTPUT_DIR': job['output_dir']}
+        os.makedirs(job['output_dir'], exist_ok=True)
+        try:
+            with open(os.path.join(job['output_dir'], 'script_output.txt'), 'w') as script_output, \
+                    contextlib.redirect_stdout(script_output):
+                print("Input files:")
+                if dp is None:
+                    # Only the job that loads the report pays for it, so only its result has the LOAD_SECONDS
+                    start = time.perf_counter()
+                    dp = DPData(job['dp_report'])
+                    result['LOAD_SECONDS'] = '%.2f' % (time.perf_counter() - start)
+                start = time.perf_counter()
+                district_data_filename = os.path.realpath(job['district_data'])
+                if district_data_filename not in district_data_cache:
+                    district_data_cache[district_data_filename] = district_data_import.load_district_data(job['district_data'])
+                # Each job mutates its own copy; the parsed inputs stay pristine for the next job in the group
+                job_dp = dp.copy()
+                district_records = district_data_cache[district_data_filename]
+                dp_messages = district_data_import.run_import(job_dp, district_records, job['school_year'],
+                                                              job['new_year_import'], job['split_parents'])
+                print()
+                print("Output files:")
+                result.update(district_data_import.write_output_files(job_dp, dp_messages, job['output_dir']))
+                district_data_import.print_instructions()
+            result['STATUS'] = 'ok'
+            result['RUN_SECONDS'] = '%.2f' % (time.perf_counter() - start)
+        except (Exception, SystemExit) as e:
+            # Details are in the job's script_output.txt; keep going with the rest of the batch
+            result['STATUS'] = 'failed: %s' % (e,)
+        results.append(result)
+    return results
+
+
+def print_summary(results):
+    widths = [max([len(header)] + [len(str(result.get(header, ''))) for result in results])
+              for header in BATCH_SUMMARY_HEADERS]
+    print('  '.join(header.ljust(width) for header, width in zip(BATCH_SUMMARY_HEADERS, widths)))
+    for result in results:
+        print('  '.join(str(result.get(header, '')).ljust(width) for header, width in zip(BATCH_SUMMARY_HEADERS, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs several district data imports in one batch")
+    parser.add_argument("--manifest",
+                        help="csv with one import job per row, columns: %s" % ', '.join(BATCH_MANIFEST_HEADERS),
+                        required=True)
+    parser.add_argument("--jobs", help="number of worker processes (default: number of cpus)", type=int, default=None)
+    parser.add_argument("--summary", help="csv file to write the batch summary to", default='batch-summary.csv')
+    args = parser.parse_args()
+
+    print("Input files:")
+    jobs = load_manifest(args.manifest)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for group_results in executor.map(run_job_group, group_jobs_by_dp_report(jobs)):
+            results.extend(group_results)
+    results.sort(key=lambda result: result['JOB'])
+
+    print()
+    print("Output files:")
+    utils.save_as_csv_file(args.summary, BATCH_SUMMARY_HEADERS, results)
+    print()
+    print_summary(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import glob
+import hashlib
+import os
+import pickle
+
+import memory_budget
+import utils
+
+
+# The import stages, in order, that a checkpoint can be saved after
+IMPORT_STAGES = ['loaded', 'grades-advanced', 'matched', 'reconciled', 'scrubbed']
+
+
+def file_hash(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as inputfile:
+        for block in iter(lambda: inputfile.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class ImportCheckpoints:
+    """Saves the import state (DPData plus the manual update messages) after each stage, so that a later run
+    can resume from it. Each checkpoint records the inputs it was computed from and is ignored once they change.
+
+    Unmodified records spilled to disk are saved as copies of their files next to the checkpoint, and restored
+    into spill files of the run's MemoryBudget (or into memory without one).
+    """
+
+    def __init__(self, directory, dp_report, district_data, school_year, new_year_import, split_parents, phonetic_match=False,
+                 budget=None):
+        self.directory = directory
+        self.budget = budget
+        os.makedirs(directory, exist_ok=True)
+        dp_report_hash = file_hash(dp_report)
+        # Loading the DP report only depends on the report; everything after that also depends on
+        # the district data and the import options.
+        self.__inputs = {'loaded': {'dp_report': dp_report_hash}}
+        stage_inputs = {
+            'dp_report': dp_report_hash,
+            'district_data': file_hash(district_data),
+            'school_year': school_year,
+            'new_year_import': new_year_import,
+            'split_parents': split_parents,
+            'phonetic_match': phonetic_match,
+        }
+        for stage in IMPORT_STAGES[1:]:
+            self.__inputs[stage] = stage_inputs
+
+    def __filename(self, stage):
+        return os.path.join(self.directory, '%s.pickle' % stage)
+
+    def __remove_spilled_files(self, stage):
+        for filename in glob.glob(os.path.join(glob.escape(self.directory), '%s-*.sqlite' % stage)):
+            os.remove(filename)
+
+    def save(self, stage, dp, dp_messages):
+        self.__remove_spilled_files(stage)
+        with utils.atomic_open(self.__filename(stage), 'wb') as outputfile, \
+                memory_budget.spilled_records_in(self.directory, stage):
+            pickle.dump({'stage': stage, 'inputs': self.__inputs[stage], 'dp': dp, 'dp_messages': dp_messages},
+                        outputfile, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, stage):
+        """Returns (dp, dp_messages) saved after stage, or None if there is no valid checkpoint for it"""
+        try:
+            with open(self.__filename(stage), 'rb') as inputfile, \
+                    memory_budget.spilled_records_in(self.directory, stage, self.budget):
+                checkpoint = pickle.load(inputfile)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, IndexError, KeyError,
+                TypeError, ValueError):
+            # Truncated or corrupted, or saved by a version of the code whose classes no longer load: treated
+            # like a stale checkpoint, so the stage is run again
+            return None
+        if not isinstance(checkpoint, dict) or checkpoint.get('inputs') != self.__inputs[stage]:
+            return None
+        return checkpoint['dp'], checkpoint['dp_messages']
+
+    def resume(self, stage):
+        """Find the last valid checkpoint at or before stage. Returns (stage, dp, dp_messages), or (None, None, None)."""
+        for candidate in reversed(IMPORT_STAGES[:IMPORT_STAGES.index(stage) + 1]):
+            checkpoint = self.load(candidate)
+            if checkpoint:
+                if candidate != stage:
+                    print("No valid checkpoint for %s (inputs changed?), resuming from %s" % (stage, candidate))
+                else:
+                    print("Resuming from checkpoint after %s" % candidate)
+                return (candidate,) + checkpoint
+            # Invalidate the stale checkpoint so it can't be picked up later
+            if os.path.exists(self.__filename(candidate)):
+                os.remove(self.__filename(candidate))
+            self.__remove_spilled_files(candidate)
+        print("No valid checkpoint found, starting from scratch")
+        return None, None, None
@@ -0,0 +1,241 @@
+from array import array
+import json
+import mmap
+import struct
+import sys
+
+import utils
+
+
+# File layout: MAGIC, the length of the JSON header (uint32), the JSON header, then 8-byte aligned sections:
+#   string offsets: uint64 per string plus one, into the string data
+#   string data: all distinct values, UTF-8 encoded and sorted, so a value's id can be found by binary search
+#   one column per table field: a uint32 string id per row, with INT_VALUE set for int values (such as YEARTO,
+#   stored as their decimal string), or MISSING where the record has no such field
+# The header has the byte order, the string section positions and per table the row count, the fields and the
+# position of each column. The arrays are in the byte order of the machine that wrote the file.
+MAGIC = b'DPCOLS\x00\x01'
+HEADER_LENGTH = struct.Struct('<I')
+MISSING = 0xFFFFFFFF
+INT_VALUE = 0x80000000
+TABLE_DONORS = 'donors'
+TABLE_STUDENTS = 'students'
+
+
+def _aligned(position):
+    return (position + 7) & ~7
+
+
+def _value_string(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, int) and not isinstance(value, bool):
+        return str(value)
+    raise ValueError("Cannot store %r in a snapshot, only strings and ints" % (value,))
+
+
+def write_snapshot(filename, donorrecords, studentrecords):
+    """Write donor and student records (e.g. DPData.get_donors()/get_students()) as a columnar snapshot.
+    The values must be strings or ints."""
+    tables = {TABLE_DONORS: list(donorrecords), TABLE_STUDENTS: list(studentrecords)}
+    strings = set()
+    fields_by_table = dict()
+    for table, records in tables.items():
+        fields = dict()
+        for record in records:
+            for field, value in record.items():
+                fields[field] = None
+                strings.add(_value_string(value))
+        fields_by_table[table] = list(fields)
+    strings = sorted(strings)
+    string_ids = dict((string, string_id) for string_id, string in enumerate(strings))
+
+    string_data = bytearray()
+    string_offsets = array('Q', [0])
+    for string in strings:
+        string_data += string.encode()
+        string_offsets.append(len(string_data))
+    columns = dict()
+    for table, records in tables.items():
+        for field in fields_by_table[table]:
+            columns[(table, field)] = array('I', (MISSING if field not in record else
+                                                 string_ids[_value_string(record[field])] | (0 if isinstance(record[field], str) else INT_VALUE)
+                                                 for record in records))
+
+    # Lay out the sections; the header holds their positions, so its length is fixed first with placeholders
+    def layout(header_size):
+        position = _aligned(len(MAGIC) + HEADER_LENGTH.size + header_size)
+        header = {'byteorder': sys.byteorder, 'strings': {'count': len(strings), 'offsets': position}, 'tables': dict()}
+        position = _aligned(position + len(string_offsets) * string_offsets.itemsize)
+        header['strings']['data'] = position
+        position = _aligned(position + len(string_data))
+        for table, records in tables.items():
+            header['tables'][table] = {'rows': len(records), 'fields': fields_by_table[table], 'columns': dict()}
+            for field in fields_by_table[table]:
+                header['tables'][table]['columns'][field] = position
+                position = _aligned(position + len(records) * 4)
+        return json.dumps(header).encode()
+
+    header = layout(0)
+    while len(layout(len(header))) != len(header):
+        header = layout(len(header))
+    header = layout(len(header))
+
+    with utils.atomic_open(filename, 'wb') as outputfile:
+        def write_section(data):
+            outputfile.write(data)
+            outputfile.write(b'\0' * (_aligned(outputfile.tell()) - outputfile.tell()))
+        write_section(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+        write_section(string_offsets.tobytes())
+        write_section(bytes(string_data))
+        for table in tables:
+            for field in fields_by_table[table]:
+                write_section(columns[(table, field)].tobytes())
+    print("    %s: Snapshot of %d donors and %d students, %d distinct values" %
+          (filename, len(tables[TABLE_DONORS]), len(tables[TABLE_STUDENTS]), len(strings)))
+
+
+class Column:
+    """One field of a table, read lazily from the snapshot: column[row] is the value (None if the record has
+    no such field). ids holds the raw value ids, e.g. to count or compare values without decoding them."""
+
+    def __init__(self, snapshot, ids):
+        self.__snapshot = snapshot
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, row):
+        return self.__snapshot.value(self.ids[row])
+
+    def __iter__(self):
+        for row in range(len(self.ids)):
+            yield self[row]
+
+    def rows_with(self, value):
+        """Rows where the field has this value"""
+        string_id = self.__snapshot.string_id(_value_string(value))
+        if string_id is None:
+            return []
+        if not isinstance(value, str):
+            string_id |= INT_VALUE
+        return [row for row, row_string_id in enumerate(self.ids) if row_string_id == string_id]
+
+
+class ColumnarSnapshot:
+    """A snapshot file written by write_snapshot, memory-mapped.
+
+    Nothing is decoded up front: single values, columns and records are read from the mapping when asked for,
+    so a tool that needs a few columns or records doesn't pay for parsing the whole report.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as snapshotfile:
+            self.__mmap = mmap.mmap(snapshotfile.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.__mmap[:len(MAGIC)] != MAGIC:
+            self.__mmap.close()
+            raise ValueError("%s is not a DP snapshot" % filename)
+        header_length, = HEADER_LENGTH.unpack_from(self.__mmap, len(MAGIC))
+        header_start = len(MAGIC) + HEADER_LENGTH.size
+        self.header = json.loads(self.__mmap[header_start:header_start + header_length])
+        if self.header['byteorder'] != sys.byteorder:
+            self.__mmap.close()
+            raise ValueError("%s was written on a %s-endian machine" % (filename, self.header['byteorder']))
+        self.__view = memoryview(self.__mmap)
+        self.__column_views = []
+        strings = self.header['strings']
+        self.__string_count = strings['count']
+        self.__string_offsets = self.__view[strings['offsets']:strings['offsets'] + (strings['count'] + 1) * 8].cast('Q')
+        self.__string_data = strings['data']
+
+    def close(self):
+        """Close the mapping; columns read from the snapshot can't be used anymore afterwards"""
+        # The views have to be released before the mapping can be closed
+        for view in self.__column_views:
+            view.release()
+        self.__column_views = []
+        self.__string_offsets.release()
+        self.__view.release()
+        self.__mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def string(self, string_id):
+        start = self.__string_data + self.__string_offsets[string_id]
+        end = self.__string_data + self.__string_offsets[string_id + 1]
+        return self.__mmap[start:end].decode()
+
+    def value(self, value_id):
+        """The value for an id from a column"""
+        if value_id == MISSING:
+            return None
+        if value_id & INT_VALUE:
+            return int(self.string(value_id & ~INT_VALUE))
+        return self.string(value_id)
+
+    def string_id(self, value):
+        """The id of value in the string dictionary, or None if no record has it"""
+        # Binary search of the sorted dictionary (bisect only takes a key function from python 3.10)
+        low, high = 0, self.__string_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.string(middle) < value:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.__string_count and self.string(low) == value:
+            return low
+        return None
+
+    def rows(self, table):
+        return self.header['tables'][table]['rows']
+
+    def fields(self, table):
+        return self.header['tables'][table]['fields']
+
+    def column(self, table, field):
+        position = self.header['tables'][table]['columns'][field]
+        view = self.__view[position:position + self.rows(table) * 4].cast('I')
+        self.__column_views.append(view)
+        return Column(self, view)
+
+    def record(self, table, row, columns=None):
+        """The record in row of table as a dict, like the DPData records"""
+        columns = columns or [(field, self.column(table, field)) for field in self.fields(table)]
+        record = dict()
+        for field, column in columns:
+            value = column[row]
+            if value is not None:
+                record[field] = value
+        return record
+
+    def __decoded_column(self, ids, strings):
+        """All values of a column, with None where they are missing"""
+        if not ids or max(ids) < INT_VALUE:
+            # Only strings: map the ids straight to the decoded dictionary
+            return list(map(strings.__getitem__, ids))
+        return [None if value_id == MISSING else int(strings[value_id & ~INT_VALUE]) if value_id & INT_VALUE else strings[value_id]
+                for value_id in ids]
+
+    def records(self, table):
+        """All records of table, in the order they were written. The whole dictionary and the table's columns
+        are decoded once, which is much faster than record() per row when most of the data is needed."""
+        data = self.__mmap[self.__string_data:self.__string_data + self.__string_offsets[self.__string_count]]
+        offsets = self.__string_offsets
+        strings = [data[offsets[string_id]:offsets[string_id + 1]].decode() for string_id in range(self.__string_count)]
+        fields = self.fields(table)
+        columns = []
+        for field in fields:
+            column = self.column(table, field)
+            columns.append(self.__decoded_column(column.ids, strings))
+        for values in zip(*columns):
+            if None in values:
+                yield dict((field, value) for field, value in zip(fields, values) if value is not None)
+            else:
+                yield dict(zip(fields, values))
@@ -0,0 +1,67 @@
+from collections import Counter, defaultdict
+import json
+import time
+
+
+class DecisionLog:
+    """Structured record of the matching and reconciliation decisions of an import.
+
+    Every decision is written to the log file as one JSON line with the stage, the rule taken, the keys it was
+    based on, the records it touched and the time it took. Per-rule counts and latency histograms are kept for
+    the summary, which is also written as the last line.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.__file = open(filename, 'w') if filename else None
+        self.counts = Counter()
+        self.total_seconds = defaultdict(float)
+        # (stage, rule) -> {bucket: count}; bucket b counts decisions that took less than 2**b microseconds
+        # (and at least 2**(b-1), or any time for bucket 0)
+        self.histograms = defaultdict(Counter)
+
+    @staticmethod
+    def bucket(elapsed):
+        return int(elapsed * 1000000).bit_length()
+
+    def record(self, stage, rule, started, keys=None, records=None):
+        """Record a decision that started at time.perf_counter() value started"""
+        elapsed = time.perf_counter() - started
+        rule_key = (stage, rule)
+        self.counts[rule_key] += 1
+        self.total_seconds[rule_key] += elapsed
+        self.histograms[rule_key][self.bucket(elapsed)] += 1
+        if self.__file is not None:
+            event = {'stage': stage, 'rule': rule, 'keys': keys or {}, 'records': records or {},
+                     'elapsed_us': round(elapsed * 1000000, 1)}
+            self.__file.write(json.dumps(event) + '\n')
+
+    def summary_rows(self):
+        """(stage, rule, count, total seconds, histogram) in order of total time spent"""
+        return [(stage, rule, self.counts[(stage, rule)], self.total_seconds[(stage, rule)],
+                 dict(sorted(self.histograms[(stage, rule)].items())))
+                for stage, rule in sorted(self.counts, key=lambda rule_key: -self.total_seconds[rule_key])]
+
+    def format_summary(self):
+        lines = ["Decisions (by time spent):"]
+        for stage, rule, count, total_seconds, histogram in self.summary_rows():
+            lines.append("    %-12s %-28s %7d  %9.1f ms  %7.1f us avg" %
+                         (stage, rule, count, total_seconds * 1000, total_seconds * 1000000 / count))
+            lines.append("        " + '  '.join("<%dus:%d" % (2 ** bucket, bucket_count) for bucket, bucket_count in histogram.items()))
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.__file is not None:
+            summary = [{'stage': stage, 'rule': rule, 'count': count, 'total_us': round(total_seconds * 1000000, 1),
+                        'histogram_us': dict(('<%d' % 2 ** bucket, bucket_count) for bucket, bucket_count in histogram.items())}
+                       for stage, rule, count, total_seconds, histogram in self.summary_rows()]
+            self.__file.write(json.dumps({'summary': summary}) + '\n')
+            self.__file.close()
+            self.__file = None
+            print("    %s: Number of decisions logged = %d" % (self.filename, sum(self.counts.values())))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,8 +1,19 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import argparse
+import contextlib
+import io
+import os
+import time
 
 from dpdata import DPData
+from decision_log import DecisionLog
+from memory_budget import MemoryBudget
+import checkpoint
 import district_data_utils
+import input_validator
+import memory_budget
 import utils
 
 
@@ -11,91 +22,176 @@ FILENAME_NEWSTUDENT = '02-new-students.csv'
 FILENAME_DONOR_UPDATES = '03-donor-updates.csv'  #do the updates first to get any change addresses, etc.
 FILENAME_NEWDONOR = '04-new-donors.csv'  #do this last so that new donors will match on existing donors.
 FILENAME_DONOR_UPDATE_MESSAGES = '05-donor-manual-updates.txt'
-
-parser = argparse.ArgumentParser(description="Uploads data from BSD to DonorPerfect")
-parser.add_argument("--dp-report",
-                    help="csv output from DP: Reports -> Report Center -> 271 Name Contacts Other -> Include \"NO MAIL\" Names -> run report -> export as .csv",
-                    required=True)
-parser.add_argument("--district-data",
-                    help="spreadsheet received from the district, converted to csv",
-                    required=True)
-parser.add_argument("--school-year",
-                    help="school year to use for new families, e.g. SY2016-17",
-                    required=True)
-group = parser.add_mutually_exclusive_group(required=True)
-group.add_argument("--new-year-import", help="specify that this is a beginning-of-year import, in which missing 8th graders will be graduated", action="store_true")
-group.add_argument("--mid-year-update", help="specify that this is a mid-year update", action="store_true")
-
-parser.add_argument("--split-parents", help="Split existing household if parents have two different addresses.", required=False, action='store_true')
-args = parser.parse_args()
-
-print("Input files:")
-
-# Load DP data
-dp = DPData(args.dp_report)
-
-# Load district data keyed off student number ("SystemID" there)
-district_records = {}
-preschool_count = 0
-empty_parent_count = 0
-for row in utils.load_csv_file(args.district_data, district_data_utils.DISTRICT_DATA_HEADERS):
-    if row['School'] == 'PreSchool':
-        preschool_count += 1
-    elif not (row['Contact 1 Last Name'] or row['Contact 2 Last Name']):
-        empty_parent_count += 1
-    else:
-        district_records[row['SystemID']] = row
-
-if preschool_count > 0:
-    print("Ignored %d district records with a school of PreSchool" % (preschool_count))
-if empty_parent_count > 0:
-    print("Ignored %d district records with no parents" % (empty_parent_count))
-
-# For new-year imports, update grade for all students
-# For returning students, this will be overridden on the next step
-if args.new_year_import:
+FILENAME_UPLOAD_MANIFEST = '00-upload-manifest.csv'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Uploads data from BSD to DonorPerfect")
+    parser.add_argument("--dp-report",
+                        help="csv output from DP: Reports -> Report Center -> 271 Name Contacts Other -> Include \"NO MAIL\" Names -> run report -> export as .csv",
+                        required=True)
+    parser.add_argument("--district-data",
+                        help="spreadsheet received from the district, converted to csv",
+                        required=True)
+    parser.add_argument("--school-year",
+                        help="school year to use for new families, e.g. SY2016-17",
+                        required=True)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--new-year-import", help="specify that this is a beginning-of-year import, in which missing 8th graders will be graduated", action="store_true")
+    group.add_argument("--mid-year-update", help="specify that this is a mid-year update", action="store_true")
+
+    parser.add_argument("--split-parents", help="Split existing household if parents have two different addresses.", required=False, action='store_true')
+    parser.add_argument("--checkpoint-dir", help="save the import state after each stage in this directory, so a later run can resume from it")
+    parser.add_argument("--resume-from", choices=checkpoint.IMPORT_STAGES,
+                        help="restart from the checkpoint saved after this stage (or the last valid one before it); requires --checkpoint-dir")
+    parser.add_argument("--chunk-rows", help="split each csv file for upload into chunks of at most this many rows", type=int)
+    parser.add_argument("--chunk-bytes", help="split each csv file for upload into chunks of at most this many bytes", type=int)
+    parser.add_argument("--columnar", help="advance grades and update students as bulk numpy operations (requires numpy)", action='store_true')
+    parser.add_argument("--phonetic-match", help="note existing donors that sound like a new donor (e.g. Jon/John Schmitt for "
+                                                 "John Schmidt at the same zip) in the manual updates file", action='store_true')
+    parser.add_argument("--decision-log", help="write every matching and reconciliation decision to this file as JSON lines, "
+                                               "and print per-rule counts and timings")
+    parser.add_argument("--parallel-load", help="load the DP report in a worker process while the district data is loaded "
+                                                "(if there are several cpus), which only pays off for large inputs", action='store_true')
+    parser.add_argument("--memory-limit", help="stay within about this much memory (e.g. 512M or 2G) by keeping the unmodified "
+                                               "DP records on disk once the import gets close to it", type=memory_budget.parse_size)
+    parser.add_argument("--snapshot-out", help="also write the loaded DP report to this file as a columnar snapshot, which "
+                                               "other tools (e.g. dpquery.py --dp-snapshot) load much faster than the csv")
+    args = parser.parse_args(argv)
+    if args.resume_from and not args.checkpoint_dir:
+        parser.error("--resume-from requires --checkpoint-dir")
+    return args
+
+
+def load_district_data(district_data_filename, row_check=None):
+    # Load district data keyed off student number ("SystemID" there)
+    district_records = {}
+    households = district_data_utils.DistrictHouseholds()
+    preschool_count = 0
+    empty_parent_count = 0
+    for row in utils.load_csv_file(district_data_filename, district_data_utils.DISTRICT_DATA_HEADERS, row_check):
+        if row['School'] == 'PreSchool':
+            preschool_count += 1
+        elif not (row['Contact 1 Last Name'] or row['Contact 2 Last Name']):
+            empty_parent_count += 1
+        else:
+            district_records[row['SystemID']] = households.district_record(row)
+
+    if preschool_count > 0:
+        print("Ignored %d district records with a school of PreSchool" % (preschool_count))
+    if empty_parent_count > 0:
+        print("Ignored %d district records with no parents" % (empty_parent_count))
+    return district_records
+
+
+def _load_dp_report(dp_report_filename):
+    """DPData for the report, with what loading it printed, the error if it failed and the validation problems
+    found in its rows, for BackgroundDPLoad"""
+    output = io.StringIO()
+    report = input_validator.ValidationReport()
+    checks = input_validator.DPReportChecks(report, dp_report_filename)
+    with contextlib.redirect_stdout(output):
+        try:
+            dp = DPData(dp_report_filename, row_check=checks.check_row)
+        except (Exception, SystemExit) as e:
+            return None, output.getvalue(), e, report.problems
+    checks.finish()
+    return dp, output.getvalue(), None, report.problems
+
+
+class BackgroundDPLoad:
+    """Loads the DP report in a worker process, so the district data can be loaded at the same time.
+
+    The two are independent until matching starts, so loading takes about as long as the slower of them
+    (plus handing the DPData back) instead of both. Start it before any other threads, so the worker isn't forked
+    from a multi-threaded process.
+    """
+
+    def __init__(self, dp_report_filename):
+        self.__executor = ProcessPoolExecutor(max_workers=1)
+        self.__future = self.__executor.submit(_load_dp_report, dp_report_filename)
+
+    def alongside(self, validation, load, *args):
+        """Run load(*args) while the DP report loads and return (dp, its result). The output is printed as if the
+        DP report had been loaded first. The worker checks the rows of the DP report, its problems are added to
+        validation (an input_validator.InputValidation)."""
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                result = load(*args)
+        finally:
+            try:
+                dp, dp_output, dp_error, dp_problems = self.__future.result()
+                validation.add_dp_report_problems(dp_problems)
+                print(dp_output, end='')
+            finally:
+                self.__executor.shutdown()
+                print(output.getvalue(), end='')
+        if dp_error is not None:
+            raise dp_error
+        return dp, result
+
+
+def update_existing_students(dp, district_records, new_year_import):
+    # For new-year imports, update grade for all students
+    # For returning students, this will be overridden on the next step
+    if new_year_import:
+        for dp_studentrecord in dp.get_students():
+            grade = dp_studentrecord['GRADE']
+            if grade and 0<= int(grade) < 9:
+                dp_studentrecord['GRADE'] = str(1 + int(grade))
+            if grade and int(grade) in [-1,-2]: #both of these will map to 0.  -1 is old TK and -2 is the new TK
+                dp_studentrecord['GRADE'] = 0
+    # Make updates for existing students
     for dp_studentrecord in dp.get_students():
-        grade = dp_studentrecord['GRADE']
-        if grade and 0<= int(grade) < 9:
-            dp_studentrecord['GRADE'] = str(1 + int(grade))
-        if grade and int(grade) in [-1,-2]: #both of these will map to 0.  -1 is old TK and -2 is the new TK
-            dp_studentrecord['GRADE'] = 0
-# Make updates for existing students
-for dp_studentrecord in dp.get_students():
-    stu_number = dp_studentrecord['STU_NUMBER']
-    if stu_number in district_records:
-        # Returning student
-        dp_studentrecord['GRADE'] = district_data_utils.dp_grade_for_district_record(district_records[stu_number])
-        dp_studentrecord['SCHOOL'] = district_data_utils.district_school_to_dp_school(district_records[stu_number]['School'])
-        dp_studentrecord['PHOTO_OPT_OUT'] = district_records[stu_number]['Photo Opt Out']
-    elif args.new_year_import and dp_studentrecord['GRADE'] == '9' and dp_studentrecord['SCHOOL'] == 'BIS':
-        dp_studentrecord['SCHOOL'] = 'ALUM'
-        dp_studentrecord['YEARTO'] = str(datetime.now().year)
-    elif dp_studentrecord['SCHOOL'] not in ['ALUM','NOBSD']:
-        #this student didn't return back to BSD
-        dp_studentrecord['SCHOOL'] = 'NOBSD'
-        dp_studentrecord['YEARTO'] = str(datetime.now().year)
-
-
-# We have 2 different ways to match district records to 1 or more donors. For each student, we use the first successful strategy:
-# 1. Match based on SystemID (in district data) / STU_NUMBER (in dp data)
-# 2. Match based on the DP fields that it uses for matching
-
-# Populate match key for all existing donors
-match_key_to_donor_id = dict()
-for dp_donorrecord in dp.get_donors():
-    donor_id = dp_donorrecord['DONOR_ID']
-    match_key = dp.compute_match_key(dp_donorrecord)
-    if match_key in match_key_to_donor_id:
-        print("Hmm, found duplicate match key %s, for donors %s and %s" % (match_key, match_key_to_donor_id[match_key], donor_id))
-    match_key_to_donor_id[match_key] = donor_id
-
-# Add new students, either to existing or new families
-for stu_number, district_record in district_records.items():
-    if dp.get_students_for_stu_number(stu_number):
-        continue
-    donor_id = None
-
+        stu_number = dp_studentrecord['STU_NUMBER']
+        if stu_number in district_records:
+            # Returning student
+            dp_studentrecord['GRADE'] = district_data_utils.dp_grade_for_district_record(district_records[stu_number])
+            dp_studentrecord['SCHOOL'] = district_data_utils.district_school_to_dp_school(district_records[stu_number]['School'])
+            dp_studentrecord['PHOTO_OPT_OUT'] = district_records[stu_number]['Photo Opt Out']
+        elif new_year_import and dp_studentrecord['GRADE'] == '9' and dp_studentrecord['SCHOOL'] == 'BIS':
+            dp_studentrecord['SCHOOL'] = 'ALUM'
+            dp_studentrecord['YEARTO'] = str(datetime.now().year)
+        elif dp_studentrecord['SCHOOL'] not in ['ALUM','NOBSD']:
+            #this student didn't return back to BSD
+            dp_studentrecord['SCHOOL'] = 'NOBSD'
+            dp_studentrecord['YEARTO'] = str(datetime.now().year)
+
+
+def get_student_updater(columnar):
+    """update_existing_students, or its numpy-based equivalent for --columnar if numpy is installed"""
+    if columnar:
+        try:
+            from student_columns import update_existing_students_columnar
+            return update_existing_students_columnar
+        except ImportError:
+            print("--columnar needs numpy, which is not installed; updating the students row by row instead")
+    return update_existing_students
+
+
+def build_match_key_index(dp):
+    # Populate match key for all existing donors
+    match_key_to_donor_id = dict()
+    for dp_donorrecord in dp.get_donors():
+        donor_id = dp_donorrecord['DONOR_ID']
+        match_key = dp.compute_match_key(dp_donorrecord)
+        if match_key in match_key_to_donor_id:
+            print("Hmm, found duplicate match key %s, for donors %s and %s (duplicate_donors.py lists all likely duplicates)" %
+                  (match_key, match_key_to_donor_id[match_key], donor_id))
+        match_key_to_donor_id[match_key] = donor_id
+    return match_key_to_donor_id
+
+
+def match_district_record(dp, match_key_to_donor_id, district_record, school_year):
+    """Work out which donor(s) a new student's district record belongs to, without changing anything.
+
+    Returns (rule, donor_id, match_key, dp_donorrecord, dp_alternate_donorrecord), where rule is one of
+    'match', 'alternate-match', 'swap-match' (donor_id is the existing donor), 'new-donor' (dp_donorrecord
+    should be added) or 'new-alternate-donor' (both dp_alternate_donorrecord and dp_donorrecord should be added).
+    match_key is the key the new donor(s) should be registered under. The donor records are the district record's
+    shared (read-only) candidates, so copy them before adding them.
+    """
     # At this point we know that: 
     #   (a) this student isn't in DP (i.e., this is new student)
     # Chances are the donor is also new, unless 
@@ -103,305 +199,215 @@ for stu_number, district_record in district_records.items():
     #   (ii) this student is returning after a break from BSD, but somehow was given a new student ID
     # If either (i) or (ii) is true, then DP will not create a new record, but update the existing donor record, so we should be okay. 
     # At any rate, we have to prepare a new record for this donor, with several custom fields
-    #print("Creating record for new donor w/ new student %s" % (stu_number))
-    dp_donorrecord_for_matching = district_data_utils.create_dp_donorrecord(
-        district_record=district_record, school_year=args.school_year)
+    dp_donorrecord_for_matching = district_record.candidate_donorrecord(school_year)
     match_key = dp.compute_match_key(dp_donorrecord_for_matching)
     if match_key in match_key_to_donor_id:
         # Use the matched donor rather than the one we created for matching purposes
-        donor_id = match_key_to_donor_id[match_key]
-    else:
-        #check against the alternate donor record in case we have the student
-        #under the alternate household (ie divorced parents)
-        dp_alternate_donorrecord_for_matching = district_data_utils.create_dp_donorrecord(
-            district_record, args.school_year, use_alternate=True)
-        if dp_alternate_donorrecord_for_matching:
-            match_key = dp.compute_match_key(dp_alternate_donorrecord_for_matching)
-            if match_key in match_key_to_donor_id:
-                donor_id = match_key_to_donor_id[match_key]
-            else:
-                #not a match for alternate household either.  Should add both donors
-                #for now add the alternate donor and add the student to that
-                donor_id = dp.gen_donor_id()
-                match_key_to_donor_id[match_key] = donor_id
-                dp_alternate_donorrecord_for_matching['DONOR_ID'] = donor_id
-                dp.add_donor(dp_alternate_donorrecord_for_matching)
-                dp_studentrecord = district_data_utils.create_dp_studentrecord(district_record)
-                dp_studentrecord['DONOR_ID'] = donor_id
-                dp_studentrecord['OTHER_ID'] = dp.gen_other_id()
-                dp.add_student(dp_studentrecord)        
-                donor_id = None  #setting this to None so that a new donor record for
-                #original household will get created below.
-        else:
-            #this district record does not have alternate household. BUT it's possible
-            #that the student is registering with different parent.  So we'll try to 
-            #match against the different parent name.
-            dp_swap_donorrecord_for_matching = district_data_utils.create_dp_donorrecord(
-                district_record, args.school_year, use_alternate=False, swap_parents=True
-            )
-            match_key = dp.compute_match_key(dp_swap_donorrecord_for_matching)
-            if match_key in match_key_to_donor_id:
-                donor_id = match_key_to_donor_id[match_key]
+        return 'match', match_key_to_donor_id[match_key], match_key, dp_donorrecord_for_matching, None
+
+    #check against the alternate donor record in case we have the student
+    #under the alternate household (ie divorced parents)
+    dp_alternate_donorrecord_for_matching = district_record.candidate_donorrecord(school_year, use_alternate=True)
+    if dp_alternate_donorrecord_for_matching:
+        match_key = dp.compute_match_key(dp_alternate_donorrecord_for_matching)
+        if match_key in match_key_to_donor_id:
+            return ('alternate-match', match_key_to_donor_id[match_key], match_key,
+                    dp_donorrecord_for_matching, dp_alternate_donorrecord_for_matching)
+        #not a match for alternate household either.  Should add both donors
+        return 'new-alternate-donor', None, match_key, dp_donorrecord_for_matching, dp_alternate_donorrecord_for_matching
+
+    #this district record does not have alternate household. BUT it's possible
+    #that the student is registering with different parent.  So we'll try to 
+    #match against the different parent name.
+    dp_swap_donorrecord_for_matching = district_record.candidate_donorrecord(school_year, swap_parents=True)
+    match_key = dp.compute_match_key(dp_swap_donorrecord_for_matching)
+    if match_key in match_key_to_donor_id:
+        return 'swap-match', match_key_to_donor_id[match_key], match_key, dp_donorrecord_for_matching, None
+    return 'new-donor', None, match_key, dp_donorrecord_for_matching, None
+
+
+def possible_match_message(dp, district_record, dp_donorrecord):
+    """A note for the manual updates file if existing donors sound like the new donor (same Soundex codes for the names
+    of the donor or spouse, and the same zip), as the exact match keys miss spelling variants. None if there are none."""
+    matches = OrderedDict()
+    for last_name, first_name in [(dp_donorrecord['LAST_NAME'], dp_donorrecord['FIRST_NAME']),
+                                  (dp_donorrecord['SP_LNAME'], dp_donorrecord['SP_FNAME'])]:
+        if not last_name:
+            continue
+        for match in dp.find_phonetic_matches(last_name, first_name):
+            if match['DONOR_ID'] != dp_donorrecord['DONOR_ID'] and match['ZIP'][:5] == dp_donorrecord['ZIP'][:5]:
+                matches[match['DONOR_ID']] = match
+    if not matches:
+        return None
+    str_list = ["Possible existing donor for new student %s %s (%s):" %
+                (district_record['Student First Name'], district_record['Student Last Name'].strip(), district_record.stu_number)]
+    str_list.append("  New donor (%s) %s %s/%s %s" % (dp_donorrecord['DONOR_ID'], dp_donorrecord['FIRST_NAME'],
+                                                      dp_donorrecord['LAST_NAME'], dp_donorrecord['OPT_LINE'], dp_donorrecord['ADDRESS']))
+    for match in matches.values():
+        str_list.append("  Sounds like donor (%s) %s %s/%s %s" % (match['DONOR_ID'], match['FIRST_NAME'], match['LAST_NAME'],
+                                                                  match['OPT_LINE'], match['ADDRESS']))
+    return '\n'.join(str_list) + '\n\n'
+
+
+def add_new_students(dp, district_records, school_year, match_key_to_donor_id=None, decision_log=None, possible_match_messages=None):
+    # We have 2 different ways to match district records to 1 or more donors. For each student, we use the first successful strategy:
+    # 1. Match based on SystemID (in district data) / STU_NUMBER (in dp data)
+    # 2. Match based on the DP fields that it uses for matching
+    # match_key_to_donor_id can be passed in pre-built (e.g. by watch mode); it gets updated with any new donors.
+    # If possible_match_messages is a list, new donors that sound like existing donors are noted in it.
+    if match_key_to_donor_id is None:
+        match_key_to_donor_id = build_match_key_index(dp)
+
+    # Add new students, either to existing or new families
+    for stu_number, district_record in district_records.items():
+        started = time.perf_counter()
+        if dp.get_students_for_stu_number(stu_number):
+            if decision_log is not None:
+                decision_log.record('matched', 'stu-number-match', started, keys={'stu_number': stu_number})
+            continue
+
+        rule, donor_id, match_key, dp_donorrecord_for_matching, dp_alternate_donorrecord_for_matching = \
+            match_district_record(dp, match_key_to_donor_id, district_record, school_year)
+        donor_ids = []
+        if rule == 'new-alternate-donor':
+            #for now add the alternate donor and add the student to that
+            alternate_donor_id = dp.gen_donor_id()
+            donor_ids.append(alternate_donor_id)
+            match_key_to_donor_id[match_key] = alternate_donor_id
+            dp_alternate_donorrecord = dict(dp_alternate_donorrecord_for_matching)
+            dp_alternate_donorrecord['DONOR_ID'] = alternate_donor_id
+            dp.add_donor(dp_alternate_donorrecord)
+            if possible_match_messages is not None:
+                message = possible_match_message(dp, district_record, dp_alternate_donorrecord)
+                if message:
+                    possible_match_messages.append(message)
+            dp_studentrecord = district_data_utils.create_dp_studentrecord(district_record)
+            dp_studentrecord['DONOR_ID'] = alternate_donor_id
+            dp_studentrecord['OTHER_ID'] = dp.gen_other_id()
+            dp.add_student(dp_studentrecord)
+            #then fall through so that a new donor record for original household gets created below.
         if not donor_id:
             # No match, so go ahead and add the new donor to DP
             donor_id = dp.gen_donor_id()
             match_key_to_donor_id[match_key] = donor_id
-            dp_donorrecord_for_matching['DONOR_ID'] = donor_id
-            dp.add_donor(dp_donorrecord_for_matching)
-
-    dp_studentrecord = district_data_utils.create_dp_studentrecord(district_record)
-    dp_studentrecord['DONOR_ID'] = donor_id
-    dp_studentrecord['OTHER_ID'] = dp.gen_other_id()
-    dp.add_student(dp_studentrecord)
-
-#End loop over student IDs in district data
-
-#this list is used to output any manual updates -- splitting single household into two households.
-dp_messages_existingdonorrecords = list()
-
-# Compute donor-level updates, typically updating address of the student.  But if we find out that
-#the student is now living in a divorced household (ie, alternate household exists) we want to
-#create a donor record for the divorced parent. (this part is done manually as we need to split the
-# original donor record into two)
-
-for stu_number, district_record in district_records.items():
-    dp_studentrecords = dp.get_students_for_stu_number(stu_number)
+            dp_donorrecord = dict(dp_donorrecord_for_matching)
+            dp_donorrecord['DONOR_ID'] = donor_id
+            dp.add_donor(dp_donorrecord)
+            if possible_match_messages is not None:
+                message = possible_match_message(dp, district_record, dp_donorrecord)
+                if message:
+                    possible_match_messages.append(message)
+
+        dp_studentrecord = district_data_utils.create_dp_studentrecord(district_record)
+        dp_studentrecord['DONOR_ID'] = donor_id
+        dp_studentrecord['OTHER_ID'] = dp.gen_other_id()
+        dp.add_student(dp_studentrecord)
+        donor_ids.append(donor_id)
+
+        if decision_log is not None:
+            decision_log.record('matched', rule, started, keys={'stu_number': stu_number, 'match_key': match_key},
+                                records={'donor_ids': donor_ids})
+
+    #End loop over student IDs in district data
+
+
+# Spouse fields to blank out when a donor record no longer has a spouse
+NO_SPOUSE_FIELDS = {
+    'SP_FNAME':'', "SP_LNAME":"", 'OPT_LINE':'', 'SPOUSE_MOBILE':'','SPOUSE_EMAIL':'','SP_EMPLOYER':'',
+    'SP_ADVISOR_MEMBER_MULTICODE':'','SP_MAILMERGE_FNAME':''
+}
+
+
+def remove_spouse(dp_donorrecord, salutation_f_name, salutation_l_name, informal_sal_f_name):
+    """Remove the spouse from the dp record, resetting the salutations to the remaining donor"""
+    dp_donorrecord.update(NO_SPOUSE_FIELDS)
+    dp_donorrecord.update({
+        'SALUTATION': district_data_utils.create_salutation(salutation_f_name, salutation_l_name, '', ''),
+        'INFORMAL_SAL': district_data_utils.create_informal_sal(informal_sal_f_name, '')
+    })
+
+
+def split_donorrecord_fields(contact):
+    """Fields for the new donor record created for the given contact when splitting a household"""
+    fields = contact.address_fields()
+    fields.update({
+        "FIRST_NAME": contact.first_name,
+        "LAST_NAME": contact.last_name,
+        'EMAIL': contact.email,
+        'MOBILE_PHONE': contact.phone,
+        'MAILMERGE_FNAME': contact.raw_first_name if contact.email else 'no email',
+        'SALUTATION': district_data_utils.create_salutation(contact.first_name, contact.raw_last_name, '', ''),
+        'INFORMAL_SAL': district_data_utils.create_informal_sal(contact.first_name, '')
+    })
+    fields.update(NO_SPOUSE_FIELDS)
+    return fields
+
+
+def reconcile_district_record(dp, district_record, dp_studentrecords, school_year, split_parents, dp_messages_existingdonorrecords):
+    # Apply one district record to the donors of its student, returning the rule that was taken
+    contact1 = district_record.contact1
+    contact2 = district_record.contact2
 
     if len(dp_studentrecords) == 1:
-        #print("processing StudentID: %s"%stu_number)
+        #print("processing StudentID: %s"%district_record.stu_number)
         # Logic for single-donor students is simpler (typically married parents or only one parent)
         dp_studentrecord = next(iter(dp_studentrecords))
         dp_donorrecord = dp.get_donor(dp_studentrecord['DONOR_ID'])
 
         # Update address if the parents have not divorced
-        if district_data_utils.different_household(district_record):
+        if district_record.different_household:
             #find which address should be updated for this donor and add the alternate household
             #record for this student to the manual updates file.
             str_list = list()
             str_list.append('New Alternate address specified for existing student. %s %s %s'%
-                (district_record['Student First Name'], district_record['Student Last Name'].strip(), stu_number))
+                (district_record['Student First Name'], district_record['Student Last Name'].strip(), district_record.stu_number))
             str_list.append("Existing DP Record: (%s) %s %s/%s %s"%(dp_donorrecord['DONOR_ID'],
                 dp_donorrecord['FIRST_NAME'],dp_donorrecord['LAST_NAME'], dp_donorrecord['OPT_LINE'],
                 dp_donorrecord['ADDRESS']))
-            str_list.append("First Household: %s %s %s %s"%(district_record['Contact 1 First Name'].strip(), district_record['Contact 1 Last Name'].strip(),
-                                            district_record['Contact 1 Relationship'], district_record['Contact 1 Street']))
-            str_list.append("Second Household: %s %s %s %s"%(district_record['Contact 2 First Name'].strip(), district_record['Contact 2 Last Name'].strip(),
-                            district_record['Contact 2 Relationship'], district_record['Contact 2 Street']))
+            str_list.append("First Household: %s %s %s %s"%(contact1.first_name, contact1.last_name,
+                                            contact1.relationship, contact1.raw_street))
+            str_list.append("Second Household: %s %s %s %s"%(contact2.first_name, contact2.last_name,
+                            contact2.relationship, contact2.raw_street))
 
-            if args.split_parents:
+            if split_parents:
                 #split the single donor record into at least two.
                 dp_donorrecord_copy = dp_donorrecord.copy()
+                split_contact = None
 
-                if district_record['Contact 1 First Name'] == dp_donorrecord['FIRST_NAME'] and district_record['Contact 1 Last Name']==dp_donorrecord['LAST_NAME']:
+                if contact1.is_named(dp_donorrecord['FIRST_NAME'], dp_donorrecord['LAST_NAME']):
                     #update the address for this dp_donorrecord
-                    dp_donorrecord.update({
-                        'ADDRESS': district_record['Contact 1 Street'].strip(),
-                        'CITY': district_record['Contact 1 City'].strip(),
-                        'STATE': district_record['Contact 1 State'].strip(),
-                        'ZIP': district_record['Contact 1 Zip'].strip(),
-                    })
+                    dp_donorrecord.update(contact1.address_fields())
                     #if the spouse on DP record is the same as the contact2, then wipe the spouse info from dp.  Otherwise, do not touch.
-                    if district_record['Contact 2 First Name'] == dp_donorrecord['SP_FNAME'] and district_record['Contact 2 Last Name'] == dp_donorrecord['SP_LNAME']:
+                    if contact2.is_named(dp_donorrecord['SP_FNAME'], dp_donorrecord['SP_LNAME']):
                         #remove the spouse from the dp record
-                        salutation = district_data_utils.create_salutation(district_record['Contact 1 First Name'].strip(),
-                                district_record['Contact 1 Last Name'],'','')
-                        informal_sal=district_data_utils.create_informal_sal(district_record['Contact 1 First Name'].strip(),'')
-                        dp_donorrecord.update({
-                            'SP_FNAME':'', "SP_LNAME":"", 'OPT_LINE':'', 'SPOUSE_MOBILE':'','SPOUSE_EMAIL':'','SP_EMPLOYER':'',
-                            'SP_ADVISOR_MEMBER_MULTICODE':'','SP_MAILMERGE_FNAME':'',
-                            'SALUTATION': salutation, 'INFORMAL_SAL': informal_sal
-                        })
-                    str_list.append("Existing DP Record Updated -- NO MANUAL INTERVENTION REQUIRED: (%s) %s %s/%s %s"% (dp_donorrecord['DONOR_ID'], 
-                            dp_donorrecord['FIRST_NAME'], dp_donorrecord['LAST_NAME'], dp_donorrecord['OPT_LINE'], dp_donorrecord['ADDRESS']))
-
-                    sp_salutation = district_data_utils.create_salutation(district_record['Contact 2 First Name'].strip(),
-                            district_record['Contact 2 Last Name'],'','')
-                    sp_informal_sal=district_data_utils.create_informal_sal(district_record['Contact 2 First Name'].strip(),'')
-                    dp_donorrecord_copy.update({
-                        "FIRST_NAME": district_record['Contact 2 First Name'].strip(),
-                        "LAST_NAME": district_record['Contact 2 Last Name'].strip(),
-                        'ADDRESS': district_record['Contact 2 Street'].strip(),
-                        'CITY': district_record['Contact 2 City'].strip(),
-                        'STATE': district_record['Contact 2 State'].strip(),
-                        'ZIP': district_record['Contact 2 Zip'].strip(),
-                        'EMAIL':district_record['Contact 2 Email'].strip(), 
-                        'MOBILE_PHONE': district_record['Contact 2 Phone'], 
-                        'MAILMERGE_FNAME': district_record['Contact 2 First Name'] if district_record['Contact 2 Email'].strip() else 'no email',
-                        'SP_FNAME':'', "SP_LNAME":"", 'OPT_LINE':'', 'SPOUSE_MOBILE':'','SPOUSE_EMAIL':'','SP_EMPLOYER':'',
-                        'SP_ADVISOR_MEMBER_MULTICODE':'','SP_MAILMERGE_FNAME':'',
-                        'SALUTATION': sp_salutation, 'INFORMAL_SAL': sp_informal_sal
-                    })
-                    donor_id = dp.gen_donor_id()
-                    dp_donorrecord_copy['DONOR_ID'] = donor_id
-                    dp.add_donor(dp_donorrecord_copy)
-                    #copy students from original donor record to dp_donorrecord_copy
-                    for student in dp.get_students_for_donor(dp_studentrecord['DONOR_ID']):
-                        dp_student_record=student.copy()
-                        dp_student_record['DONOR_ID'] = donor_id
-                        dp_student_record['OTHER_ID'] = dp.gen_other_id()
-                        dp.add_student(dp_student_record)
-                    str_list.append("New Donor Record Created -- NO MANUAL INTERVENTION REQUIRED: %s %s %s"%(dp_donorrecord_copy['FIRST_NAME'], dp_donorrecord_copy['LAST_NAME'],
-                                            dp_donorrecord_copy['ADDRESS']))
-                elif district_record['Contact 1 First Name'] == dp_donorrecord['SP_FNAME'] and district_record['Contact 1 Last Name'] == dp_donorrecord['SP_LNAME']:
-                    if district_record['Contact 2 First Name'] == dp_donorrecord['FIRST_NAME'] and district_record['Contact 2 Last Name'] == dp_donorrecord['LAST_NAME']:
+                        remove_spouse(dp_donorrecord, contact1.first_name, contact1.raw_last_name, contact1.first_name)
+                    split_contact = contact2
+                elif contact1.is_named(dp_donorrecord['SP_FNAME'], dp_donorrecord['SP_LNAME']):
+                    if contact2.is_named(dp_donorrecord['FIRST_NAME'], dp_donorrecord['LAST_NAME']):
                         #keep the dp record for contact 2 (and remove spouse record) and create a new record for contact 1.
-                        dp_donorrecord.update({
-                            'ADDRESS': district_record['Contact 2 Street'].strip(),
-                            'CITY': district_record['Contact 2 City'].strip(),
-                            'STATE': district_record['Contact 2 State'].strip(),
-                            'ZIP': district_record['Contact 2 Zip'].strip(),
-                        })
+                        dp_donorrecord.update(contact2.address_fields())
                         #remove the spouse from the dp record
-                        salutation = district_data_utils.create_salutation(district_record['Contact 2 First Name'].strip(),
-                                district_record['Contact 2 Last Name'],'','')
-                        informal_sal=district_data_utils.create_informal_sal(district_record['Contact 1 First Name'].strip(),'')
-                        dp_donorrecord.update({
-                            'SP_FNAME':'', "SP_LNAME":"", 'OPT_LINE':'', 'SPOUSE_MOBILE':'','SPOUSE_EMAIL':'','SP_EMPLOYER':'',
-                            'SP_ADVISOR_MEMBER_MULTICODE':'','SP_MAILMERGE_FNAME':'',
-                            'SALUTATION': salutation, 'INFORMAL_SAL': informal_sal
-                        })
-                        str_list.append("Existing DP Record Updated -- NO MANUAL INTERVENTION REQUIRED: (%s) %s %s/%s %s"% (dp_donorrecord['DONOR_ID'], 
-                            dp_donorrecord['FIRST_NAME'], dp_donorrecord['LAST_NAME'], dp_donorrecord['OPT_LINE'], dp_donorrecord['ADDRESS']))
-
-                        #create a new record for contact 1
-                        sp_salutation = district_data_utils.create_salutation(district_record['Contact 1 First Name'].strip(),
-                                district_record['Contact 1 Last Name'],'','')
-                        sp_informal_sal=district_data_utils.create_informal_sal(district_record['Contact 1 First Name'].strip(),'')
-
-                        dp_donorrecord_copy.update({
-                            "FIRST_NAME": district_record['Contact 1 First Name'].strip(),
-                            "LAST_NAME": district_record['Contact 1 Last Name'].strip(),
-                            'ADDRESS': district_record['Contact 1 Street'].strip(),
-                            'CITY': district_record['Contact 1 City'].strip(),
-                            'STATE': district_record['Contact 1 State'].strip(),
-                            'ZIP': district_record['Contact 1 Zip'].strip(),
-                            'EMAIL':district_record['Contact 1 Email'].strip(), 
-                            'MOBILE_PHONE': district_record['Contact 1 Phone'], 
-                            'MAILMERGE_FNAME': district_record['Contact 1 First Name'] if district_record['Contact 1 Email'].strip() else 'no email',
-                            'SP_FNAME':'', "SP_LNAME":"", 'OPT_LINE':'', 'SPOUSE_MOBILE':'','SPOUSE_EMAIL':'','SP_EMPLOYER':'',
-                            'SP_ADVISOR_MEMBER_MULTICODE':'','SP_MAILMERGE_FNAME':'',
-                            'SALUTATION': sp_salutation, 'INFORMAL_SAL': sp_informal_sal
-                        })
-                        str_list.append("New Donor Record Created -- NO MANUAL INTERVENTION REQUIRED: %s %s %s"%(dp_donorrecord_copy['FIRST_NAME'], dp_donorrecord_copy['LAST_NAME'],
-                                            dp_donorrecord_copy['ADDRESS']))
-
+                        remove_spouse(dp_donorrecord, contact2.first_name, contact2.raw_last_name, contact1.first_name)
+                        split_contact = contact1
                     else:
                         #keep the dp record for contact1 keep existing spouse and create a new record for contact 2
-                        dp_donorrecord.update({
-                            'ADDRESS': district_record['Contact 1 Street'].strip(),
-                            'CITY': district_record['Contact 1 City'].strip(),
-                            'STATE': district_record['Contact 1 State'].strip(),
-                            'ZIP': district_record['Contact 1 Zip'].strip(),
-                        })
-                        str_list.append("Existing DP Record Updated -- NO MANUAL INTERVENTION REQUIRED: (%s) %s %s/%s %s"% (dp_donorrecord['DONOR_ID'], 
-                            dp_donorrecord['FIRST_NAME'], dp_donorrecord['LAST_NAME'], dp_donorrecord['OPT_LINE'], dp_donorrecord['ADDRESS']))
-
-                        sp_salutation = district_data_utils.create_salutation(district_record['Contact 2 First Name'].strip(),
-                                district_record['Contact 2 Last Name'],'','')
-                        sp_informal_sal=district_data_utils.create_informal_sal(district_record['Contact 2 First Name'].strip(),'')
-
-                        dp_donorrecord_copy.update({
-                            "FIRST_NAME": district_record['Contact 2 First Name'].strip(),
-                            "LAST_NAME": district_record['Contact 2 Last Name'].strip(),
-                            'ADDRESS': district_record['Contact 2 Street'].strip(),
-                            'CITY': district_record['Contact 2 City'].strip(),
-                            'STATE': district_record['Contact 2 State'].strip(),
-                            'ZIP': district_record['Contact 2 Zip'].strip(),
-                            'EMAIL':district_record['Contact 2 Email'].strip(), 
-                            'MOBILE_PHONE': district_record['Contact 2 Phone'], 
-                            'MAILMERGE_FNAME': district_record['Contact 2 First Name'] if district_record['Contact 2 Email'].strip() else 'no email',
-                            'SP_FNAME':'', "SP_LNAME":"", 'OPT_LINE':'', 'SPOUSE_MOBILE':'','SPOUSE_EMAIL':'','SP_EMPLOYER':'',
-                            'SP_ADVISOR_MEMBER_MULTICODE':'','SP_MAILMERGE_FNAME':'',
-                            'SALUTATION': sp_salutation, 'INFORMAL_SAL': sp_informal_sal
-                        })
-                        str_list.append("New Donor Record Created -- NO MANUAL INTERVENTION REQUIRED: %s %s %s"%(dp_donorrecord_copy['FIRST_NAME'], dp_donorrecord_copy['LAST_NAME'],
-                                            dp_donorrecord_copy['ADDRESS']))
-
-                    donor_id = dp.gen_donor_id()
-                    dp_donorrecord_copy['DONOR_ID'] = donor_id
-                    dp.add_donor(dp_donorrecord_copy)
-                    #copy students from original donor record to dp_donorrecord_copy
-                    for student in dp.get_students_for_donor(dp_studentrecord['DONOR_ID']):
-                        dp_student_record=student.copy()
-                        dp_student_record['DONOR_ID'] = donor_id
-                        dp_student_record['OTHER_ID'] = dp.gen_other_id()
-                        dp.add_student(dp_student_record)                        
-                elif district_record['Contact 2 First Name'] == dp_donorrecord['FIRST_NAME'] and district_record['Contact 2 Last Name'] == dp_donorrecord['LAST_NAME']:
-                    #update dp_donorrecord with address for Contact 2
-                    dp_donorrecord.update({
-                        'ADDRESS': district_record['Contact 2 Street'].strip(),
-                        'CITY': district_record['Contact 2 City'].strip(),
-                        'STATE': district_record['Contact 2 State'].strip(),
-                        'ZIP': district_record['Contact 2 Zip'].strip(),
-                    })
+                        dp_donorrecord.update(contact1.address_fields())
+                        split_contact = contact2
+                elif contact2.is_named(dp_donorrecord['FIRST_NAME'], dp_donorrecord['LAST_NAME']):
+                    #update dp_donorrecord with address for Contact 2, create a new record for contact 1
+                    dp_donorrecord.update(contact2.address_fields())
+                    split_contact = contact1
+                elif contact2.is_named(dp_donorrecord['SP_FNAME'], dp_donorrecord['SP_LNAME']):
+                    #update the dp record with contact 2 address, create a new record for contact 1
+                    dp_donorrecord.update(contact2.address_fields())
+                    split_contact = contact1
+
+                if split_contact:
                     str_list.append("Existing DP Record Updated -- NO MANUAL INTERVENTION REQUIRED: (%s) %s %s/%s %s"% (dp_donorrecord['DONOR_ID'], 
-                            dp_donorrecord['FIRST_NAME'], dp_donorrecord['LAST_NAME'], dp_donorrecord['OPT_LINE'], dp_donorrecord['ADDRESS']))
-
-                    #create a new record for contact 1
-                    sp_salutation = district_data_utils.create_salutation(district_record['Contact 1 First Name'].strip(),
-                            district_record['Contact 1 Last Name'],'','')
-                    sp_informal_sal=district_data_utils.create_informal_sal(district_record['Contact 1 First Name'].strip(),'')
-
-                    dp_donorrecord_copy.update({
-                        "FIRST_NAME": district_record['Contact 1 First Name'].strip(),
-                        "LAST_NAME": district_record['Contact 1 Last Name'].strip(),
-                        'ADDRESS': district_record['Contact 1 Street'].strip(),
-                        'CITY': district_record['Contact 1 City'].strip(),
-                        'STATE': district_record['Contact 1 State'].strip(),
-                        'ZIP': district_record['Contact 1 Zip'].strip(),
-                        'EMAIL':district_record['Contact 1 Email'].strip(), 
-                        'MOBILE_PHONE': district_record['Contact 1 Phone'], 
-                        'MAILMERGE_FNAME': district_record['Contact 1 First Name'] if district_record['Contact 1 Email'].strip() else 'no email',
-                        'SP_FNAME':'', "SP_LNAME":"", 'OPT_LINE':'', 'SPOUSE_MOBILE':'','SPOUSE_EMAIL':'','SP_EMPLOYER':'',
-                        'SP_ADVISOR_MEMBER_MULTICODE':'','SP_MAILMERGE_FNAME':'',
-                        'SALUTATION': sp_salutation, 'INFORMAL_SAL': sp_informal_sal
-                    })
+                        dp_donorrecord['FIRST_NAME'], dp_donorrecord['LAST_NAME'], dp_donorrecord['OPT_LINE'], dp_donorrecord['ADDRESS']))
+                    dp_donorrecord_copy.update(split_donorrecord_fields(split_contact))
                     str_list.append("New Donor Record Created -- NO MANUAL INTERVENTION REQUIRED: %s %s %s"%(dp_donorrecord_copy['FIRST_NAME'], dp_donorrecord_copy['LAST_NAME'],
-                                        dp_donorrecord_copy['ADDRESS']))
-
-                    donor_id = dp.gen_donor_id()
-                    dp_donorrecord_copy['DONOR_ID'] = donor_id
-                    dp.add_donor(dp_donorrecord_copy)
-
-                    #copy students from original donor record to dp_donorrecord_copy
-                    for student in dp.get_students_for_donor(dp_studentrecord['DONOR_ID']):
-                        dp_student_record=student.copy()
-                        dp_student_record['DONOR_ID'] = donor_id
-                        dp_student_record['OTHER_ID'] = dp.gen_other_id()
-                        dp.add_student(dp_student_record)                        
-                elif district_record['Contact 2 First Name'] == dp_donorrecord['SP_FNAME'] and district_record['Contact 2 Last Name'] == dp_donorrecord['SP_LNAME']:
-                    #update the dp record with contact 2 address
-                    dp_donorrecord.update({
-                        'ADDRESS': district_record['Contact 2 Street'].strip(),
-                        'CITY': district_record['Contact 2 City'].strip(),
-                        'STATE': district_record['Contact 2 State'].strip(),
-                        'ZIP': district_record['Contact 2 Zip'].strip(),
-                    })
-                    str_list.append("Existing DP Record Updated -- NO MANUAL INTERVENTION REQUIRED: (%s) %s %s/%s %s"% (dp_donorrecord['DONOR_ID'], 
-                            dp_donorrecord['FIRST_NAME'], dp_donorrecord['LAST_NAME'], dp_donorrecord['OPT_LINE'], dp_donorrecord['ADDRESS']))
-
-                    #create a new record for contact 1
-                    sp_salutation = district_data_utils.create_salutation(district_record['Contact 1 First Name'].strip(),
-                            district_record['Contact 1 Last Name'],'','')
-                    sp_informal_sal=district_data_utils.create_informal_sal(district_record['Contact 1 First Name'].strip(),'')
-
-                    dp_donorrecord_copy.update({
-                        "FIRST_NAME": district_record['Contact 1 First Name'].strip(),
-                        "LAST_NAME": district_record['Contact 1 Last Name'].strip(),
-                        'ADDRESS': district_record['Contact 1 Street'].strip(),
-                        'CITY': district_record['Contact 1 City'].strip(),
-                        'STATE': district_record['Contact 1 State'].strip(),
-                        'ZIP': district_record['Contact 1 Zip'].strip(),
-                        'EMAIL':district_record['Contact 1 Email'].strip(), 
-                        'MOBILE_PHONE': district_record['Contact 1 Phone'], 
-                        'MAILMERGE_FNAME': district_record['Contact 1 First Name'] if district_record['Contact 1 Email'].strip() else 'no email',
-                        'SP_FNAME':'', "SP_LNAME":"", 'OPT_LINE':'', 'SPOUSE_MOBILE':'','SPOUSE_EMAIL':'','SP_EMPLOYER':'',
-                        'SP_ADVISOR_MEMBER_MULTICODE':'','SP_MAILMERGE_FNAME':'',
-                        'SALUTATION': sp_salutation, 'INFORMAL_SAL': sp_informal_sal
-                    })
-                    str_list.append("New Donor Record Created -- NO MANUAL INTERVENTION REQUIRED: %s %s %s"%(dp_donorrecord_copy['FIRST_NAME'], dp_donorrecord_copy['LAST_NAME'],
-                                        dp_donorrecord_copy['ADDRESS']))
-
+                                            dp_donorrecord_copy['ADDRESS']))
                     donor_id = dp.gen_donor_id()
                     dp_donorrecord_copy['DONOR_ID'] = donor_id
                     dp.add_donor(dp_donorrecord_copy)
@@ -410,28 +416,17 @@ for stu_number, district_record in district_records.items():
                         dp_student_record=student.copy()
                         dp_student_record['DONOR_ID'] = donor_id
                         dp_student_record['OTHER_ID'] = dp.gen_other_id()
-                        dp.add_student(dp_student_record)                        
+                        dp.add_student(dp_student_record)
             dp_messages_existingdonorrecords.append('\n'.join(str_list) + '\n\n')
-            continue
+            return 'split-parents' if split_parents and split_contact else 'different-household'
         else:
             #many parents forget to enter address for both contact 1 and contact 2.  Get the correct address for this household (don't assume contact 1 is filled in.)
-            if district_record['Contact 1 Street'].strip():
-                dp_donorrecord.update({
-                    'ADDRESS': district_record['Contact 1 Street'].strip(),
-                    'CITY': district_record['Contact 1 City'].strip(),
-                    'STATE': district_record['Contact 1 State'].strip(),
-                    'ZIP': district_record['Contact 1 Zip'].strip()
-                })
-            elif district_record['Contact 2 Relationship'] in ('Mother','Father','Stepmother','Stepfather'):
-                dp_donorrecord.update({
-                    'ADDRESS': district_record['Contact 2 Street'].strip(),
-                    'CITY': district_record['Contact 2 City'].strip(),
-                    'STATE': district_record['Contact 2 State'].strip(),
-                    'ZIP': district_record['Contact 2 Zip'].strip()
-                })
-            
-        dp_donorrecord_for_update = district_data_utils.create_dp_donorrecord(
-            district_record=district_record, school_year=args.school_year)
+            if contact1.street:
+                dp_donorrecord.update(contact1.address_fields())
+            elif contact2.is_parent or contact2.is_step_parent:
+                dp_donorrecord.update(contact2.address_fields())
+        
+        dp_donorrecord_for_update = district_record.candidate_donorrecord(school_year)
 
         # Figure out if we are changing the parent order by importing the district data
         parent_order_changed = False
@@ -510,13 +505,14 @@ for stu_number, district_record in district_records.items():
             })
 
         # Update email based on parent1 email
-        if district_record['Contact 1 Email'] and not dp_donorrecord['EMAIL']:
-            dp_donorrecord['EMAIL'] = district_record['Contact 1 Email'].strip()
+        if contact1.raw_email and not dp_donorrecord['EMAIL']:
+            dp_donorrecord['EMAIL'] = contact1.email
 
         # Update email based on parent2 email
-        parent2_email_field = 'SPOUSE_EMAIL' if district_record['Contact 1 Last Name'] else 'EMAIL'
-        if district_record['Contact 2 Email'] and not dp_donorrecord[parent2_email_field]:
-            dp_donorrecord[parent2_email_field] = district_record['Contact 2 Email'].strip()
+        parent2_email_field = 'SPOUSE_EMAIL' if contact1.raw_last_name else 'EMAIL'
+        if contact2.raw_email and not dp_donorrecord[parent2_email_field]:
+            dp_donorrecord[parent2_email_field] = contact2.email
+        return 'single-donor-update'
 
     else:
         # For multi-donor students, typically both Parent1 and Parent2 are separate donors, and the "spouse" is either
@@ -525,145 +521,181 @@ for stu_number, district_record in district_records.items():
         for dp_studentrecord in dp_studentrecords:
             dp_donorrecord = dp.get_donor(dp_studentrecord['DONOR_ID'])
             if not dp_donorrecord['EMAIL']:
-                if district_record['Contact 1 Email'] and dp_donorrecord['FIRST_NAME'] == district_record['Contact 1 First Name']:
-                    dp_donorrecord['EMAIL'] = district_record['Contact 1 Email']
-                elif district_record['Contact 2 Email'] and dp_donorrecord['FIRST_NAME'] == district_record['Contact 2 First Name']:
-                    dp_donorrecord['EMAIL'] = district_record['Contact 2 Email']
-
-# Compute manual updates for (most likely) divorced donors
-# The goal is to detect if we have fresher data in the district data, then write out notes in a file to
-# be processed by someone manually interacting with DP.
-# as of 08052022, instead of manual updates, the program will try to detect and update the address automatically.
-dp_messages_donor_ids = set()
-for stu_number, district_record in district_records.items():
-    dp_studentrecords = dp.get_students_for_stu_number(stu_number)
-    if len(dp_studentrecords) < 2:
-        continue
-    #when comparing addresses, we're only going to compare the first 8 chars of street and first 5 of zipcode.
-    #remove all space and - from string. 
-    #Also, sometimes the district address is not complete and only Contact 2 address is filled out.  Use whichever is filled in completely.
-    street = district_record['Contact 1 Street'].strip()
-    district_address_display=''
-    district_address=''
-    if street:
-        district_address = '%s%s' % (district_record['Contact 1 Street'].translate({ord(' '):None, ord('-'):None})[:8].upper().ljust(8), 
-                                    district_record['Contact 1 Zip'][:5])
-        district_address_display = '%s %s, %s %s %s %s' % (district_record['Contact 1 First Name'], district_record['Contact 1 Last Name'],
-            district_record['Contact 1 Street'], district_record['Contact 1 City'], district_record['Contact 1 State'], district_record['Contact 1 Zip'][:5])
-    elif district_record['Contact 2 Relationship'] in ("Mother", "Father", 'Stepmother', 'Stepfather'):
-        district_address = '%s%s' % (district_record['Contact 2 Street'].translate({ord(' '):None, ord('-'):None})[:8].upper().ljust(8), 
-                                    district_record['Contact 2 Zip'][:5])
-        district_address_display = '%s %s, %s %s %s %s' % (district_record['Contact 2 First Name'], district_record['Contact 2 Last Name'], 
-                                    district_record['Contact 2 Street'], district_record['Contact 2 City'], district_record['Contact 2 State'], district_record['Contact 2 Zip'][:5])
-    if district_data_utils.different_household(district_record):
-        district_address_2="%s%s"%(district_record['Contact 2 Street'].translate({ord(' '):None, ord('-'):None})[:8].upper().ljust(8),
-                                   district_record['Contact 2 Zip'][:5])
-        district_address_2_display = '%s %s, %s %s %s %s' % (district_record['Contact 2 First Name'], district_record['Contact 2 Last Name'],
-                                    district_record['Contact 2 Street'], district_record['Contact 2 City'], district_record['Contact 2 State'], district_record['Contact 2 Zip'][:5])
-    else:
-        district_address_2=''
-    # Cases we are trying to detect:
-    # 1. District address is not present on any of the donors
-    dp_addresses_by_donor_id = dict()
-    dp_addresses_by_donor_id_display=dict()
-    for dp_studentrecord in dp_studentrecords:
-        donor_id = dp_studentrecord['DONOR_ID']
-        dp_donorrecord = dp.get_donor(donor_id)
-        dp_addresses_by_donor_id[donor_id] = '%s%s' % (dp_donorrecord['ADDRESS'].translate({ord(' '):None, ord('-'):None})[:8].upper().ljust(8), 
-                                                        dp_donorrecord['ZIP'][:5])
-        dp_addresses_by_donor_id_display[donor_id] = '%s %s/%s %s %s %s %s' % (dp_donorrecord['FIRST_NAME'], dp_donorrecord['LAST_NAME'], 
-                                                                                dp_donorrecord['OPT_LINE'],dp_donorrecord['ADDRESS'], 
-                                                                                dp_donorrecord['CITY'], dp_donorrecord['STATE'], dp_donorrecord['ZIP'][:5])
-
-    donor_ids_for_student = set(dp_addresses_by_donor_id.keys())
-    if dp_messages_donor_ids.issuperset(donor_ids_for_student):
-        # In this case we have already spat out a message for all donors (because we already encountered a sibling).
-        # So, we can skip this student rather than spitting out a duplicate message.
-        continue
-    else:
-        dp_messages_donor_ids.update(donor_ids_for_student)
-    #We're trying to update the donor addresses.
-    flag_address=True
-    if street:
-        #district_address is for contact 1
-        for donor_id, dp_address in dp_addresses_by_donor_id.items():
-            dp_donorrecord=dp.get_donor(donor_id)
-            if ((district_record['Contact 1 First Name'] == dp_donorrecord['FIRST_NAME'] 
-                    and district_record['Contact 1 Last Name'] == dp_donorrecord['LAST_NAME']) 
-                or (district_record['Contact 1 First Name'] == dp_donorrecord['SP_FNAME'] 
-                    and district_record['Contact 1 Last Name'] == dp_donorrecord['SP_LNAME'])):
-                #update the address
-                dp_donorrecord.update({
-                    'ADDRESS': district_record['Contact 1 Street'].strip(),
-                    'CITY': district_record['Contact 1 City'].strip(),
-                    'STATE': district_record['Contact 1 State'].strip(),
-                    'ZIP': district_record['Contact 1 Zip'].strip()
-                })
-                flag_address=False
-
-    else:
-        #district_address is for contact 2
-        for donor_id, dp_address in dp_addresses_by_donor_id.items():
-            dp_donorrecord=dp.get_donor(donor_id)
-            if ((district_record['Contact 2 First Name'] == dp_donorrecord['FIRST_NAME'] 
-                    and district_record['Contact 2 Last Name'] == dp_donorrecord['LAST_NAME']) 
-                or (district_record['Contact 2 First Name'] == dp_donorrecord['SP_FNAME'] 
-                    and district_record['Contact 2 Last Name'] == dp_donorrecord['SP_LNAME'])):
-                #update the address
-                dp_donorrecord.update({
-                    'ADDRESS': district_record['Contact 2 Street'].strip(),
-                    'CITY': district_record['Contact 2 City'].strip(),
-                    'STATE': district_record['Contact 2 State'].strip(),
-                    'ZIP': district_record['Contact 2 Zip'].strip()
-                })
-                flag_address=False
-    if district_address_2:
-        #has a separate household
-        for donor_id, dp_address in dp_addresses_by_donor_id.items():
-            dp_donorrecord=dp.get_donor(donor_id)
-            if ((district_record['Contact 2 First Name'] == dp_donorrecord['FIRST_NAME'] 
-                    and district_record['Contact 2 Last Name'] == dp_donorrecord['LAST_NAME']) 
-                or (district_record['Contact 2 First Name'] == dp_donorrecord['SP_FNAME'] 
-                    and district_record['Contact 2 Last Name'] == dp_donorrecord['SP_LNAME'])):
-                #update the address
-                dp_donorrecord.update({
-                    'ADDRESS': district_record['Contact 2 Street'].strip(),
-                    'CITY': district_record['Contact 2 City'].strip(),
-                    'STATE': district_record['Contact 2 State'].strip(),
-                    'ZIP': district_record['Contact 2 Zip'].strip()
-                })
-                flag_address=False
-        
-    if flag_address:
-        str_list = list()
-        str_list.append("Found MANUAL UPDATE for student %s %s (%s) with %d donor records:" %
-                        (district_record['Student First Name'], district_record['Student Last Name'].strip(), stu_number, len(dp_studentrecords)))
-        for donor_id, dp_address in dp_addresses_by_donor_id_display.items():
-            str_list.append("  Donor %s address: %s" % (donor_id, dp_address))
-        str_list.append("  District address1: %s" % district_address_display)
+                if contact1.raw_email and dp_donorrecord['FIRST_NAME'] == contact1.raw_first_name:
+                    dp_donorrecord['EMAIL'] = contact1.raw_email
+                elif contact2.raw_email and dp_donorrecord['FIRST_NAME'] == contact2.raw_first_name:
+                    dp_donorrecord['EMAIL'] = contact2.raw_email
+        return 'multi-donor-email'
+
+
+def update_existing_donors(dp, district_records, school_year, split_parents, dp_messages_existingdonorrecords, decision_log=None):
+    # Compute donor-level updates, typically updating address of the student.  But if we find out that
+    #the student is now living in a divorced household (ie, alternate household exists) we want to
+    #create a donor record for the divorced parent. (this part is done manually as we need to split the
+    # original donor record into two)
+
+    for stu_number, district_record in district_records.items():
+        started = time.perf_counter()
+        dp_studentrecords = dp.get_students_for_stu_number(stu_number)
+        rule = reconcile_district_record(dp, district_record, dp_studentrecords, school_year, split_parents, dp_messages_existingdonorrecords)
+
+        if decision_log is not None:
+            # After a split this includes the new donor
+            decision_log.record('reconciled', rule, started,
+                                keys={'stu_number': stu_number, 'different_household': district_record.different_household},
+                                records={'donor_ids': [dp_studentrecord['DONOR_ID'] for dp_studentrecord in dp.get_students_for_stu_number(stu_number)]})
+
+
+def compute_manual_updates(dp, district_records, dp_messages_existingdonorrecords, decision_log=None):
+    # Compute manual updates for (most likely) divorced donors
+    # The goal is to detect if we have fresher data in the district data, then write out notes in a file to
+    # be processed by someone manually interacting with DP.
+    # as of 08052022, instead of manual updates, the program will try to detect and update the address automatically.
+    dp_messages_donor_ids = set()
+    for stu_number, district_record in district_records.items():
+        started = time.perf_counter()
+        dp_studentrecords = dp.get_students_for_stu_number(stu_number)
+        if len(dp_studentrecords) < 2:
+            continue
+        #when comparing addresses, we're only going to compare the first 8 chars of street and first 5 of zipcode.
+        #remove all space and - from string. 
+        #Also, sometimes the district address is not complete and only Contact 2 address is filled out.  Use whichever is filled in completely.
+        contact1 = district_record.contact1
+        contact2 = district_record.contact2
+        street = contact1.street
+        district_address_display=''
+        district_address=''
+        if street:
+            district_address = contact1.address_key
+            district_address_display = contact1.address_display()
+        elif contact2.is_parent or contact2.is_step_parent:
+            district_address = contact2.address_key
+            district_address_display = contact2.address_display()
+        if district_record.different_household:
+            district_address_2 = contact2.address_key
+            district_address_2_display = contact2.address_display()
+        else:
+            district_address_2=''
+        # Cases we are trying to detect:
+        # 1. District address is not present on any of the donors
+        dp_addresses_by_donor_id = dict()
+        dp_addresses_by_donor_id_display=dict()
+        for dp_studentrecord in dp_studentrecords:
+            donor_id = dp_studentrecord['DONOR_ID']
+            dp_donorrecord = dp.get_donor(donor_id)
+            dp_addresses_by_donor_id[donor_id] = utils.address_key(dp_donorrecord['ADDRESS'], dp_donorrecord['ZIP'])
+            dp_addresses_by_donor_id_display[donor_id] = '%s %s/%s %s %s %s %s' % (dp_donorrecord['FIRST_NAME'], dp_donorrecord['LAST_NAME'], 
+                                                                                    dp_donorrecord['OPT_LINE'],dp_donorrecord['ADDRESS'], 
+                                                                                    dp_donorrecord['CITY'], dp_donorrecord['STATE'], dp_donorrecord['ZIP'][:5])
+
+        donor_ids_for_student = set(dp_addresses_by_donor_id.keys())
+        if dp_messages_donor_ids.issuperset(donor_ids_for_student):
+            # In this case we have already spat out a message for all donors (because we already encountered a sibling).
+            # So, we can skip this student rather than spitting out a duplicate message.
+            if decision_log is not None:
+                decision_log.record('reconciled', 'sibling-already-reported', started, keys={'stu_number': stu_number},
+                                    records={'donor_ids': list(dp_addresses_by_donor_id)})
+            continue
+        else:
+            dp_messages_donor_ids.update(donor_ids_for_student)
+        #We're trying to update the donor addresses.
+        flag_address=True
+        #district_address is for contact 1 if it has a street, otherwise for contact 2
+        address_contacts = [contact1 if street else contact2]
         if district_address_2:
-            str_list.append("  District address2: %s" % district_address_2_display)
-        dp_messages_existingdonorrecords.append('\n'.join(str_list) + '\n\n')
-
-
-# Do any post-import data scrubbing
-dp.scrub_data(args.new_year_import)
-
-
-print()
-print("Output files:")
-
-# Output csv files for import into DP
-dp.write_updated_students_file(FILENAME_STUDENT_UPDATES)
-dp.write_new_students_for_existing_donors_file(FILENAME_NEWSTUDENT)
-dp.write_updated_donors_file(FILENAME_DONOR_UPDATES)
-dp.write_new_students_for_new_donors_file(FILENAME_NEWDONOR)
-
-# Output donor manual updates file
-utils.save_as_text_file(FILENAME_DONOR_UPDATE_MESSAGES, dp_messages_existingdonorrecords)
+            #has a separate household
+            address_contacts.append(contact2)
+        for address_contact in address_contacts:
+            for donor_id, dp_address in dp_addresses_by_donor_id.items():
+                dp_donorrecord=dp.get_donor(donor_id)
+                if (address_contact.is_named(dp_donorrecord['FIRST_NAME'], dp_donorrecord['LAST_NAME'])
+                        or address_contact.is_named(dp_donorrecord['SP_FNAME'], dp_donorrecord['SP_LNAME'])):
+                    #update the address
+                    dp_donorrecord.update(address_contact.address_fields())
+                    flag_address=False
+
+        if flag_address:
+            str_list = list()
+            str_list.append("Found MANUAL UPDATE for student %s %s (%s) with %d donor records:" %
+                            (district_record['Student First Name'], district_record['Student Last Name'].strip(), stu_number, len(dp_studentrecords)))
+            for donor_id, dp_address in dp_addresses_by_donor_id_display.items():
+                str_list.append("  Donor %s address: %s" % (donor_id, dp_address))
+            str_list.append("  District address1: %s" % district_address_display)
+            if district_address_2:
+                str_list.append("  District address2: %s" % district_address_2_display)
+            dp_messages_existingdonorrecords.append('\n'.join(str_list) + '\n\n')
 
-# Print instructions on what to do with everything
-print('''
+        if decision_log is not None:
+            decision_log.record('reconciled', 'manual-update' if flag_address else 'address-updated', started,
+                                keys={'stu_number': stu_number, 'district_addresses': [district_address, district_address_2]},
+                                records={'donor_ids': list(dp_addresses_by_donor_id)})
+
+
+def run_import(dp, district_records, school_year, new_year_import, split_parents, match_key_to_donor_id=None,
+               dp_messages_existingdonorrecords=None, completed_stage='loaded', save_checkpoint=None, columnar=False,
+               decision_log=None, phonetic_match=False):
+    """Apply the district data to dp and return the list of manual update messages.
+
+    Only the stages after completed_stage are run, so a run can resume from a checkpoint (in which case
+    dp_messages_existingdonorrecords holds the messages saved with it). save_checkpoint(stage, dp, messages)
+    is called after each stage. If anyone is reading snapshots of dp, a new one is published after each stage.
+    columnar selects the numpy-based student updates (same results, faster on large reports). The matching
+    and reconciliation decisions are recorded in decision_log if one is given. With phonetic_match, new donors
+    that sound like existing ones are noted in the messages.
+    """
+    #this list is used to output any manual updates -- splitting single household into two households.
+    if dp_messages_existingdonorrecords is None:
+        dp_messages_existingdonorrecords = list()
+
+    def reconcile():
+        update_existing_donors(dp, district_records, school_year, split_parents, dp_messages_existingdonorrecords, decision_log)
+        compute_manual_updates(dp, district_records, dp_messages_existingdonorrecords, decision_log)
+
+    stages = [
+        ('grades-advanced', lambda: get_student_updater(columnar)(dp, district_records, new_year_import)),
+        ('matched', lambda: add_new_students(dp, district_records, school_year, match_key_to_donor_id, decision_log,
+                                             dp_messages_existingdonorrecords if phonetic_match else None)),
+        ('reconciled', reconcile),
+        # Do any post-import data scrubbing
+        ('scrubbed', lambda: dp.scrub_data(new_year_import)),
+    ]
+    for stage, run_stage in stages[checkpoint.IMPORT_STAGES.index(completed_stage):]:
+        run_stage()
+        if dp.has_snapshot():
+            dp.publish()
+        if save_checkpoint:
+            save_checkpoint(stage, dp, dp_messages_existingdonorrecords)
+    return dp_messages_existingdonorrecords
+
+
+def write_output_files(dp, dp_messages_existingdonorrecords, output_dir='', chunked_output=None):
+    """Write the csv files for import into DP plus the manual updates file. Returns the record count per file.
+
+    With a utils.ChunkedOutput the csv files are split into chunks, listed in the upload manifest. Without one,
+    the chunks and manifest of an earlier chunked run are removed, so only the files of this run are uploaded.
+    """
+    if chunked_output is None:
+        for filename in [FILENAME_STUDENT_UPDATES, FILENAME_NEWSTUDENT, FILENAME_DONOR_UPDATES, FILENAME_NEWDONOR]:
+            utils.ChunkedOutput.remove_stale_chunks(os.path.join(output_dir, filename))
+        if os.path.exists(os.path.join(output_dir, FILENAME_UPLOAD_MANIFEST)):
+            os.remove(os.path.join(output_dir, FILENAME_UPLOAD_MANIFEST))
+    counts = dict()
+    counts[FILENAME_STUDENT_UPDATES] = dp.write_updated_students_file(os.path.join(output_dir, FILENAME_STUDENT_UPDATES), chunked_output)
+    counts[FILENAME_NEWSTUDENT] = dp.write_new_students_for_existing_donors_file(os.path.join(output_dir, FILENAME_NEWSTUDENT), chunked_output)
+    counts[FILENAME_DONOR_UPDATES] = dp.write_updated_donors_file(os.path.join(output_dir, FILENAME_DONOR_UPDATES), chunked_output)
+    counts[FILENAME_NEWDONOR] = dp.write_new_students_for_new_donors_file(os.path.join(output_dir, FILENAME_NEWDONOR), chunked_output)
+    if chunked_output is not None:
+        chunked_output.write_manifest(os.path.join(output_dir, FILENAME_UPLOAD_MANIFEST))
+
+    # Output donor manual updates file
+    counts[FILENAME_DONOR_UPDATE_MESSAGES] = utils.save_as_text_file(
+        os.path.join(output_dir, FILENAME_DONOR_UPDATE_MESSAGES), dp_messages_existingdonorrecords)
+    return counts
+
+
+def print_instructions():
+    # Print instructions on what to do with everything
+    print('''
 Instructions:
     %s: updates to existing students. Import first:
                  Utilities -> Import,
@@ -699,3 +731,98 @@ Instructions:
     Afterwards, have the BCE Staff update the HOME_SCHOOL manually or with an upload script for any student without a HOME_SCHOOL set.
             
 ''' % (FILENAME_STUDENT_UPDATES, FILENAME_NEWSTUDENT, FILENAME_DONOR_UPDATES, FILENAME_NEWDONOR,  FILENAME_DONOR_UPDATE_MESSAGES))
+
+
+def main():
+    args = parse_args()
+
+    print("Input files:")
+
+    budget = None
+    if args.memory_limit:
+        budget = MemoryBudget(args.memory_limit)
+        print(budget.format_plan())
+
+    try:
+        checkpoints = None
+        dp = None
+        dp_messages_existingdonorrecords = None
+        completed_stage = 'loaded'
+        if args.checkpoint_dir:
+            checkpoints = checkpoint.ImportCheckpoints(args.checkpoint_dir, args.dp_report, args.district_data, args.school_year,
+                                            args.new_year_import, args.split_parents, args.phonetic_match, budget)
+            if args.resume_from:
+                completed_stage, dp, dp_messages_existingdonorrecords = checkpoints.resume(args.resume_from)
+
+        dp_load = None
+        # Handing the loaded DP data back from the worker costs about as much as loading the district data, so this
+        # is opt-in. With a single cpu the worker would only compete with the district data load, and with a memory
+        # limit the DP data shouldn't be in two processes at once.
+        if dp is None and args.parallel_load and budget is None and (os.cpu_count() or 1) > 1:
+            dp_load = BackgroundDPLoad(args.dp_report)
+
+        # Check all rows of both files while loading them, so every problem is reported in one go
+        with input_validator.validating(args.dp_report, args.district_data) as validation:
+            # Load DP data
+            if dp is None:
+                completed_stage = 'loaded'
+                if dp_load is not None:
+                    dp, district_records = dp_load.alongside(validation, load_district_data, args.district_data,
+                                                             validation.district_data_row_check)
+                else:
+                    dp = DPData(args.dp_report, memory_budget=budget, row_check=validation.dp_report_row_check)
+                    district_records = load_district_data(args.district_data, validation.district_data_row_check)
+                if checkpoints:
+                    checkpoints.save('loaded', dp, [])
+                if args.snapshot_out:
+                    dp.write_snapshot(args.snapshot_out)
+            else:
+                validation.validate_dp_report_file()
+                district_records = load_district_data(args.district_data, validation.district_data_row_check)
+        if budget is not None:
+            budget.check(dp)
+
+        def after_stage(stage, dp, dp_messages):
+            # The import keeps growing after loading, so the memory use is checked again after every stage
+            if budget is not None:
+                budget.check(dp)
+            if checkpoints:
+                checkpoints.save(stage, dp, dp_messages)
+
+        decision_log = DecisionLog(args.decision_log) if args.decision_log else None
+        try:
+            dp_messages_existingdonorrecords = run_import(dp, district_records, args.school_year,
+                                                          args.new_year_import, args.split_parents,
+                                                          dp_messages_existingdonorrecords=dp_messages_existingdonorrecords,
+                                                          completed_stage=completed_stage,
+                                                          save_checkpoint=after_stage,
+                                                          columnar=args.columnar,
+                                                          decision_log=decision_log,
+                                                          phonetic_match=args.phonetic_match)
+            if decision_log is not None:
+                print()
+                print(decision_log.format_summary())
+
+            print()
+            print("Output files:")
+            chunked_output = None
+            if args.chunk_rows or args.chunk_bytes:
+                chunked_output = utils.ChunkedOutput(args.chunk_rows, args.chunk_bytes)
+            write_output_files(dp, dp_messages_existingdonorrecords, chunked_output=chunked_output)
+        finally:
+            # Also when the import fails, so the decisions up to the failure are in the file with their summary
+            if decision_log is not None:
+                decision_log.close()
+    finally:
+        # Also when the import fails, so nothing is left behind in the spill directory
+        if budget is not None:
+            print(budget.format_usage())
+            budget.close()
+    print_instructions()
+    if chunked_output is not None:
+        print("The csv files are split into chunks: import the chunks of each file in the order listed in %s, "
+              "checking the ROWS and SHA256 of any chunk that has to be retried." % FILENAME_UPLOAD_MANIFEST)
+
+
+if __name__ == '__main__':
+    main()
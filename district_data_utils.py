@@ -1,3 +1,6 @@
+from operator import itemgetter
+from types import MappingProxyType
+
 import utils
 
 DISTRICT_DATA_HEADERS = ['School', 'SystemID', 'Student Last Name', 'Student First Name', 
@@ -75,103 +78,208 @@ def create_informal_sal(main_f_name, spouse_f_name):
     return informal_sal
 
 
+PARENT_RELATIONSHIPS = ('Mother', 'Father')
+STEP_PARENT_RELATIONSHIPS = ('Stepmother', 'Stepfather')
+
+
+class DistrictContact:
+    """One contact (parent) of a district record, parsed once.
+
+    The plain attributes are stripped; raw_* keep the value exactly as the district sent it, for the places
+    that compare against or copy the unstripped value.
+    """
+    __slots__ = ('first_name', 'last_name', 'email', 'street', 'city', 'state', 'zip', 'phone', 'relationship',
+                 'raw_first_name', 'raw_last_name', 'raw_email', 'raw_street', 'raw_city', 'raw_state', 'raw_zip',
+                 'is_parent', 'is_step_parent', 'street_prefix', 'address_key')
+
+    def __init__(self, row, number):
+        prefix = 'Contact %d ' % number
+        self.raw_first_name = row[prefix + 'First Name']
+        self.raw_last_name = row[prefix + 'Last Name']
+        self.raw_email = row[prefix + 'Email']
+        self.raw_street = row[prefix + 'Street']
+        self.raw_city = row[prefix + 'City']
+        self.raw_state = row[prefix + 'State']
+        self.raw_zip = row[prefix + 'Zip']
+        self.first_name = self.raw_first_name.strip()
+        self.last_name = self.raw_last_name.strip()
+        self.email = self.raw_email.strip()
+        self.street = self.raw_street.strip()
+        self.city = self.raw_city.strip()
+        self.state = self.raw_state.strip()
+        self.zip = self.raw_zip.strip()
+        self.phone = row[prefix + 'Phone']
+        self.relationship = row[prefix + 'Relationship']
+        self.is_parent = self.relationship in PARENT_RELATIONSHIPS
+        self.is_step_parent = self.relationship in STEP_PARENT_RELATIONSHIPS
+        #We only match the first 8 chars of the address as we see lots of different
+        #variation on addresses.
+        self.street_prefix = self.street.upper()[:8]
+        #first 8 chars of street (without space and -) and first 5 of zipcode, for comparing against DP addresses
+        self.address_key = utils.address_key(self.raw_street, self.raw_zip)
+
+    def is_named(self, first_name, last_name):
+        """True if this contact has exactly the given first and last name (e.g. those of a DP donor or spouse)"""
+        return self.raw_first_name == first_name and self.raw_last_name == last_name
+
+    def address_fields(self):
+        """The DP donor address fields for this contact's address"""
+        return {'ADDRESS': self.street, 'CITY': self.city, 'STATE': self.state, 'ZIP': self.zip}
+
+    def address_display(self):
+        return '%s %s, %s %s %s %s' % (self.raw_first_name, self.raw_last_name,
+                                       self.raw_street, self.raw_city, self.raw_state, self.raw_zip[:5])
+
+
+class DistrictRecord:
+    """A district data row, with its contacts parsed and normalized once so every import stage can reuse them.
+
+    Indexing with a district csv header still returns the raw value from the row.
+    """
+    __slots__ = ('row', 'stu_number', 'contact1', 'contact2', 'different_household', 'donor_candidates')
+
+    def __init__(self, row, sibling=None):
+        self.row = row
+        self.stu_number = row['SystemID']
+        if sibling is not None:
+            # Same contact columns (see DistrictHouseholds), and everything below only depends on those
+            self.contact1 = sibling.contact1
+            self.contact2 = sibling.contact2
+            self.different_household = sibling.different_household
+            self.donor_candidates = sibling.donor_candidates
+            return
+        self.contact1 = DistrictContact(row, 1)
+        self.contact2 = DistrictContact(row, 2)
+        #it's two households if the two addresses are different (not empty) AND the second
+        #household is mother/father relationship.
+        self.different_household = bool(self.contact1.street and self.contact2.street
+                                        and self.contact1.street_prefix != self.contact2.street_prefix
+                                        and self.contact2.is_parent)
+        # (school_year, use_alternate, swap_parents) -> candidate donor record, see candidate_donorrecord
+        self.donor_candidates = dict()
+
+    def __getitem__(self, header):
+        return self.row[header]
+
+    def get(self, header, default=None):
+        return self.row.get(header, default)
+
+    def swaps_parents(self):
+        """True if create_dp_donorrecord(..., swap_parents=True) gives a different record than without swapping"""
+        return bool(self.contact1.last_name and self.contact2.last_name and not self.different_household
+                    and (self.contact2.is_parent or self.contact2.is_step_parent))
+
+    def candidate_donorrecord(self, school_year, use_alternate=False, swap_parents=False):
+        """create_dp_donorrecord for this record, built on first use and then shared by every stage of the run.
+
+        The result is read-only (or None if there is no alternate household); copy it before changing it.
+        """
+        key = (school_year, use_alternate, swap_parents)
+        if key not in self.donor_candidates:
+            if swap_parents and not use_alternate and not self.swaps_parents():
+                candidate = self.candidate_donorrecord(school_year)
+            else:
+                dp_donorrecord = create_dp_donorrecord(self, school_year, use_alternate, swap_parents)
+                candidate = None if dp_donorrecord is None else MappingProxyType(dp_donorrecord)
+            self.donor_candidates[key] = candidate
+        return self.donor_candidates[key]
+
+
+# The district columns the contacts (and so the candidate donor records) are built from
+CONTACT_HEADERS = [header for header in DISTRICT_DATA_HEADERS if header.startswith('Contact ')]
+
+
+class DistrictHouseholds:
+    """Groups district records into households as they are loaded. Siblings with the same contact columns (parent
+    names, addresses, emails and phones) share the parsed contacts and the candidate donor records, so those are
+    built once per household and then used by the per-student matching and reconciling.
+
+    Only exact copies are grouped: the candidate donor records keep some of the raw values, so siblings whose
+    contact columns differ even in whitespace get their own.
+    """
+
+    def __init__(self):
+        # contact columns -> the first district record with them
+        self.__households = dict()
+        self.__contact_values = itemgetter(*CONTACT_HEADERS)
+
+    def district_record(self, row):
+        """The DistrictRecord for row, sharing the household data of an earlier sibling if there is one"""
+        contact_values = self.__contact_values(row)
+        sibling = self.__households.get(contact_values)
+        district_record = DistrictRecord(row, sibling)
+        if sibling is None:
+            self.__households[contact_values] = district_record
+        return district_record
+
+
 def different_household(district_record):
     #return True if the district record contains two households.
-    #it's two household if the two addresses are different (not empty) AND the second
-    #household is mother/father relationship.
-    #We only match the first 8 chars of the address as we see lots of different
-    #variation on addresses.
-    street1=district_record['Contact 1 Street'].strip()
-    street2=district_record['Contact 2 Street'].strip()
-    if (street1 and street2
-        and district_record['Contact 1 Street'].strip().upper()[:8] != district_record['Contact 2 Street'].strip().upper()[:8]):
-        return district_record['Contact 2 Relationship'] in ('Mother', 'Father')
-    return False
+    return district_record.different_household
+
 
 def create_dp_donorrecord(district_record, school_year, use_alternate=False, swap_parents=False):
     """Create a DP donorrecord from the given district record (without creating any studentrecords)."""
     if not school_year:
         raise ValueError("school_year param required")
-    
+
+    contact1 = district_record.contact1
+    contact2 = district_record.contact2
+    #unless set below, there is no spouse info
+    spouse_f_name = ""
+    spouse_l_name = ""
+    spouse_email = ""
+    spouse_phone = ""
     if use_alternate:
-        if different_household(district_record):
-            main_l_name=district_record['Contact 2 Last Name']
-            if not main_l_name:
-                return None
-            main_f_name = district_record['Contact 2 First Name']
-            main_email = district_record['Contact 2 Email']
-            main_phone = district_record['Contact 2 Phone']
-            street = district_record['Contact 2 Street']
-            city = district_record['Contact 2 City']
-            zip = district_record['Contact 2 Zip']
-            state = district_record['Contact 2 State']
-            #alternate household do not have spouse info
-            spouse_f_name = ""
-            spouse_l_name = ""
-            spouse_email=""
-            spouse_phone=""
-        else:
+        if not district_record.different_household or not contact2.raw_last_name:
             return None
+        #the alternate household is contact 2, taken as-is, and does not have spouse info
+        main_f_name = contact2.raw_first_name
+        main_l_name = contact2.raw_last_name
+        main_email = contact2.raw_email
+        main_phone = contact2.phone
+        street = contact2.raw_street
+        city = contact2.raw_city
+        zip = contact2.raw_zip
+        state = contact2.raw_state
+    elif len(contact1.last_name) != 0:
+        main_f_name = contact1.first_name
+        main_l_name = contact1.last_name
+        main_email = contact1.email
+        main_phone = contact1.phone
+        #if contact1 street is empty, use contact2 street instead -- as sometimes one parent only fills in the address partially.
+        address_contact = contact1
+        if not contact1.street and (contact2.is_parent or contact2.is_step_parent):
+            address_contact = contact2
+        street = address_contact.street
+        city = address_contact.raw_city
+        zip = address_contact.raw_zip
+        state = address_contact.raw_state
+        #spouse record is filled in ONLY if the address is the same AND
+        # contact 2 relationship is mother/father/stepfather/stepmother
+        #not a different household but if the contact2 relationship is NOT mother/father/stepmother/stepfather
+        #we don't want to include it as the same household.  Sometimes when people
+        #are living in multi-generational household, this could list their grandmother, aunt, etc.
+        if not district_record.different_household and (contact2.is_parent or contact2.is_step_parent):
+            spouse_f_name = contact2.first_name
+            spouse_l_name = contact2.last_name
+            spouse_email = contact2.email
+            spouse_phone = contact2.phone
+            if spouse_l_name and swap_parents:
+                #we want to swap the parents in this case
+                main_f_name, spouse_f_name = spouse_f_name, main_f_name
+                main_l_name, spouse_l_name = spouse_l_name, main_l_name
+                main_email, spouse_email = spouse_email, main_email
+                main_phone, spouse_phone = spouse_phone, main_phone
     else:
-        main_l_name = district_record['Contact 1 Last Name'].strip() 
-        if len(main_l_name) != 0:
-            main_f_name = district_record['Contact 1 First Name'].strip()
-            main_email = district_record['Contact 1 Email'].strip()
-            main_phone = district_record['Contact 1 Phone']
-            #if contact1 street is empty, use contact2 street instead -- as sometimes one parent only fills in the address partially.
-            street = district_record['Contact 1 Street'].strip()
-            city = district_record['Contact 1 City']
-            zip = district_record['Contact 1 Zip']
-            state = district_record['Contact 1 State']
-            if not street and district_record['Contact 2 Relationship'] in ("Mother","Father", 'Stepmother','Stepfather'):
-                street=district_record['Contact 2 Street'].strip()
-                city = district_record['Contact 2 City']
-                zip=district_record['Contact 2 Zip']
-                state = district_record['Contact 2 State']
-            #spouse record is filled in ONLY if the address is the same AND
-            # contact 2 relationship is mother/father/stepfather/stepmother
-            if different_household(district_record):
-                spouse_f_name=""
-                spouse_l_name=""
-                spouse_email=""
-                spouse_phone=""
-            else:
-                #not a different household but if the contact2 relationship is NOT mother/father/stepmother/stepfather
-                #we don't want to include it as the same household.  Sometimes when people
-                #are living in multi-generational household, this could list their grandmother, aunt, etc.
-                if district_record['Contact 2 Relationship'] in ('Mother','Father','Stepmother','Stepfather'):
-                    spouse_f_name = district_record['Contact 2 First Name'].strip()
-                    spouse_l_name = district_record['Contact 2 Last Name'].strip()
-                    spouse_email = district_record['Contact 2 Email'].strip()
-                    spouse_phone=district_record['Contact 2 Phone']
-                    if spouse_l_name and swap_parents:
-                        #we want to swap the parents in this case
-                        main_l_name = district_record['Contact 2 Last Name'].strip()
-                        main_f_name = district_record['Contact 2 First Name'].strip()
-                        main_email = district_record['Contact 2 Email'].strip()
-                        main_phone = district_record['Contact 2 Phone']
-                        spouse_f_name = district_record['Contact 1 First Name'].strip()
-                        spouse_l_name = district_record['Contact 1 Last Name'].strip()
-                        spouse_email = district_record['Contact 1 Email'].strip()
-                        spouse_phone=district_record['Contact 1 Phone']
-                else:
-                    spouse_f_name=""
-                    spouse_l_name=""
-                    spouse_email=""
-                    spouse_phone=""
-        else:
-            main_f_name = district_record['Contact 2 First Name'].strip()
-            main_l_name = district_record['Contact 2 Last Name'].strip()
-            main_email = district_record['Contact 2 Email'].strip()
-            main_phone = district_record['Contact 2 Phone']
-            street = district_record['Contact 2 Street'].strip()
-            city = district_record['Contact 2 City']
-            zip = district_record['Contact 2 Zip']
-            state = district_record['Contact 2 State']            
-            spouse_f_name = ""
-            spouse_l_name = ""
-            spouse_email = ""
-            spouse_phone = ""
+        main_f_name = contact2.first_name
+        main_l_name = contact2.last_name
+        main_email = contact2.email
+        main_phone = contact2.phone
+        street = contact2.street
+        city = contact2.raw_city
+        zip = contact2.raw_zip
+        state = contact2.raw_state
 
     salutation = create_salutation(main_f_name, main_l_name, spouse_f_name, spouse_l_name)
     informal_sal = create_informal_sal(main_f_name, spouse_f_name)
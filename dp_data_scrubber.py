@@ -1,33 +1,94 @@
 import argparse
 
-from dpdata import DPData
+from dpdata import DP_DONOR_UPDATE_HEADERS, DP_REPORT_271_DONOR_HEADERS, DP_REPORT_271_HEADERS, DP_REPORT_271_STUDENT_HEADERS
+import dpdata
+import external_sort
+import utils
 
 
 FILENAME_DONOR_UPDATES = 'donor-updates.csv'
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--dp-report",
-                    help="csv output from DP: Reports -> Custom Report Writer -> Include \"NO MAIL\" Names -> 271 -> CSV",
-                    required=True)
-args = parser.parse_args()
+def group_rows_by_donor(rows):
+    """Yields (donor_id, rows) for each run of consecutive rows with the same DONOR_ID.
 
-print("Input files:")
+    Only one donor's rows are held at a time. Raises ValueError if a donor's rows are not all together.
+    """
+    seen_donor_ids = set()
+    donor_id = None
+    group = []
+    for row in rows:
+        if row['DONOR_ID'] != donor_id:
+            if group:
+                yield donor_id, group
+            donor_id = row['DONOR_ID']
+            if donor_id in seen_donor_ids:
+                raise ValueError("The rows for DONOR_ID %s are not together, the report must be grouped by DONOR_ID" % donor_id)
+            seen_donor_ids.add(donor_id)
+            group = []
+        group.append(row)
+    if group:
+        yield donor_id, group
 
-# Load DP data
-dp = DPData(args.dp_report)
 
-dp.scrub_data()
+def donor_group_records(rows):
+    """The donorrecord and studentrecords for one donor's report rows, the same way DPData loads them"""
+    donorrecord = dict((header, rows[0][header]) for header in DP_REPORT_271_DONOR_HEADERS)
+    studentrecords = []
+    for row in rows:
+        if dict((header, row[header]) for header in DP_REPORT_271_DONOR_HEADERS) != donorrecord:
+            raise ValueError(
+                "Unexpected differences in donors. Assumptions must be incorrect. Expected: %s, Actual: %s" %
+                (donorrecord, dict((header, row[header]) for header in DP_REPORT_271_DONOR_HEADERS)))
+        studentrecord = dict((header, row[header]) for header in DP_REPORT_271_STUDENT_HEADERS)
+        dpdata.fix_studentrecord(studentrecord)
+        #sometimes DP has duplicate student records for the same donor.
+        if not any(student['STU_NUMBER'] == row['STU_NUMBER'] for student in studentrecords):
+            studentrecords.append(studentrecord)
+    return donorrecord, studentrecords
 
-print()
-print("Output files:")
 
-# Output csv files for import into DP
-dp.write_updated_donors_file(FILENAME_DONOR_UPDATES)
+def scrub_report_rows(rows, new_year):
+    """Yields a donor update row for each donor the scrub rules change, one donor group at a time"""
+    includes_nomail = False
+    project = utils.RowProjector(DP_DONOR_UPDATE_HEADERS[:-1])
+    for donor_id, group in group_rows_by_donor(rows):
+        dp_donorrecord, dp_studentrecords = donor_group_records(group)
+        unmodified_donorrecord = dp_donorrecord.copy()
+        if dp_donorrecord['NOMAIL'] == 'Y':
+            includes_nomail = True
+        # Nothing was imported, so every student still has the school from the report
+        unmodified_schools = dict((dp_studentrecord['OTHER_ID'], dp_studentrecord['SCHOOL']) for dp_studentrecord in dp_studentrecords)
+        dpdata.scrub_donorrecord(dp_donorrecord, dp_studentrecords, unmodified_schools, new_year)
+        if int(donor_id) >= 0 and dp_donorrecord != unmodified_donorrecord:
+            yield project(dp_donorrecord) + ('|'.join(utils.modified_fields(unmodified_donorrecord, dp_donorrecord)),)
+    if not includes_nomail:
+        raise ValueError("The DP report must include \"NO MAIL\" donors. Please select 'Include \"NO MAIL\" Names' and regenerate the report.")
 
 
-# Print instructions on what to do with everything
-print('''
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dp-report",
+                        help="csv output from DP: Reports -> Custom Report Writer -> Include \"NO MAIL\" Names -> 271 -> CSV",
+                        required=True)
+    parser.add_argument("--new-year", help="scrub as at the start of a school year (clears HOME_SCHOOL for families at several schools)",
+                        action='store_true')
+    parser.add_argument("--temp-dir", help="directory for temporary files when the report has to be sorted (default: system temp dir)")
+    args = parser.parse_args()
+
+    print("Input files:")
+    # DP doesn't guarantee the export order, so group the rows by sorting them (on disk if needed)
+    rows = external_sort.sorted_csv_rows(args.dp_report, 'DONOR_ID', DP_REPORT_271_HEADERS, temp_dir=args.temp_dir)
+
+    print()
+    print("Output files:")
+
+    # Stream the donor updates straight to the csv file for import into DP
+    utils.save_as_csv_rows(FILENAME_DONOR_UPDATES, DP_DONOR_UPDATE_HEADERS, scrub_report_rows(rows, args.new_year))
+
+
+    # Print instructions on what to do with everything
+    print('''
 Instructions:
     %s: updates to existing donors. Import:
                  Utilities -> Import,
@@ -35,3 +96,7 @@ Instructions:
                  Select Type of Records = Names and Addresses,
                  Ignore _modified_fields
 ''' % (FILENAME_DONOR_UPDATES))
+
+
+if __name__ == '__main__':
+    main()
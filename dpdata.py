@@ -1,5 +1,12 @@
 from collections import defaultdict, OrderedDict
-
+from types import MappingProxyType
+import copy
+import threading
+
+from columnar_snapshot import ColumnarSnapshot, TABLE_DONORS, TABLE_STUDENTS
+from id_allocator import IdAllocator
+from memory_budget import CHECK_EVERY_ROWS
+import columnar_snapshot
 import utils
 
 DP_REPORT_271_DONOR_HEADERS = ['DONOR_ID','FIRST_NAME','LAST_NAME','SP_FNAME','SP_LNAME',
@@ -16,6 +23,8 @@ DP_REPORT_271_STUDENT_HEADERS = ['DONOR_ID','STU_NUMBER','STU_FNAME','STU_LNAME'
 
 DP_REPORT_271_HEADERS = list(set(DP_REPORT_271_DONOR_HEADERS + DP_REPORT_271_STUDENT_HEADERS))
 
+DP_DONOR_UPDATE_HEADERS = utils.list_with_mods(DP_REPORT_271_DONOR_HEADERS, add=['_MODIFIED_FIELDS'], remove=['ADVISORY_MEMBER_MULTICODE', 'SP_ADVISOR_MEMBER_MULTICODE'])
+
 DP_SCHOOL_TO_HOMESCHOOL={
     'BIS': 'BIS',
     'FRANKLIN': 'FRA',
@@ -26,32 +35,249 @@ DP_SCHOOL_TO_HOMESCHOOL={
     'WASHINGTON': 'WAS'
 }
 
+
+def calculate_homeschool(student_list):
+    '''given a list of students for the donor, calculate their homeschool.
+    Return the elementary school for all students unless all are in BIS.
+    If more than one elementary school, return 'multiple'.
+    '''
+    current_school = ''
+    bis=False
+    for student in student_list:
+        if student['SCHOOL']  in ['FRANKLIN', 'HOOVER', 'LINCOLN','MCKINLEY','ROOSEVELT', 'WASHINGTON']:                
+            if current_school and not current_school == student['SCHOOL']:
+                current_school = 'multiple'
+            else:
+                current_school=student['SCHOOL']
+        elif student['SCHOOL'] == 'BIS':
+            bis=True
+    if current_school == 'multiple':
+        return 'multiple'
+    if not current_school:
+        return 'BIS' if bis else ""
+    return DP_SCHOOL_TO_HOMESCHOOL[current_school]
+
+
+def scrub_donorrecord(dp_donorrecord, dp_studentrecords, unmodified_schools, new_year):
+    '''Apply the post-import scrub rules to one donor, given all of its students.
+    unmodified_schools maps OTHER_ID to the SCHOOL the student had in the DP report (new students are missing).
+    The rules only look at the donor's own students, so donors can be scrubbed one at a time, e.g. while streaming.
+    '''
+    _fixup_nomail_flag(dp_donorrecord, dp_studentrecords, unmodified_schools)
+    _copy_spouse_email(dp_donorrecord)
+    _set_home_school(dp_donorrecord, dp_studentrecords, new_year)
+
+
+def _fixup_nomail_flag(dp_donorrecord, dp_studentrecords, unmodified_schools):
+    # Fix up NOMAIL stuff
+    student_count_district = 0
+    student_count_nobsd = 0
+    student_count_converted_to_nobsd = 0
+
+    for dp_studentrecord in dp_studentrecords:
+        if dp_studentrecord['SCHOOL'] not in ['ALUM','NOBSD']:
+            student_count_district += 1
+        elif dp_studentrecord['SCHOOL'] == 'NOBSD':
+            student_count_nobsd += 1
+            try:
+                if unmodified_schools[dp_studentrecord['OTHER_ID']] != 'NOBSD':
+                    student_count_converted_to_nobsd += 1
+            except KeyError:
+                pass
+
+    if dp_donorrecord['NOMAIL'] == 'N' and student_count_district == 0:
+        # Donor has no current students...
+        # If all students are NOBSD, then they get flipped to NO
+        # Or if they removed kids from the district, then they get flipped to NO
+        # The other case here is various combinations of ALUM students
+        if student_count_nobsd == len(dp_studentrecords) or student_count_converted_to_nobsd > 0:
+            dp_donorrecord['NOMAIL'] = 'Y'
+            dp_donorrecord['NOMAIL_REASON'] = 'NO'
+            dp_donorrecord['DONOR_TYPE'] = 'NO'
+    elif dp_donorrecord['NOMAIL'] == 'Y' and dp_donorrecord['NOMAIL_REASON'] == 'NO' and student_count_district > 0:
+        # They have kids in the district, so we need to unset NOMAIL
+        dp_donorrecord['NOMAIL'] = 'N'
+        dp_donorrecord['NOMAIL_REASON'] = 'NU' # Signifies null (cannot set to actual null on import)
+        dp_donorrecord['DONOR_TYPE'] = 'IN'
+
+    #anyone with student in district SHOULD be set with Donortype=IN
+    if student_count_district and not dp_donorrecord['DONOR_TYPE'] == 'IN':
+        dp_donorrecord['DONOR_TYPE']='IN'
+    # Legacy data cleanup
+    if dp_donorrecord['NOMAIL'] == 'N' and dp_donorrecord['NOMAIL_REASON'] not in ['','NU']:
+        # Empty out NOMAIL_REASON if NOMAIL not set
+        dp_donorrecord['NOMAIL_REASON'] = 'NU'
+
+
+def _copy_spouse_email(dp_donorrecord):
+    # we need to have email field populated even if the district has no parent1 email
+    if dp_donorrecord['SPOUSE_EMAIL'] and not dp_donorrecord['EMAIL']:
+        dp_donorrecord['EMAIL'] = dp_donorrecord['SPOUSE_EMAIL']
+
+
+def _set_home_school(dp_donorrecord, dp_studentrecords, new_year):
+    '''set the HOME_SCHOOL field to the correct elementary school or BIS as appropriate
+    If they are no longer in BSD, set it to empty.  Also set Former_ELEMENTARY_SCHOOL.
+    '''
+    #if the donor is no longer in BSD, donor_type=NO, set HOME_SCHOOL to empty
+    # and set the former_elem_school if the home_school was an elementary school
+    # note that former_elem_school does not need to be reset if it's already set.
+    # DP does not allow you to 'unset' a field (ie set it to empty string) during file import.
+    # so the only way to 'unset' the HOME_SCHOOL field is to set to to something and use
+    # global update in DP to set it to "".  So we'll use "EMPTY" as the code to indicate to unset the field.
+    old_homeschool = dp_donorrecord['HOME_SCHOOL']
+    if old_homeschool == 'NULL':  #fix problem with DP data sending us NULL.
+        old_homeschool = ''
+    if dp_donorrecord['DONOR_TYPE'] == 'NO':
+        #if former elemen school is not set, move the existing home_school if that's elementary.
+        if not dp_donorrecord['FORMER_ELEM_SCHOOL'] and dp_donorrecord['HOME_SCHOOL'] in ('FRA','LIN','MCK','HOO','ROOS','WAS'):
+            dp_donorrecord['FORMER_ELEM_SCHOOL'] = dp_donorrecord['HOME_SCHOOL']
+        if old_homeschool:  #if it's set to something indicate that it should be unset
+            dp_donorrecord['HOME_SCHOOL'] = 'EMPTY'
+    else:
+        new_homeschool = calculate_homeschool(dp_studentrecords)
+        if new_homeschool == 'multiple':
+            if new_year:
+                #when new year, reset home_school to empty if we get multiple returns.
+                if old_homeschool:  #only if it's not empty -- set it to empty
+                    dp_donorrecord['HOME_SCHOOL'] = 'EMPTY'
+
+            #otherwise, leave it as-is.  If it's already set, we will use that for the rest of the year
+            # if it's not already set, we can't set it anyway.
+        elif new_homeschool:
+            dp_donorrecord['HOME_SCHOOL'] = new_homeschool
+        elif old_homeschool:  #if there was something there, reset to EMPTY
+            dp_donorrecord['HOME_SCHOOL'] = 'EMPTY'
+
+        #try to set the former_elementary _school if not already set.
+        if not dp_donorrecord['FORMER_ELEM_SCHOOL'] and new_homeschool == 'BIS':
+            if old_homeschool in ('FRA','LIN','MCK','HOO','ROOS','WAS'):
+                dp_donorrecord['FORMER_ELEM_SCHOOL'] = old_homeschool 
+
+
+def fix_studentrecord(data):
+    #fix the studentrecord from DP to cleanup any issues with the data.
+    yearto = data['YEARTO']
+    if not yearto == "":
+        data['YEARTO'] = int(float(yearto.replace(",",'')))
+        if data['YEARTO'] == 0:
+            data['YEARTO'] = ''
+
+
+class DPSnapshot:
+    """An immutable point-in-time view of a DPData, published with DPData.publish().
+
+    Any number of threads can read a snapshot without locking while the import keeps changing the DPData.
+    Records are read-only mappings; unchanged records are shared with the previous snapshot, not copied.
+    """
+
+    def __init__(self, version, donorrecords, studentrecords, donor_id_to_other_ids, stu_number_to_other_ids):
+        self.version = version
+        self.__donorrecords = donorrecords
+        self.__studentrecords = studentrecords
+        self.__donor_id_to_other_ids = donor_id_to_other_ids
+        self.__stu_number_to_other_ids = stu_number_to_other_ids
+        self.__query = None
+
+    def get_donor(self, donor_id):
+        return self.__donorrecords[donor_id]
+
+    def has_donor(self, donor_id):
+        return donor_id in self.__donorrecords
+
+    def get_donors(self):
+        return self.__donorrecords.values()
+
+    def get_student(self, other_id):
+        return self.__studentrecords.get(other_id)
+
+    def get_students(self):
+        return self.__studentrecords.values()
+
+    def get_students_for_donor(self, donor_id):
+        return [self.__studentrecords[other_id] for other_id in self.__donor_id_to_other_ids.get(donor_id, ())]
+
+    def get_students_for_stu_number(self, stu_number):
+        return [self.__studentrecords[other_id] for other_id in self.__stu_number_to_other_ids.get(stu_number, ())]
+
+    def query(self):
+        """A DPQuery over this snapshot; its indexes are built on demand and shared by all callers"""
+        if self.__query is None:
+            from dpquery import DPQuery
+            self.__query = DPQuery(self)
+        return self.__query
+
+    def updated(self, donorrecords, studentrecords, donor_id_to_other_ids, stu_number_to_other_ids):
+        """The next version of this snapshot for the given (mutable) records and indexes"""
+        return DPSnapshot(self.version + 1,
+                          self.__frozen_records(donorrecords, self.__donorrecords),
+                          self.__frozen_records(studentrecords, self.__studentrecords),
+                          self.__frozen_index(donor_id_to_other_ids, self.__donor_id_to_other_ids),
+                          self.__frozen_index(stu_number_to_other_ids, self.__stu_number_to_other_ids))
+
+    @staticmethod
+    def __frozen_records(records, previous):
+        # Read-only copies of the records, reusing the previous ones that are unchanged
+        frozen = OrderedDict()
+        for record_id, record in records.items():
+            frozen_record = previous.get(record_id)
+            if frozen_record is None or frozen_record != record:
+                frozen_record = MappingProxyType(dict(record))
+            frozen[record_id] = frozen_record
+        return frozen
+
+    @staticmethod
+    def __frozen_index(index, previous):
+        frozen = dict()
+        for key, ids in index.items():
+            frozen_ids = previous.get(key)
+            if frozen_ids is None or list(frozen_ids) != ids:
+                frozen_ids = tuple(ids)
+            frozen[key] = frozen_ids
+        return frozen
+
+
 class DPData:
     # These are the default match fields (and number of chars to compare) for DP donors
     __DONOR_MATCH_FIELDS = OrderedDict([('LAST_NAME', 10), ('FIRST_NAME', 8), ('ADDRESS', 8), ('ZIP', 5)])
+    # (last name, first name) fields of the people on a donor record, for the phonetic index
+    __DONOR_NAME_FIELDS = [('LAST_NAME', 'FIRST_NAME'), ('SP_LNAME', 'SP_FNAME')]
 
-    def __init__(self, dp_report_filename):
+    def __init__(self, dp_report_filename, id_allocator=None, memory_budget=None, row_check=None):
         self.__donorrecords = OrderedDict()
-        self.__unmodified_donorrecords = OrderedDict()
         self.__studentrecords = OrderedDict()
+        # Only needed again when writing the output files, so they go to disk if memory gets tight (see memory_budget)
+        self.__unmodified_donorrecords = OrderedDict()
         self.__unmodified_studentrecords = OrderedDict()
+        self.__memory_budget = memory_budget
         self.__donor_id_to_other_ids = defaultdict(list)
         self.__stu_number_to_other_ids = defaultdict(list)
-        self.__last_seq_values = dict()
+        # (soundex of last name, soundex of first name) -> donor ids, for the donor and the spouse. Only needed with
+        # --phonetic-match, so it is built on the first find_phonetic_matches (None until then)
+        self.__phonetic_name_to_donor_ids = None
+        # Hands out the negative placeholder DONOR_IDs/OTHER_IDs for new records, safe to use from several threads
+        self.__id_allocator = id_allocator or IdAllocator()
+        self.__snapshot = None
+        self.__publish_lock = threading.Lock()
+        if memory_budget is not None:
+            memory_budget.check(self)
         if dp_report_filename:
-            self.__load_dp_report(dp_report_filename)
+            self.__load_dp_report(dp_report_filename, row_check)
 
-    def __load_dp_report(self, dp_report_filename):
+    def __load_dp_report(self, dp_report_filename, row_check=None):
         includes_nomail = False
-        for row in utils.load_csv_file(dp_report_filename, DP_REPORT_271_HEADERS):
+        for row_number, row in enumerate(utils.load_csv_file(dp_report_filename, DP_REPORT_271_HEADERS, row_check), 1):
+            if self.__memory_budget is not None and row_number % CHECK_EVERY_ROWS == 0:
+                self.__memory_budget.check(self)
             # Process donor-level info
             donor_id = row['DONOR_ID']
             donorrecord = dict((header, row[header]) for header in DP_REPORT_271_DONOR_HEADERS)
             if donor_id in self.__donorrecords:
-                if donorrecord != self.__unmodified_donorrecords[donor_id]:
+                # Nothing is modified while loading, so this is the same as the unmodified record
+                if donorrecord != self.__donorrecords[donor_id]:
                     raise ValueError(
                         "Unexpected differences in donors. Assumptions must be incorrect. Expected: %s, Actual: %s" %
-                        (self.__unmodified_donorrecords[donor_id], donorrecord))
+                        (self.__donorrecords[donor_id], donorrecord))
             else:
                 self.add_donor(donorrecord)
                 self.__unmodified_donorrecords[donor_id] = donorrecord.copy()
@@ -61,7 +287,7 @@ class DPData:
             if other_id in self.__studentrecords:
                 raise ValueError("Found a duplicate OTHER_ID in report 271, the report's assumptions are now violated")
             studentrecord = dict((header, row[header]) for header in DP_REPORT_271_STUDENT_HEADERS)
-            self.__fix_studentrecord(studentrecord)
+            fix_studentrecord(studentrecord)
             #before adding this student record, check to make sure it's a unique student for the given donor.
             #sometimes DP has duplicate student records for the same donor.
             duplicate_other=False
@@ -78,24 +304,140 @@ class DPData:
         if not includes_nomail:
             raise ValueError("%s must include \"NO MAIL\" donors. Please select 'Include \"NO MAIL\" Names' and regenerate the report." % dp_report_filename)
 
-    def __next_seq_value(self, seq):
-        next = self.__last_seq_values.get(seq, 0) + 1
-        self.__last_seq_values[seq] = next
-        return next
-
-    def __fix_studentrecord(self, data):
-        #fix the studentrecord from DP to cleanup any issues with the data.
-        yearto = data['YEARTO']
-        if not yearto == "":
-            data['YEARTO'] = int(float(yearto.replace(",",'')))
-            if data['YEARTO'] == 0:
-                data['YEARTO'] = ''
+    @classmethod
+    def from_snapshot(cls, snapshot_filename, id_allocator=None, memory_budget=None):
+        """Load the data from a columnar snapshot (see write_snapshot) instead of parsing the DP report again"""
+        dp = cls(None, id_allocator, memory_budget)
+        with ColumnarSnapshot(snapshot_filename) as snapshot:
+            for donorrecord in snapshot.records(TABLE_DONORS):
+                dp.add_donor(donorrecord)
+                dp.__unmodified_donorrecords[donorrecord['DONOR_ID']] = donorrecord.copy()
+            for row_number, studentrecord in enumerate(snapshot.records(TABLE_STUDENTS), 1):
+                if memory_budget is not None and row_number % CHECK_EVERY_ROWS == 0:
+                    memory_budget.check(dp)
+                dp.add_student(studentrecord)
+                dp.__unmodified_studentrecords[studentrecord['OTHER_ID']] = studentrecord.copy()
+        print("    %s: Number of snapshot donors/students read = %d/%d" %
+              (snapshot_filename, len(dp.__donorrecords), len(dp.__studentrecords)))
+        return dp
+
+    def write_snapshot(self, snapshot_filename):
+        """Write the donors and students as a columnar snapshot, which DPData.from_snapshot and other tools
+        (through columnar_snapshot.ColumnarSnapshot) can read without parsing the DP report. Meant to be called
+        right after loading, as the snapshot has no unmodified records of its own."""
+        columnar_snapshot.write_snapshot(snapshot_filename, self.get_donors(), self.get_students())
+
+    def copy(self):
+        """Return an independent copy of this data, e.g. to run several imports against one loaded report.
+
+        Much cheaper than copy.deepcopy (or parsing the report again): the records hold only strings and ints,
+        so copying each record dict is enough. The unmodified records are never changed once loaded, so the
+        copy shares them (spilled ones get their own file).
+        """
+        dp = DPData(None, copy.deepcopy(self.__id_allocator))
+        dp.__donorrecords = OrderedDict((donor_id, dict(record)) for donor_id, record in self.__donorrecords.items())
+        dp.__studentrecords = OrderedDict((other_id, dict(record)) for other_id, record in self.__studentrecords.items())
+        for attribute in ('_DPData__unmodified_donorrecords', '_DPData__unmodified_studentrecords'):
+            records = self.__dict__[attribute]
+            dp.__dict__[attribute] = records.copy() if isinstance(records, OrderedDict) else copy.deepcopy(records)
+        dp.__donor_id_to_other_ids = self.__copy_index(self.__donor_id_to_other_ids)
+        dp.__stu_number_to_other_ids = self.__copy_index(self.__stu_number_to_other_ids)
+        if self.__phonetic_name_to_donor_ids is not None:
+            dp.__phonetic_name_to_donor_ids = self.__copy_index(self.__phonetic_name_to_donor_ids)
+        return dp
+
+    @staticmethod
+    def __copy_index(index):
+        return defaultdict(list, ((key, list(ids)) for key, ids in index.items()))
+
+    def spill_unmodified_records(self, memory_budget):
+        """Move the unmodified records to disk (see memory_budget.SpilledRecords), and keep the ones loaded after this there"""
+        for attribute, name in [('_DPData__unmodified_donorrecords', 'unmodified-donors'),
+                                ('_DPData__unmodified_studentrecords', 'unmodified-students')]:
+            records = self.__dict__[attribute]
+            if isinstance(records, OrderedDict):
+                spilled_records = memory_budget.spilled_records(name)
+                # Oldest first, freeing each record as it goes
+                while records:
+                    record_id, record = records.popitem(last=False)
+                    spilled_records[record_id] = record
+                self.__dict__[attribute] = spilled_records
+
+    def __getstate__(self):
+        # Snapshots belong to the readers of this object, not to its copies (and a lock can't be pickled)
+        state = self.__dict__.copy()
+        state['_DPData__snapshot'] = None
+        del state['_DPData__publish_lock']
+        # Only used while loading. Spilled unmodified records stay on disk in copies and checkpoints (see
+        # memory_budget.SpilledRecords).
+        state['_DPData__memory_budget'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__memory_budget = None
+        self.__dict__.update(state)
+        self.__publish_lock = threading.Lock()
+
+    def publish(self):
+        """Publish the current state as a new DPSnapshot for readers, and return it.
+
+        Must be called from the thread changing the data (e.g. between import stages). Readers holding an older
+        snapshot keep seeing that one; snapshot() returns the new one from now on.
+        """
+        with self.__publish_lock:
+            previous = self.__snapshot or DPSnapshot(0, dict(), dict(), dict(), dict())
+            snapshot = previous.updated(self.__donorrecords, self.__studentrecords,
+                                        self.__donor_id_to_other_ids, self.__stu_number_to_other_ids)
+            # A single attribute assignment, so readers see either the old or the new snapshot
+            self.__snapshot = snapshot
+        return snapshot
+
+    def snapshot(self):
+        """The latest published DPSnapshot (publishing the first one if there is none yet)"""
+        return self.__snapshot or self.publish()
+
+    def has_snapshot(self):
+        return self.__snapshot is not None
 
     def gen_donor_id(self):
-        return str(-1 * self.__next_seq_value('DONOR_ID'))
+        return str(-1 * self.__id_allocator.next_value('DONOR_ID'))
 
     def gen_other_id(self):
-        return str(-1 * self.__next_seq_value('OTHER_ID'))
+        return str(-1 * self.__id_allocator.next_value('OTHER_ID'))
+
+    def renumber_generated_ids(self):
+        """Renumber the generated (negative) DONOR_IDs and OTHER_IDs to -1, -2, ... in record order.
+
+        When several threads created records, their IDs come from whichever blocks they reserved;
+        after merging the records in a deterministic order this makes the IDs deterministic too.
+        Any donor ids held outside this object (e.g. a match key index) are stale afterwards.
+        """
+        donor_id_map = self.__renumber(self.__donorrecords, 'DONOR_ID')
+        other_id_map = self.__renumber(self.__studentrecords, 'OTHER_ID')
+        for studentrecord in self.__studentrecords.values():
+            studentrecord['DONOR_ID'] = donor_id_map.get(studentrecord['DONOR_ID'], studentrecord['DONOR_ID'])
+        self.__donor_id_to_other_ids = defaultdict(list)
+        self.__stu_number_to_other_ids = defaultdict(list)
+        for other_id, studentrecord in self.__studentrecords.items():
+            self.__donor_id_to_other_ids[studentrecord['DONOR_ID']].append(other_id)
+            if studentrecord['STU_NUMBER']:
+                self.__stu_number_to_other_ids[studentrecord['STU_NUMBER']].append(other_id)
+        if self.__phonetic_name_to_donor_ids is not None:
+            self.__build_phonetic_index()
+        return donor_id_map, other_id_map
+
+    def __renumber(self, records, id_field):
+        """Renumber the negative ids of records (an OrderedDict keyed by id_field) in place, returning old -> new"""
+        id_map = dict()
+        renumbered = OrderedDict()
+        for record_id, record in records.items():
+            if int(record_id) < 0:
+                id_map[record_id] = record_id = record[id_field] = str(-1 - len(id_map))
+            renumbered[record_id] = record
+        records.clear()
+        records.update(renumbered)
+        self.__id_allocator.reset(id_field, len(id_map))
+        return id_map
 
     def add_donor(self, donorrecord):
         if 'DONOR_ID' not in donorrecord:
@@ -104,10 +446,47 @@ class DPData:
         if donor_id in self.__donorrecords:
             raise ValueError("DONOR_ID %s already present" % donor_id)
         self.__donorrecords[donor_id] = donorrecord
+        if self.__phonetic_name_to_donor_ids is not None:
+            self.__index_donor_names(donorrecord)
+
+    @staticmethod
+    def phonetic_name_key(last_name, first_name):
+        return utils.soundex(last_name or ''), utils.soundex(first_name or '')
+
+    def __build_phonetic_index(self):
+        self.__phonetic_name_to_donor_ids = defaultdict(list)
+        for donorrecord in self.__donorrecords.values():
+            self.__index_donor_names(donorrecord)
+
+    def __index_donor_names(self, donorrecord):
+        for last_name_field, first_name_field in self.__DONOR_NAME_FIELDS:
+            if donorrecord.get(last_name_field):
+                donor_ids = self.__phonetic_name_to_donor_ids[
+                    self.phonetic_name_key(donorrecord[last_name_field], donorrecord.get(first_name_field))]
+                if donorrecord['DONOR_ID'] not in donor_ids:
+                    donor_ids.append(donorrecord['DONOR_ID'])
+
+    def find_phonetic_matches(self, last_name, first_name):
+        """Donors with a donor or spouse whose name sounds like this one (same Soundex codes), e.g. Jon/John Schmitt
+        for John Schmidt. The names are indexed on the first call (and when a donor is added after that); the
+        matches are checked against the donors' current names."""
+        if self.__phonetic_name_to_donor_ids is None:
+            self.__build_phonetic_index()
+        key = self.phonetic_name_key(last_name, first_name)
+        matches = []
+        for donor_id in self.__phonetic_name_to_donor_ids.get(key, ()):
+            donorrecord = self.__donorrecords[donor_id]
+            if any(self.phonetic_name_key(donorrecord.get(last_name_field), donorrecord.get(first_name_field)) == key
+                   for last_name_field, first_name_field in self.__DONOR_NAME_FIELDS):
+                matches.append(donorrecord)
+        return matches
 
     def get_donor(self, donor_id):
         return self.__donorrecords[donor_id]
 
+    def has_donor(self, donor_id):
+        return donor_id in self.__donorrecords
+
     def get_donors(self):
         return self.__donorrecords.values()
 
@@ -147,175 +526,79 @@ class DPData:
         return res
 
     def scrub_data(self, new_year):
-        self.__fixup_nomail_flag()
-        self.__copy_spouse_email()
-        self.__set_home_school(new_year)
-
-    def calculate_homeschool(self, student_list):
-        '''given a list of students for the donor, calculate their homeschool.
-        Return the elementary school for all students unless all are in BIS.
-        If more than one elementary school, return 'multiple'.
-        '''
-        current_school = ''
-        bis=False
-        for student in student_list:
-            if student['SCHOOL']  in ['FRANKLIN', 'HOOVER', 'LINCOLN','MCKINLEY','ROOSEVELT', 'WASHINGTON']:                
-                if current_school and not current_school == student['SCHOOL']:
-                    current_school = 'multiple'
-                else:
-                    current_school=student['SCHOOL']
-            elif student['SCHOOL'] == 'BIS':
-                bis=True
-        if current_school == 'multiple':
-            return 'multiple'
-        if not current_school:
-            return 'BIS' if bis else ""
-        return DP_SCHOOL_TO_HOMESCHOOL[current_school]
-
-    def __fixup_nomail_flag(self):
-        # Fix up NOMAIL stuff
         for dp_donorrecord in self.get_donors():
-            donor_id = dp_donorrecord['DONOR_ID']
-            dp_studentrecords = self.get_students_for_donor(donor_id)
-
-            student_count_district = 0
-            student_count_nobsd = 0
-            student_count_converted_to_nobsd = 0
-
+            dp_studentrecords = self.get_students_for_donor(dp_donorrecord['DONOR_ID'])
+            unmodified_schools = dict()
             for dp_studentrecord in dp_studentrecords:
-                if dp_studentrecord['SCHOOL'] not in ['ALUM','NOBSD']:
-                    student_count_district += 1
-                elif dp_studentrecord['SCHOOL'] == 'NOBSD':
-                    student_count_nobsd += 1
-                    try:
-                        if self.__unmodified_studentrecords[dp_studentrecord['OTHER_ID']]['SCHOOL'] != 'NOBSD':
-                            student_count_converted_to_nobsd += 1
-                    except KeyError:
-                        pass
-
-            if dp_donorrecord['NOMAIL'] == 'N' and student_count_district == 0:
-                # Donor has no current students...
-                # If all students are NOBSD, then they get flipped to NO
-                # Or if they removed kids from the district, then they get flipped to NO
-                # The other case here is various combinations of ALUM students
-                if student_count_nobsd == len(dp_studentrecords) or student_count_converted_to_nobsd > 0:
-                    dp_donorrecord['NOMAIL'] = 'Y'
-                    dp_donorrecord['NOMAIL_REASON'] = 'NO'
-                    dp_donorrecord['DONOR_TYPE'] = 'NO'
-            elif dp_donorrecord['NOMAIL'] == 'Y' and dp_donorrecord['NOMAIL_REASON'] == 'NO' and student_count_district > 0:
-                # They have kids in the district, so we need to unset NOMAIL
-                dp_donorrecord['NOMAIL'] = 'N'
-                dp_donorrecord['NOMAIL_REASON'] = 'NU' # Signifies null (cannot set to actual null on import)
-                dp_donorrecord['DONOR_TYPE'] = 'IN'
-
-            #anyone with student in district SHOULD be set with Donortype=IN
-            if student_count_district and not dp_donorrecord['DONOR_TYPE'] == 'IN':
-                dp_donorrecord['DONOR_TYPE']='IN'
-            # Legacy data cleanup
-            if dp_donorrecord['NOMAIL'] == 'N' and dp_donorrecord['NOMAIL_REASON'] not in ['','NU']:
-                # Empty out NOMAIL_REASON if NOMAIL not set
-                dp_donorrecord['NOMAIL_REASON'] = 'NU'
-
-    def __copy_spouse_email(self):
-        # we need to have email field populated even if the district has no parent1 email
-        for dp_donorrecord in self.get_donors():
-            if dp_donorrecord['SPOUSE_EMAIL'] and not dp_donorrecord['EMAIL']:
-                dp_donorrecord['EMAIL'] = dp_donorrecord['SPOUSE_EMAIL']
+                other_id = dp_studentrecord['OTHER_ID']
+                if int(other_id) >= 0:
+                    unmodified_schools[other_id] = self.__unmodified_studentrecords[other_id]['SCHOOL']
+            scrub_donorrecord(dp_donorrecord, dp_studentrecords, unmodified_schools, new_year)
 
-    def __set_home_school(self, new_year):
-        '''set the HOME_SCHOOL field to the correct elementary school or BIS as appropriate
-        If they are no longer in BSD, set it to empty.  Also set Former_ELEMENTARY_SCHOOL.
-        '''
-        for dp_donorrecord in self.get_donors():
-            #if the donor is no longer in BSD, donor_type=NO, set HOME_SCHOOL to empty
-            # and set the former_elem_school if the home_school was an elementary school
-            # note that former_elem_school does not need to be reset if it's already set.
-            # DP does not allow you to 'unset' a field (ie set it to empty string) during file import.
-            # so the only way to 'unset' the HOME_SCHOOL field is to set to to something and use
-            # global update in DP to set it to "".  So we'll use "EMPTY" as the code to indicate to unset the field.
-            old_homeschool = dp_donorrecord['HOME_SCHOOL']
-            if old_homeschool == 'NULL':  #fix problem with DP data sending us NULL.
-                old_homeschool = ''
-            if dp_donorrecord['DONOR_TYPE'] == 'NO':
-                #if former elemen school is not set, move the existing home_school if that's elementary.
-                if not dp_donorrecord['FORMER_ELEM_SCHOOL'] and dp_donorrecord['HOME_SCHOOL'] in ('FRA','LIN','MCK','HOO','ROOS','WAS'):
-                    dp_donorrecord['FORMER_ELEM_SCHOOL'] = dp_donorrecord['HOME_SCHOOL']
-                if old_homeschool:  #if it's set to something indicate that it should be unset
-                    dp_donorrecord['HOME_SCHOOL'] = 'EMPTY'
-            else:
-                all_students = self.get_students_for_donor(dp_donorrecord['DONOR_ID'])
-                new_homeschool = self.calculate_homeschool(all_students)
-                if new_homeschool == 'multiple':
-                    if new_year:
-                        #when new year, reset home_school to empty if we get multiple returns.
-                        if old_homeschool:  #only if it's not empty -- set it to empty
-                            dp_donorrecord['HOME_SCHOOL'] = 'EMPTY'
-
-                    #otherwise, leave it as-is.  If it's already set, we will use that for the rest of the year
-                    # if it's not already set, we can't set it anyway.
-                elif new_homeschool:
-                    dp_donorrecord['HOME_SCHOOL'] = new_homeschool
-                elif old_homeschool:  #if there was something there, reset to EMPTY
-                    dp_donorrecord['HOME_SCHOOL'] = 'EMPTY'
+    def calculate_homeschool(self, student_list):
+        return calculate_homeschool(student_list)
 
-                #try to set the former_elementary _school if not already set.
-                if not dp_donorrecord['FORMER_ELEM_SCHOOL'] and new_homeschool == 'BIS':
-                    if old_homeschool in ('FRA','LIN','MCK','HOO','ROOS','WAS'):
-                        dp_donorrecord['FORMER_ELEM_SCHOOL'] = old_homeschool 
+    # The output rows are streamed to the files as they are built, so they never all have to be in memory
 
-    def write_updated_students_file(self, csv_filename):
-        data = list()
-        headers = utils.list_with_mods(DP_REPORT_271_STUDENT_HEADERS, add=['_MODIFIED_FIELDS'])
+    def __updated_student_rows(self):
+        project = utils.RowProjector(DP_REPORT_271_STUDENT_HEADERS)
+        other_date_index = DP_REPORT_271_STUDENT_HEADERS.index('OTHER_DATE')
         for other_id, studentrecord in self.__studentrecords.items():
-            if int(other_id) >= 0 and studentrecord != self.__unmodified_studentrecords[other_id]:
-                row = utils.dict_filtered_copy(studentrecord, headers)
-                row['_MODIFIED_FIELDS'] = '|'.join(self.__get_modified_fields(studentrecord))
+            if int(other_id) < 0:
+                continue
+            # Looked up once, as it may have to be read back from disk (see memory_budget)
+            unmodified_studentrecord = self.__unmodified_studentrecords[other_id]
+            if studentrecord != unmodified_studentrecord:
+                row = project(studentrecord) + ('|'.join(utils.modified_fields(unmodified_studentrecord, studentrecord)),)
                 # Add OTHER_DATE if missing as the import doesn't seem to like having an empty one
-                if not row['OTHER_DATE']:
-                    row['OTHER_DATE'] = utils.TODAY_STR
-                data.append(row)
-        utils.save_as_csv_file(csv_filename, headers, data)
+                if not row[other_date_index]:
+                    row = row[:other_date_index] + (utils.TODAY_STR,) + row[other_date_index + 1:]
+                yield row
 
-    def write_new_students_for_existing_donors_file(self, csv_filename):
-        data = list()
-        headers = utils.list_with_mods(DP_REPORT_271_STUDENT_HEADERS, remove=['OTHER_ID'])
+    def write_updated_students_file(self, csv_filename, chunked_output=None):
+        headers = utils.list_with_mods(DP_REPORT_271_STUDENT_HEADERS, add=['_MODIFIED_FIELDS'])
+        return utils.save_as_csv_rows(csv_filename, headers, self.__updated_student_rows(), chunked_output)
+
+    def __new_student_rows(self, headers):
+        project = utils.RowProjector(headers)
         for other_id, studentrecord in self.__studentrecords.items():
             if int(other_id) < 0 and int(studentrecord['DONOR_ID']) >= 0:
-                row = utils.dict_filtered_copy(studentrecord, headers)
-                data.append(row)
-        utils.save_as_csv_file(csv_filename, headers, data)
+                yield project(studentrecord)
 
-    def write_new_students_for_new_donors_file(self, csv_filename):
-        data = list()
-        headers = utils.list_with_mods(DP_REPORT_271_HEADERS, remove=['DONOR_ID', 'OTHER_ID', 'ADVISORY_MEMBER_MULTICODE', 'SP_ADVISOR_MEMBER_MULTICODE', 'DONOR_EMPLOYER', 'SP_EMPLOYER'])
+    def write_new_students_for_existing_donors_file(self, csv_filename, chunked_output=None):
+        headers = utils.list_with_mods(DP_REPORT_271_STUDENT_HEADERS, remove=['OTHER_ID'])
+        return utils.save_as_csv_rows(csv_filename, headers, self.__new_student_rows(headers), chunked_output)
+
+    def __new_donor_rows(self, headers):
+        # Combine donor and student fields into a single row: project each record onto its own fields, then put
+        # the values in header order
+        student_fields = [field for field in headers if field in DP_REPORT_271_STUDENT_HEADERS]
+        donor_fields = [field for field in headers if field not in DP_REPORT_271_STUDENT_HEADERS]
+        project_student = utils.RowProjector(student_fields)
+        project_donor = utils.RowProjector(donor_fields)
+        to_header_order = utils.RowProjector([(student_fields + donor_fields).index(field) for field in headers])
         for other_id, studentrecord in self.__studentrecords.items():
             if int(other_id) < 0 and int(studentrecord['DONOR_ID']) < 0:
-                # Combine donor and student fields into a single row
-                row = utils.dict_filtered_copy(studentrecord, headers)
-                row.update(utils.dict_filtered_copy(self.get_donor(studentrecord['DONOR_ID']), headers))
-                data.append(row)
-        utils.save_as_csv_file(csv_filename, headers, data)
-
-    def write_updated_donors_file(self, csv_filename):
-        data = []
-        headers = utils.list_with_mods(DP_REPORT_271_DONOR_HEADERS, add=['_MODIFIED_FIELDS'], remove=['ADVISORY_MEMBER_MULTICODE', 'SP_ADVISOR_MEMBER_MULTICODE'])
+                yield to_header_order(project_student(studentrecord) + project_donor(self.get_donor(studentrecord['DONOR_ID'])))
+
+    def write_new_students_for_new_donors_file(self, csv_filename, chunked_output=None):
+        headers = utils.list_with_mods(DP_REPORT_271_HEADERS, remove=['DONOR_ID', 'OTHER_ID', 'ADVISORY_MEMBER_MULTICODE', 'SP_ADVISOR_MEMBER_MULTICODE', 'DONOR_EMPLOYER', 'SP_EMPLOYER'])
+        return utils.save_as_csv_rows(csv_filename, headers, self.__new_donor_rows(headers), chunked_output)
+
+    def __updated_donor_rows(self):
+        project = utils.RowProjector(DP_DONOR_UPDATE_HEADERS[:-1])
         for donor_id, donorrecord in self.__donorrecords.items():
-            if int(donor_id) >= 0 and donorrecord != self.__unmodified_donorrecords[donor_id]:
-                row = utils.dict_filtered_copy(donorrecord, headers)
-                row['_MODIFIED_FIELDS'] = '|'.join(self.__get_modified_fields(donorrecord))
-                data.append(row)
-        utils.save_as_csv_file(csv_filename, headers, data)
-
-    def __get_modified_fields(self, donor_or_student):
-        if 'OTHER_ID' in donor_or_student.keys():
-            return utils.modified_fields(self.__unmodified_studentrecords[donor_or_student['OTHER_ID']], donor_or_student)
-        else:
-            return utils.modified_fields(self.__unmodified_donorrecords[donor_or_student['DONOR_ID']], donor_or_student)
+            if int(donor_id) < 0:
+                continue
+            unmodified_donorrecord = self.__unmodified_donorrecords[donor_id]
+            if donorrecord != unmodified_donorrecord:
+                yield project(donorrecord) + ('|'.join(utils.modified_fields(unmodified_donorrecord, donorrecord)),)
+
+    def write_updated_donors_file(self, csv_filename, chunked_output=None):
+        return utils.save_as_csv_rows(csv_filename, DP_DONOR_UPDATE_HEADERS, self.__updated_donor_rows(), chunked_output)
 
     def compute_match_key(self, donorrecord):
         """Returns a string representing the concatenation of all the match key values, trimmed/padded to size"""
-        key = ''
-        for field, chars_to_compare in self.__DONOR_MATCH_FIELDS.items():
-            #remove space and - from the string.
-            key += donorrecord.get(field).translate({ord(' '):None, ord('-'): None})[:chars_to_compare].upper().ljust(chars_to_compare)
-        return key
+        #remove space and - from the string.
+        return ''.join(utils.normalize_key_part(donorrecord.get(field), chars_to_compare)
+                       for field, chars_to_compare in self.__DONOR_MATCH_FIELDS.items())
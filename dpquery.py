@@ -0,0 +1,215 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+import argparse
+
+from dpdata import DPData, DP_REPORT_271_DONOR_HEADERS, DP_REPORT_271_STUDENT_HEADERS
+import utils
+
+
+# Columns compared as numbers in range queries (GRADE holds e.g. '-2', '8' or 'ALUM'; values that aren't numbers are left out)
+NUMERIC_FIELDS = ('GRADE', 'YEARTO', 'STU_NUMBER', 'DONOR_ID', 'OTHER_ID')
+
+
+def _range_key(field, value):
+    if field in NUMERIC_FIELDS:
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+    return value
+
+
+def _value_key(field, value):
+    """The key a value is indexed under for equality queries: numeric fields hold both strings and ints
+    (DPData turns YEARTO into an int, the import sets some GRADEs to 0), so '2019' and 2019 are the same"""
+    key = _range_key(field, value)
+    return value if key is None else key
+
+
+FIELDS = {'donor': DP_REPORT_271_DONOR_HEADERS, 'student': DP_REPORT_271_STUDENT_HEADERS}
+
+
+def _check_field(kind, field):
+    if field not in FIELDS[kind]:
+        raise ValueError("Unknown %s field %s, expected one of: %s" % (kind, field, ', '.join(FIELDS[kind])))
+
+
+class DPQuery:
+    """Indexed queries over a DPSnapshot, for reports.
+
+    A column's index is built the first time the column is queried and kept, which is safe because the snapshot
+    never changes. Concurrent readers may race to build the same index; both results are identical and the
+    last one wins, so no locking is needed.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.__donor_indexes = dict()
+        self.__student_indexes = dict()
+        self.__range_indexes = dict()
+
+    def __value_index(self, kind, indexes, records, field):
+        index = indexes.get(field)
+        if index is None:
+            _check_field(kind, field)
+            index = defaultdict(list)
+            for record in records():
+                # Records the import created don't have every field (new students have no YEARTO): same as empty
+                index[_value_key(field, record.get(field, ''))].append(record)
+            index = dict(index)
+            indexes[field] = index
+        return index
+
+    def __donor_index(self, field):
+        return self.__value_index('donor', self.__donor_indexes, self.snapshot.get_donors, field)
+
+    def __student_index(self, field):
+        return self.__value_index('student', self.__student_indexes, self.snapshot.get_students, field)
+
+    def __range_index(self, kind, field):
+        """(sorted keys, records in the same order) for a range query on field"""
+        range_index = self.__range_indexes.get((kind, field))
+        if range_index is None:
+            _check_field(kind, field)
+            records = self.snapshot.get_donors() if kind == 'donor' else self.snapshot.get_students()
+            # Missing and empty values are in no range
+            keyed = [(key, record) for key, record in ((_range_key(field, record.get(field)), record) for record in records)
+                     if key is not None and key != '']
+            keyed.sort(key=lambda key_record: key_record[0])
+            range_index = ([key for key, _ in keyed], [record for _, record in keyed])
+            self.__range_indexes[(kind, field)] = range_index
+        return range_index
+
+    def __where(self, index_for_field, conditions):
+        """Records matching all field=value conditions, probing the smallest index bucket first"""
+        buckets = sorted((index_for_field(field).get(_value_key(field, value), ()) for field, value in conditions.items()), key=len)
+        if not buckets:
+            raise ValueError("At least one condition is required")
+        result = buckets[0]
+        for bucket in buckets[1:]:
+            bucket_ids = set(map(id, bucket))
+            result = [record for record in result if id(record) in bucket_ids]
+        return list(result)
+
+    def donors_where(self, **conditions):
+        """Donors whose fields equal all the given values, e.g. donors_where(HOME_SCHOOL='HOO', NOMAIL='N')"""
+        return self.__where(self.__donor_index, conditions)
+
+    def students_where(self, **conditions):
+        """Students whose fields equal all the given values, e.g. students_where(SCHOOL='BIS', GRADE='8')"""
+        return self.__where(self.__student_index, conditions)
+
+    @staticmethod
+    def __bound_key(field, bound):
+        key = _range_key(field, bound)
+        if key is None or (field not in NUMERIC_FIELDS and not isinstance(key, str)):
+            raise ValueError("Invalid bound %r for %s, expected %s" % (bound, field, 'a number' if field in NUMERIC_FIELDS else 'a string'))
+        return key
+
+    def __between(self, kind, field, low, high):
+        keys, records = self.__range_index(kind, field)
+        start = 0 if low is None else bisect_left(keys, self.__bound_key(field, low))
+        end = len(keys) if high is None else bisect_right(keys, self.__bound_key(field, high))
+        return records[start:end]
+
+    def donors_between(self, field, low=None, high=None):
+        """Donors with low <= field <= high (either bound may be None)"""
+        return self.__between('donor', field, low, high)
+
+    def students_between(self, field, low=None, high=None):
+        """Students with low <= field <= high (either bound may be None), e.g. students_between('GRADE', 0, 5)"""
+        return self.__between('student', field, low, high)
+
+    def count_donors_where(self, field, value):
+        return len(self.__donor_index(field).get(_value_key(field, value), ()))
+
+    def count_students_where(self, field, value):
+        return len(self.__student_index(field).get(_value_key(field, value), ()))
+
+    def donor_value_counts(self, field):
+        return dict((value, len(records)) for value, records in self.__donor_index(field).items())
+
+    def student_value_counts(self, field):
+        return dict((value, len(records)) for value, records in self.__student_index(field).items())
+
+    def donors_of(self, studentrecords):
+        """The donors of the given students, each once, in student order"""
+        donor_ids = list(dict.fromkeys(studentrecord['DONOR_ID'] for studentrecord in studentrecords))
+        return [self.snapshot.get_donor(donor_id) for donor_id in donor_ids if self.snapshot.has_donor(donor_id)]
+
+    def students_of(self, donorrecords):
+        """The students of the given donors"""
+        return [studentrecord for donorrecord in donorrecords
+                for studentrecord in self.snapshot.get_students_for_donor(donorrecord['DONOR_ID'])]
+
+    def donors_with_students_where(self, **conditions):
+        """Join: the donors that have a student matching the conditions"""
+        return self.donors_of(self.students_where(**conditions))
+
+
+def parse_conditions(conditions):
+    """FIELD=VALUE strings from the command line as a dict"""
+    parsed = dict()
+    for condition in conditions or ():
+        field, sep, value = condition.partition('=')
+        if not sep:
+            raise ValueError("Conditions look like FIELD=VALUE, not %s" % condition)
+        parsed[field.upper()] = value
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the donors and students in a DP report")
+    dp_input = parser.add_mutually_exclusive_group(required=True)
+    dp_input.add_argument("--dp-report",
+                          help="csv output from DP: Reports -> Report Center -> 271 Name Contacts Other -> Include \"NO MAIL\" Names -> run report -> export as .csv")
+    dp_input.add_argument("--dp-snapshot", help="columnar snapshot of the DP report written by district_data_import.py --snapshot-out "
+                                                "(faster to load than the csv)")
+    parser.add_argument("--donors", help="report donors matching FIELD=VALUE conditions", nargs='+', metavar='FIELD=VALUE')
+    parser.add_argument("--students", help="report students matching FIELD=VALUE conditions", nargs='+', metavar='FIELD=VALUE')
+    parser.add_argument("--donors-with-students", help="report donors with a student matching FIELD=VALUE conditions",
+                        nargs='+', metavar='FIELD=VALUE')
+    parser.add_argument("--group-by", help="instead of listing records, count them per value of this field")
+    parser.add_argument("--count", help="only print the number of matching records", action='store_true')
+    parser.add_argument("--output", help="csv file to write the matching records to")
+    args = parser.parse_args()
+
+    print("Input files:")
+    dp = DPData.from_snapshot(args.dp_snapshot) if args.dp_snapshot else DPData(args.dp_report)
+    query = dp.snapshot().query()
+    print()
+    try:
+        if args.students:
+            records, headers = query.students_where(**parse_conditions(args.students)), DP_REPORT_271_STUDENT_HEADERS
+        elif args.donors_with_students:
+            records, headers = query.donors_with_students_where(**parse_conditions(args.donors_with_students)), DP_REPORT_271_DONOR_HEADERS
+        elif args.donors:
+            records, headers = query.donors_where(**parse_conditions(args.donors)), DP_REPORT_271_DONOR_HEADERS
+        elif args.group_by:
+            # No conditions: count over all students (or donors, for donor-only fields)
+            value_counts = (query.student_value_counts if args.group_by in DP_REPORT_271_STUDENT_HEADERS else query.donor_value_counts)(args.group_by)
+            for value, count in sorted(value_counts.items(), key=lambda value_count: str(value_count[0])):
+                print("%s: %d" % (value, count))
+            return
+        else:
+            parser.error("one of --donors, --students, --donors-with-students or --group-by is required")
+        if args.group_by and args.group_by not in headers:
+            raise ValueError("Cannot group these records by %s, expected one of: %s" % (args.group_by, ', '.join(headers)))
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.group_by:
+        value_counts = defaultdict(int)
+        for record in records:
+            value_counts[record.get(args.group_by, '')] += 1
+        for value, count in sorted(value_counts.items(), key=lambda value_count: str(value_count[0])):
+            print("%s: %d" % (value, count))
+    elif args.count or not args.output:
+        print("Matching records: %d" % len(records))
+    if args.output:
+        print("Output files:")
+        utils.save_as_csv_file(args.output, headers, [dict(record) for record in records])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+from collections import defaultdict
+import argparse
+
+from dpdata import DPData
+import utils
+
+
+# Blocking keys, with how much sharing one says about two donors being the same people
+BLOCKING_KEY_WEIGHTS = {'match-key': 3, 'email': 3, 'phone': 2, 'address': 1}
+# Values shared by more donors than this are placeholders (e.g. a school office phone), not evidence
+DEFAULT_MAX_BLOCK_SIZE = 20
+# Phone numbers are compared on their last 10 digits, and ignored if they have fewer than this
+MIN_PHONE_DIGITS = 7
+
+DUPLICATE_REPORT_HEADERS = ['CLUSTER', 'SCORE', 'EVIDENCE', 'DONOR_ID', 'FIRST_NAME', 'LAST_NAME', 'SP_FNAME', 'SP_LNAME',
+                            'ADDRESS', 'CITY', 'ZIP', 'EMAIL', 'SPOUSE_EMAIL', 'MOBILE_PHONE', 'SPOUSE_MOBILE', 'HOME_PHONE',
+                            'STUDENTS']
+
+
+class UnionFind:
+    """Disjoint sets of ids, with path halving and union by size"""
+
+    def __init__(self):
+        self.parent = dict()
+        self.size = dict()
+
+    def find(self, item):
+        parent = self.parent.setdefault(item, item)
+        if parent == item:
+            self.size.setdefault(item, 1)
+            return item
+        while self.parent[item] != item:
+            self.parent[item] = self.parent[self.parent[item]]
+            item = self.parent[item]
+        return item
+
+    def union(self, item1, item2):
+        root1 = self.find(item1)
+        root2 = self.find(item2)
+        if root1 == root2:
+            return root1
+        if self.size[root1] < self.size[root2]:
+            root1, root2 = root2, root1
+        self.parent[root2] = root1
+        self.size[root1] += self.size.pop(root2)
+        return root1
+
+
+def normalize_phone(phone):
+    digits = ''.join(c for c in phone if c.isdigit())
+    return digits[-10:] if len(digits) >= MIN_PHONE_DIGITS else ''
+
+
+def blocking_keys(dp, dp_donorrecord):
+    """(kind, value) keys of a donor; donors sharing any of them are compared"""
+    keys = [('match-key', dp.compute_match_key(dp_donorrecord))]
+    for field in ('EMAIL', 'SPOUSE_EMAIL'):
+        email = utils.normalize_email(dp_donorrecord[field])
+        if email:
+            keys.append(('email', email))
+    for field in ('MOBILE_PHONE', 'SPOUSE_MOBILE', 'HOME_PHONE'):
+        phone = normalize_phone(dp_donorrecord[field])
+        if phone:
+            keys.append(('phone', phone))
+    if dp_donorrecord['ADDRESS'].strip():
+        # Only the same family at the same address: apartment buildings share the address key
+        keys.append(('address', utils.address_key(dp_donorrecord['ADDRESS'], dp_donorrecord['ZIP']) +
+                     utils.soundex(dp_donorrecord['LAST_NAME'])))
+    return keys
+
+
+def find_duplicate_clusters(dp, max_block_size=DEFAULT_MAX_BLOCK_SIZE):
+    """Clusters of donors that share a blocking key, directly or through other donors in the cluster.
+
+    Each donor is only compared through its few blocking keys, so this is linear in the number of donors
+    (rather than comparing all pairs). Returns (clusters, skipped blocks), where clusters are
+    (score, donor ids, {kind: shared values}) with the most likely duplicates first, and skipped blocks are
+    (kind, value, donor count) for values shared by more than max_block_size donors. The score is the weight of
+    the shared keys per donor joined, so donors chained together through single shared values rank low.
+    """
+    blocks = defaultdict(list)
+    for dp_donorrecord in dp.get_donors():
+        donor_id = dp_donorrecord['DONOR_ID']
+        for key in blocking_keys(dp, dp_donorrecord):
+            donor_ids = blocks[key]
+            # The donor and spouse can share an email or phone
+            if not donor_ids or donor_ids[-1] != donor_id:
+                donor_ids.append(donor_id)
+
+    union_find = UnionFind()
+    shared_keys = []
+    skipped_blocks = []
+    for (kind, value), donor_ids in blocks.items():
+        if len(donor_ids) < 2:
+            continue
+        if len(donor_ids) > max_block_size:
+            skipped_blocks.append((kind, value, len(donor_ids)))
+            continue
+        for donor_id in donor_ids[1:]:
+            union_find.union(donor_ids[0], donor_id)
+        shared_keys.append((donor_ids[0], kind, value))
+
+    donor_ids_by_root = defaultdict(list)
+    for dp_donorrecord in dp.get_donors():
+        donor_id = dp_donorrecord['DONOR_ID']
+        if donor_id in union_find.parent:
+            donor_ids_by_root[union_find.find(donor_id)].append(donor_id)
+    evidence_by_root = defaultdict(lambda: defaultdict(list))
+    for donor_id, kind, value in shared_keys:
+        evidence_by_root[union_find.find(donor_id)][kind].append(value)
+
+    clusters = []
+    for root, donor_ids in donor_ids_by_root.items():
+        evidence = evidence_by_root[root]
+        weight = sum(BLOCKING_KEY_WEIGHTS[kind] * len(values) for kind, values in evidence.items())
+        clusters.append((round(weight / (len(donor_ids) - 1), 2), donor_ids, dict(evidence)))
+    # Strongest evidence first; then the smaller (more specific) clusters
+    clusters.sort(key=lambda cluster: (-cluster[0], len(cluster[1]), cluster[1][0]))
+    return clusters, sorted(skipped_blocks, key=lambda block: -block[2])
+
+
+def cluster_report_rows(dp, clusters):
+    for cluster_number, (score, donor_ids, evidence) in enumerate(clusters, 1):
+        evidence_str = '|'.join('%s:%s' % (kind, value.strip()) for kind, values in sorted(evidence.items()) for value in values)
+        for donor_id in donor_ids:
+            row = utils.dict_filtered_copy(dp.get_donor(donor_id), DUPLICATE_REPORT_HEADERS)
+            row.update({'CLUSTER': cluster_number, 'SCORE': score, 'EVIDENCE': evidence_str,
+                        'STUDENTS': ' '.join('%s %s (%s)' % (studentrecord['STU_FNAME'], studentrecord['STU_LNAME'], studentrecord['SCHOOL'])
+                                             for studentrecord in dp.get_students_for_donor(donor_id))})
+            yield row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find groups of DP donors that are probably the same people")
+    parser.add_argument("--dp-report",
+                        help="csv output from DP: Reports -> Report Center -> 271 Name Contacts Other -> Include \"NO MAIL\" Names -> run report -> export as .csv",
+                        required=True)
+    parser.add_argument("--output", help="csv file for the duplicate clusters, most likely duplicates first", default='duplicate-donors.csv')
+    parser.add_argument("--max-block-size", help="ignore emails, phones and addresses shared by more donors than this",
+                        type=int, default=DEFAULT_MAX_BLOCK_SIZE)
+    args = parser.parse_args()
+
+    print("Input files:")
+    dp = DPData(args.dp_report)
+    clusters, skipped_blocks = find_duplicate_clusters(dp, args.max_block_size)
+
+    for kind, value, donor_count in skipped_blocks:
+        print("Ignored %s %s, shared by %d donors" % (kind, value.strip(), donor_count))
+    print("Found %d cluster(s) of possible duplicates, with %d donors" %
+          (len(clusters), sum(len(donor_ids) for score, donor_ids, evidence in clusters)))
+
+    print()
+    print("Output files:")
+    utils.save_as_csv_file(args.output, DUPLICATE_REPORT_HEADERS, cluster_report_rows(dp, clusters))
+
+
+if __name__ == '__main__':
+    main()
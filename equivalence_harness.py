@@ -0,0 +1,335 @@
+from collections import Counter
+import argparse
+import csv
+import glob
+import itertools
+import os
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from dpdata import DP_REPORT_271_HEADERS
+import district_data_import
+import district_data_utils
+import external_sort
+
+
+# The generated csv files are uploaded in bulk, so their row order doesn't matter (the header order of
+# 04-new-donors.csv isn't even stable between runs). The manual updates are read top to bottom, so they must match exactly.
+CSV_OUTPUT_FILES = [district_data_import.FILENAME_STUDENT_UPDATES, district_data_import.FILENAME_NEWSTUDENT,
+                    district_data_import.FILENAME_DONOR_UPDATES, district_data_import.FILENAME_NEWDONOR]
+TEXT_OUTPUT_FILES = [district_data_import.FILENAME_DONOR_UPDATE_MESSAGES]
+IMPORT_MODES = {'new-year': '--new-year-import', 'mid-year': '--mid-year-update'}
+# Differing rows shown per file
+MAX_REPORTED_ROWS = 5
+
+SYNTHETIC_FIRST_NAMES = ['John', 'Jon', 'Jane', 'Mary', 'Bob', 'Alice', 'Tom', 'Sue', 'Li', 'Wei', 'Ana', 'Jose']
+SYNTHETIC_LAST_NAMES = ['Smith', 'Schmidt', 'Schmitt', 'Lee', 'Garcia', 'Nguyen', 'Brown', 'Jones', 'De-Silva', 'Van Horn']
+SYNTHETIC_STREETS = ['Oak St', 'Pine Ave', 'Elm-Ct', 'Main St', 'Birch Rd', 'Cedar Ln', 'Maple Dr']
+SYNTHETIC_ZIPS = ['94010', '94011', '94010-1234']
+
+
+class Engine:
+    """One way of running the import: a district_data_import.py script plus extra command line arguments"""
+
+    def __init__(self, name, script, args):
+        self.name = name
+        self.script = os.path.abspath(script)
+        self.args = args
+
+    def run(self, dp_report, district_data, import_args, output_dir):
+        """Run the import in output_dir and return the elapsed seconds"""
+        command = [sys.executable, self.script, '--dp-report', os.path.abspath(dp_report),
+                   '--district-data', os.path.abspath(district_data)] + import_args + self.args
+        # The header order of the new donors file follows set iteration order, so fix the hash seed for both
+        env = dict(os.environ, PYTHONHASHSEED='0')
+        start = time.perf_counter()
+        with open(os.path.join(output_dir, 'script_output.txt'), 'w') as outputfile:
+            result = subprocess.run(command, cwd=output_dir, env=env, stdout=outputfile, stderr=subprocess.STDOUT)
+        elapsed = time.perf_counter() - start
+        if result.returncode != 0:
+            raise RuntimeError("%s failed (exit code %d), see %s" %
+                               (self.name, result.returncode, os.path.join(output_dir, 'script_output.txt')))
+        return elapsed
+
+
+def write_synthetic_inputs(directory, seed, family_count):
+    """Write a random but plausible dp.csv and district.csv: existing and new families, siblings, divorced
+    parents with two donor records, swapped contacts, alumni, and stray whitespace in the district data"""
+    rng = random.Random(seed)
+    # All donor ids and student numbers come from one counter, so they can't collide however many families there are
+    ids = itertools.count(10000)
+    families = []
+    for i in range(family_count):
+        last_name = rng.choice(SYNTHETIC_LAST_NAMES)
+        street = '%d %s' % (rng.randint(1, 200), rng.choice(SYNTHETIC_STREETS))
+        first_name_1 = rng.choice(SYNTHETIC_FIRST_NAMES)
+        first_name_2 = rng.choice(SYNTHETIC_FIRST_NAMES)
+        families.append({
+            'first_name_1': first_name_1, 'last_name_1': last_name,
+            'first_name_2': first_name_2, 'last_name_2': last_name if rng.random() < .7 else rng.choice(SYNTHETIC_LAST_NAMES),
+            'street_1': street,
+            'street_2': street if rng.random() < .8 else '%d %s' % (rng.randint(1, 200), rng.choice(SYNTHETIC_STREETS)),
+            'zip': rng.choice(SYNTHETIC_ZIPS),
+            'email_1': '%s%d@example.com' % (first_name_1.lower(), i) if rng.random() < .8 else '',
+            'email_2': '%s%d@example.org' % (first_name_2.lower(), i) if rng.random() < .6 else '',
+            'relationship_2': rng.choice(['Mother', 'Father', 'Stepmother', 'Grandmother']),
+            'students': [(str(next(ids)), rng.choice(SYNTHETIC_FIRST_NAMES), last_name,
+                          rng.choice(['TK', 'K', '1', '2', '3', '4', '5', '6', '7', '8']),
+                          rng.choice(sorted(set(district_data_utils.DISTRICT_SCHOOL_MAPPING) - {'PreSchool'})))
+                         for _ in range(rng.choice([1, 1, 2, 3]))],
+        })
+
+    dp_rows = []
+    other_id = 1
+    for family in families:
+        if rng.random() < .35:
+            # A new family
+            continue
+        nomail = rng.choice(['N', 'N', 'Y'])
+        # The donor record of the other parent, if they turn out to be divorced
+        second_donor_id = None
+        donorrecord = dict((header, '') for header in DP_REPORT_271_HEADERS)
+        donorrecord.update({
+            'DONOR_ID': str(next(ids)),
+            'FIRST_NAME': family['first_name_1'] if rng.random() < .85 else family['first_name_2'],
+            'LAST_NAME': family['last_name_1'], 'SP_FNAME': family['first_name_2'], 'SP_LNAME': family['last_name_2'],
+            'SALUTATION': '%s %s' % (family['first_name_1'], family['last_name_1']),
+            'INFORMAL_SAL': '%s and %s' % (family['first_name_2'], family['first_name_1']),
+            'ADDRESS_TYPE': 'HOME', 'ADDRESS': family['street_1'] if rng.random() < .8 else '1 Old Rd',
+            'CITY': 'Burlingame', 'STATE': 'CA', 'ZIP': family['zip'],
+            'EMAIL': family['email_1'] if rng.random() < .5 else '', 'MOBILE_PHONE': '555-0100',
+            'DONOR_TYPE': rng.choice(['IN', 'NO']), 'NOMAIL': nomail,
+            'NOMAIL_REASON': 'NO' if nomail == 'Y' else rng.choice(['', 'NU', 'XX']),
+            'FY_JOIN_BSD': 'SY2015-16', 'RECEIPT_DELIVERY': 'E', 'HOME_SCHOOL': rng.choice(['', 'LIN', 'BIS', 'NULL']),
+        })
+        students = list(family['students'])
+        if rng.random() < .3:
+            # An older sibling who has already left the elementary schools
+            students.append((str(next(ids)), 'Old', family['last_name_1'], None, None))
+        for stu_number, first_name, last_name, grade, school in students:
+            studentrecord = dict(donorrecord)
+            if grade is None:
+                grade, dp_school = rng.choice(['8', '7', '-1', '']), rng.choice(['ALUM', 'NOBSD', 'BIS', 'LINCOLN'])
+            else:
+                # DP still has last year's grade
+                grade = str(int({'TK': '-2', 'K': '0'}.get(grade, grade)) - 1)
+                dp_school = district_data_utils.district_school_to_dp_school(school)
+            studentrecord.update({'STU_NUMBER': stu_number, 'STU_FNAME': first_name, 'STU_LNAME': last_name,
+                                  'GRADE': grade, 'SCHOOL': dp_school, 'OTHER_ID': str(other_id),
+                                  'YEARTO': rng.choice(['', '2,019.00', '0']), 'PHOTO_OPT_OUT': 'N'})
+            other_id += 1
+            dp_rows.append(studentrecord)
+            if rng.random() < .08:
+                # Divorced parents, each with their own donor record
+                if second_donor_id is None:
+                    second_donor_id = str(next(ids))
+                studentrecord = dict(studentrecord)
+                studentrecord.update({'DONOR_ID': second_donor_id, 'FIRST_NAME': family['first_name_2'],
+                                      'LAST_NAME': family['last_name_2'], 'SP_FNAME': '', 'SP_LNAME': '',
+                                      'OTHER_ID': str(other_id)})
+                other_id += 1
+                dp_rows.append(studentrecord)
+    if dp_rows and not any(row['NOMAIL'] == 'Y' for row in dp_rows):
+        for row in dp_rows:
+            if row['DONOR_ID'] == dp_rows[0]['DONOR_ID']:
+                row['NOMAIL'] = 'Y'
+
+    district_rows = []
+    for family in families:
+        for stu_number, first_name, last_name, grade, school in family['students']:
+            if rng.random() < .1:
+                # Left the district
+                continue
+            row = dict((header, '') for header in district_data_utils.DISTRICT_DATA_HEADERS)
+            row.update({'School': school, 'SystemID': stu_number, 'Student Last Name': last_name + ' ',
+                        'Student First Name': first_name, 'Grade': grade, 'Photo Opt Out': 'N'})
+            contacts = [('1', '2'), ('2', '1')][rng.random() < .15]
+            for contact, parent in zip(contacts, ('1', '2')):
+                prefix = 'Contact %s ' % contact
+                row.update({prefix + 'First Name': family['first_name_' + parent], prefix + 'Last Name': family['last_name_' + parent],
+                            prefix + 'Relationship': 'Father' if parent == '1' else family['relationship_2'],
+                            prefix + 'Street': family['street_' + parent], prefix + 'City': 'Burlingame', prefix + 'State': 'CA',
+                            prefix + 'Zip': family['zip'], prefix + 'Email': family['email_' + parent],
+                            prefix + 'Phone': '555-010' + parent, prefix + 'Phone Type': 'Cell'})
+            if rng.random() < .05:
+                row['Contact 2 Last Name'] = ''
+            if rng.random() < .05:
+                row['Contact 1 Street'] = ''
+            for header in row:
+                if header.startswith('Contact ') and rng.random() < .04:
+                    row[header] = ' ' + row[header] + ' '
+            district_rows.append(row)
+
+    os.makedirs(directory, exist_ok=True)
+    dp_report = os.path.join(directory, 'dp.csv')
+    district_data = os.path.join(directory, 'district.csv')
+    for filename, headers, rows in [(dp_report, DP_REPORT_271_HEADERS, dp_rows),
+                                    (district_data, district_data_utils.DISTRICT_DATA_HEADERS, district_rows)]:
+        with open(filename, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, headers)
+            writer.writeheader()
+            writer.writerows(rows)
+    return dp_report, district_data
+
+
+def find_archived_inputs(archive_dir):
+    """(dp report, district data) in each Upload-Archive-<yyyymmdd> directory under archive_dir (or archive_dir
+    itself), recognized by their headers"""
+    inputs = []
+    directories = sorted(glob.glob(os.path.join(archive_dir, 'Upload-Archive-*'))) or [archive_dir]
+    for directory in directories:
+        dp_reports = []
+        district_data = []
+        for filename in sorted(glob.glob(os.path.join(directory, '*.csv'))):
+            headers = set(external_sort.read_csv_headers(filename))
+            if headers == set(DP_REPORT_271_HEADERS):
+                dp_reports.append(filename)
+            elif headers == set(district_data_utils.DISTRICT_DATA_HEADERS):
+                district_data.append(filename)
+        if len(dp_reports) == 1 and len(district_data) == 1:
+            inputs.append((dp_reports[0], district_data[0]))
+        else:
+            print("Skipping %s: found %d DP reports and %d district data files" % (directory, len(dp_reports), len(district_data)))
+    return inputs
+
+
+def read_csv_rows(filename):
+    """(headers, Counter of rows), with each row's values in sorted header order"""
+    with open(filename, 'r', newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        headers = next(reader, [])
+        order = sorted(range(len(headers)), key=lambda i: headers[i])
+        return [headers[i] for i in order], Counter(tuple(row[i] for i in order) for row in reader)
+
+
+def compare_csv_files(baseline_filename, candidate_filename):
+    """The differences between two csv files, ignoring the order of the rows and columns"""
+    baseline_headers, baseline_rows = read_csv_rows(baseline_filename)
+    candidate_headers, candidate_rows = read_csv_rows(candidate_filename)
+    if baseline_headers != candidate_headers:
+        return ["headers differ: %s vs %s" % (baseline_headers, candidate_headers)]
+    differences = []
+    for name, rows in [('baseline', baseline_rows - candidate_rows), ('candidate', candidate_rows - baseline_rows)]:
+        if rows:
+            differences.append("%d row(s) only in the %s output" % (sum(rows.values()), name))
+            for row in list(rows)[:MAX_REPORTED_ROWS]:
+                differences.append("    " + ', '.join('%s=%s' % (header, value) for header, value in zip(baseline_headers, row) if value))
+    return differences
+
+
+def compare_text_files(baseline_filename, candidate_filename):
+    with open(baseline_filename) as baseline_file, open(candidate_filename) as candidate_file:
+        baseline_lines = baseline_file.read().splitlines()
+        candidate_lines = candidate_file.read().splitlines()
+    for line_number, (baseline_line, candidate_line) in enumerate(zip(baseline_lines, candidate_lines), 1):
+        if baseline_line != candidate_line:
+            return ["line %d differs: %r vs %r" % (line_number, baseline_line, candidate_line)]
+    if len(baseline_lines) != len(candidate_lines):
+        return ["%d lines vs %d lines" % (len(baseline_lines), len(candidate_lines))]
+    return []
+
+
+def compare_outputs(baseline_dir, candidate_dir):
+    """filename -> differences, for the output files that differ"""
+    differences = dict()
+    for filename in CSV_OUTPUT_FILES + TEXT_OUTPUT_FILES:
+        compare = compare_csv_files if filename in CSV_OUTPUT_FILES else compare_text_files
+        file_differences = compare(os.path.join(baseline_dir, filename), os.path.join(candidate_dir, filename))
+        if file_differences:
+            differences[filename] = file_differences
+    return differences
+
+
+def run_case(baseline, candidate, dp_report, district_data, import_args, work_dir, repeat):
+    """Run both engines on one input (best of repeat runs each), returning (baseline seconds, candidate seconds, differences).
+    If an engine fails, its seconds are None and the differences say why."""
+    timings = []
+    output_dirs = []
+    failures = dict()
+    for engine in (baseline, candidate):
+        output_dir = os.path.join(work_dir, engine.name)
+        os.makedirs(output_dir)
+        try:
+            timings.append(min(engine.run(dp_report, district_data, import_args, output_dir) for _ in range(repeat)))
+        except RuntimeError as e:
+            timings.append(None)
+            failures['%s run' % engine.name] = [str(e)]
+        output_dirs.append(output_dir)
+    if failures:
+        return timings[0], timings[1], failures
+    return timings[0], timings[1], compare_outputs(*output_dirs)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs two versions of the import (scripts and/or options) on the same inputs and checks that they "
+                    "generate the same files for upload")
+    parser.add_argument("--baseline-script", help="district_data_import.py to compare against, e.g. in a git worktree of the last release "
+                                                  "(default: this one)",
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'district_data_import.py'))
+    parser.add_argument("--baseline-args", help="extra options for the baseline import, e.g. --baseline-args=--split-parents", default='')
+    parser.add_argument("--candidate-script", help="district_data_import.py to check (default: this one)",
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'district_data_import.py'))
+    parser.add_argument("--candidate-args", help="extra options for the candidate import, e.g. --candidate-args=\"--columnar --split-parents\"", default='')
+    parser.add_argument("--synthetic", help="number of synthetic inputs to generate (seeds 1..N)", type=int, default=0)
+    parser.add_argument("--synthetic-families", help="families per synthetic input", type=int, default=300)
+    parser.add_argument("--archive", help="directory of Upload-Archive-<yyyymmdd> directories (or one of them) to use as inputs",
+                        action='append', default=[])
+    parser.add_argument("--input", help="a DP report and district data file to use as input", nargs=2, action='append', default=[],
+                        metavar=('DP_REPORT', 'DISTRICT_DATA'))
+    parser.add_argument("--school-year", default='SY2024-25')
+    parser.add_argument("--modes", help="import modes to run each input in", nargs='+', choices=list(IMPORT_MODES), default=list(IMPORT_MODES))
+    parser.add_argument("--repeat", help="runs per engine and input; the fastest is used for the timing", type=int, default=1)
+    parser.add_argument("--keep", help="keep the outputs of all runs in this directory instead of a temporary one")
+    args = parser.parse_args()
+
+    baseline = Engine('baseline', args.baseline_script, shlex.split(args.baseline_args))
+    candidate = Engine('candidate', args.candidate_script, shlex.split(args.candidate_args))
+    work_dir = args.keep or tempfile.mkdtemp(prefix='equivalence-')
+    try:
+        inputs = [tuple(paths) for paths in args.input]
+        for archive_dir in args.archive:
+            inputs.extend(find_archived_inputs(archive_dir))
+        for seed in range(1, args.synthetic + 1):
+            inputs.append(write_synthetic_inputs(os.path.join(work_dir, 'synthetic-%d' % seed), seed, args.synthetic_families))
+        if not inputs:
+            parser.error("no inputs: use --synthetic, --archive and/or --input")
+
+        failures = 0
+        baseline_total = candidate_total = 0.0
+        for case_number, (dp_report, district_data) in enumerate(inputs, 1):
+            for mode in args.modes:
+                case_dir = os.path.join(work_dir, 'case-%d-%s' % (case_number, mode))
+                baseline_seconds, candidate_seconds, differences = run_case(
+                    baseline, candidate, dp_report, district_data, ['--school-year', args.school_year, IMPORT_MODES[mode]], case_dir, args.repeat)
+                if baseline_seconds is None or candidate_seconds is None:
+                    print("FAIL %s %s %s" % (dp_report, district_data, mode))
+                else:
+                    baseline_total += baseline_seconds
+                    candidate_total += candidate_seconds
+                    print("%-4s %s %s %s: baseline %.2fs, candidate %.2fs (x%.2f)" %
+                          ('DIFF' if differences else 'OK', dp_report, district_data, mode,
+                           baseline_seconds, candidate_seconds, candidate_seconds / baseline_seconds))
+                for filename, file_differences in differences.items():
+                    print("    %s:" % filename)
+                    for difference in file_differences:
+                        print("        %s" % difference)
+                failures += bool(differences)
+
+        print()
+        print("%d of %d runs identical; total baseline %.2fs, candidate %.2fs (x%.2f)" %
+              (len(inputs) * len(args.modes) - failures, len(inputs) * len(args.modes),
+               baseline_total, candidate_total, candidate_total / baseline_total if baseline_total else 0))
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
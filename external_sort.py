@@ -0,0 +1,125 @@
+import argparse
+import csv
+import heapq
+import os
+import shutil
+import tempfile
+
+import utils
+
+
+# Rows sorted in memory at a time; each batch becomes one run on disk
+DEFAULT_ROWS_PER_RUN = 100000
+# Runs merged at once; with more runs they are merged in several passes to bound the number of open files
+MAX_MERGE_FAN_IN = 64
+
+
+def sort_key(value):
+    """Orders ids numerically (so '9' < '10') and anything else after them as text"""
+    try:
+        return (0, int(value), '')
+    except ValueError:
+        return (1, 0, value)
+
+
+def read_csv_headers(filename):
+    with open(filename, 'r', newline='') as csvfile:
+        return next(csv.reader(csvfile), [])
+
+
+def is_sorted_csv_file(filename, key_field, expected_headers=None):
+    """True if the rows of the csv file are already in key_field order (one streaming pass)"""
+    with open(filename, 'r', newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        headers = next(reader, [])
+        if expected_headers is not None:
+            utils.validate_headers(filename, expected_headers, headers)
+        key_index = headers.index(key_field)
+        previous = None
+        for row in reader:
+            key = sort_key(row[key_index])
+            if previous is not None and key < previous:
+                return False
+            previous = key
+    return True
+
+
+def _write_run(directory, headers, rows):
+    fd, run_filename = tempfile.mkstemp(suffix='.csv', dir=directory)
+    with os.fdopen(fd, 'w', newline='') as runfile:
+        writer = csv.writer(runfile)
+        writer.writerow(headers)
+        writer.writerows(rows)
+    return run_filename
+
+
+def _read_run(run_filename):
+    with open(run_filename, 'r', newline='') as runfile:
+        reader = csv.reader(runfile)
+        next(reader)
+        yield from reader
+
+
+def _merge_runs(run_filenames, key_index):
+    # heapq.merge keeps rows with equal keys in run order, so the sort stays stable
+    return heapq.merge(*(_read_run(run_filename) for run_filename in run_filenames),
+                       key=lambda row: sort_key(row[key_index]))
+
+
+def sorted_csv_rows(filename, key_field, expected_headers=None, rows_per_run=DEFAULT_ROWS_PER_RUN, temp_dir=None):
+    """Yields the rows of a csv file (as dicts, like utils.iter_csv_file) in key_field order, in bounded memory.
+
+    The sort is stable, so rows with the same key keep their order from the file. Already sorted files are
+    streamed as they are; otherwise sorted runs of rows_per_run rows are written to a temporary directory and
+    merged.
+    """
+    if expected_headers is None:
+        expected_headers = read_csv_headers(filename)
+    if is_sorted_csv_file(filename, key_field, expected_headers):
+        yield from utils.iter_csv_file(filename, expected_headers)
+        return
+
+    run_directory = tempfile.mkdtemp(prefix='external-sort-', dir=temp_dir)
+    try:
+        headers = read_csv_headers(filename)
+        key_index = headers.index(key_field)
+        run_filenames = []
+        batch = []
+        for row in utils.iter_csv_file(filename, expected_headers):
+            if len(batch) == rows_per_run:
+                batch.sort(key=lambda values: sort_key(values[key_index]))
+                run_filenames.append(_write_run(run_directory, headers, batch))
+                batch = []
+            batch.append(list(row.values()))
+        batch.sort(key=lambda values: sort_key(values[key_index]))
+        run_filenames.append(_write_run(run_directory, headers, batch))
+
+        while len(run_filenames) > MAX_MERGE_FAN_IN:
+            # Merge neighbouring runs so that equal keys stay in file order
+            run_filenames = [_write_run(run_directory, headers, _merge_runs(run_filenames[i:i + MAX_MERGE_FAN_IN], key_index))
+                             for i in range(0, len(run_filenames), MAX_MERGE_FAN_IN)]
+        for values in _merge_runs(run_filenames, key_index):
+            yield dict(zip(headers, values))
+    finally:
+        shutil.rmtree(run_directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sort a csv export (e.g. DP report 271) by one column without loading it into memory")
+    parser.add_argument("--input", help="csv file to sort", required=True)
+    parser.add_argument("--output", help="csv file to write the sorted rows to", required=True)
+    parser.add_argument("--key", help="column to sort by, e.g. DONOR_ID or STU_NUMBER", default='DONOR_ID')
+    parser.add_argument("--rows-per-run", help="rows sorted in memory at a time", type=int, default=DEFAULT_ROWS_PER_RUN)
+    parser.add_argument("--temp-dir", help="directory for the temporary sorted runs (default: system temp dir)")
+    args = parser.parse_args()
+
+    headers = read_csv_headers(args.input)
+    print("Input files:")
+    rows = sorted_csv_rows(args.input, args.key, headers, args.rows_per_run, args.temp_dir)
+    print()
+    print("Output files:")
+    utils.save_as_csv_file(args.output, headers, rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Block allocation of the generated (negative) DONOR_IDs and OTHER_IDs.
+
+Threads only: the reserved blocks live in this process, so worker processes (multiprocessing, or a pickled
+IdAllocator in each worker) would hand out the same values. To use workers, have the parent reserve a range
+per task with reserve_block(seq, count) and pass the (first, end) pair along; the worker then uses
+first .. end - 1 and never reserves on its own, and the parent reserves a new range if a task needs more.
+"""
+import threading
+
+
+DEFAULT_BLOCK_SIZE = 256
+
+
+class IdProducer:
+    """Hands out sequence values from blocks it reserves from an IdAllocator.
+
+    Only reserving a block touches the shared state, so producers in different threads don't contend on
+    every ID. A producer itself must only be used from one thread.
+    """
+
+    def __init__(self, allocator, seq, block_size):
+        self.__allocator = allocator
+        self.__seq = seq
+        self.__block_size = block_size
+        self.__next = 0
+        self.__end = 0
+
+    def next_value(self):
+        if self.__next == self.__end:
+            self.__next, self.__end = self.__allocator.reserve_block(self.__seq, self.__block_size)
+        value = self.__next
+        self.__next += 1
+        return value
+
+    def remaining_block(self):
+        return self.__next, self.__end
+
+    def restore_block(self, block):
+        self.__next, self.__end = block
+
+
+class IdAllocator:
+    """Allocates values for named sequences (e.g. DONOR_ID, OTHER_ID) in contiguous blocks.
+
+    Thread-safe: each thread draws from its own producer and only takes the lock to reserve a new block.
+    A single thread gets consecutive values 1, 2, 3, ... just like a plain counter.
+    """
+
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE):
+        self.block_size = block_size
+        self.__init_local_state(dict())
+
+    def __init_local_state(self, last_values):
+        self.__lock = threading.Lock()
+        self.__last_values = last_values
+        self.__producers = threading.local()
+        # Bumped by reset(), so every thread drops the block it reserved before
+        self.__generations = dict()
+
+    def reserve_block(self, seq, size):
+        """Reserve size consecutive values of seq. Returns (first, end) with end exclusive."""
+        with self.__lock:
+            first = self.__last_values.get(seq, 0) + 1
+            self.__last_values[seq] = first + size - 1
+        return first, first + size
+
+    def __thread_producer(self, seq):
+        """This thread's producer for seq, as long as seq hasn't been reset since it was made"""
+        producers = self.__producers.__dict__
+        generation = self.__generations.get(seq, 0)
+        if seq not in producers or producers[seq][0] != generation:
+            producers[seq] = (generation, IdProducer(self, seq, self.block_size))
+        return producers[seq][1]
+
+    def next_value(self, seq):
+        return self.__thread_producer(seq).next_value()
+
+    def reset(self, seq, last_value):
+        """Continue seq after last_value in every thread, e.g. after the IDs have been renumbered. Only call
+        while no other thread is allocating."""
+        with self.__lock:
+            self.__last_values[seq] = last_value
+            self.__generations[seq] = self.__generations.get(seq, 0) + 1
+
+    def __getstate__(self):
+        # Locks and thread-local producers can't be pickled (e.g. for checkpoints). Keep the calling thread's
+        # remaining blocks so that a restored single-threaded run carries on with exactly the same values.
+        producers = self.__producers.__dict__
+        return {
+            'block_size': self.block_size,
+            'last_values': dict(self.__last_values),
+            'remaining_blocks': dict((seq, producer.remaining_block()) for seq, (generation, producer) in producers.items()
+                                     if generation == self.__generations.get(seq, 0)),
+        }
+
+    def __setstate__(self, state):
+        self.block_size = state['block_size']
+        self.__init_local_state(state['last_values'])
+        for seq, block in state['remaining_blocks'].items():
+            self.__thread_producer(seq).restore_block(block)
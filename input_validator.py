@@ -0,0 +1,212 @@
+from collections import namedtuple
+import contextlib
+import csv
+from operator import itemgetter
+import sys
+
+from dpdata import DP_REPORT_271_DONOR_HEADERS, DP_REPORT_271_HEADERS
+import district_data_utils
+
+
+# Values the district sometimes puts in empty fields
+PLACEHOLDER_VALUES = ('-', '#N/A')
+
+ValidationProblem = namedtuple('ValidationProblem', ['severity', 'filename', 'line', 'column', 'value', 'message'])
+
+
+class ValidationReport:
+    """All problems found in the input files. Errors would make the import fail; warnings are suspicious data."""
+
+    def __init__(self):
+        self.problems = []
+
+    def add(self, severity, filename, line, column, value, message):
+        self.problems.append(ValidationProblem(severity, filename, line, column, value, message))
+
+    def errors(self):
+        return [problem for problem in self.problems if problem.severity == 'error']
+
+    def warnings(self):
+        return [problem for problem in self.problems if problem.severity == 'warning']
+
+    def format(self):
+        lines = ["Input validation: %d error(s), %d warning(s)" % (len(self.errors()), len(self.warnings()))]
+        for problem in self.errors() + self.warnings():
+            where = problem.filename if problem.line is None else "%s line %d" % (problem.filename, problem.line)
+            column = " [%s=%r]" % (problem.column, problem.value) if problem.column else ""
+            lines.append("    %s: %s%s: %s" % (problem.severity.upper(), where, column, problem.message))
+        return '\n'.join(lines)
+
+
+def _open_rows(report, filename, expected_headers):
+    """Yields (line, row) for each row, after reporting unexpected headers (or stops at missing ones)"""
+    if not filename.endswith('.csv'):
+        report.add('error', filename, None, None, None, "must be a csv file")
+        return
+    try:
+        csvfile = open(filename, 'r')
+    except OSError as e:
+        report.add('error', filename, None, None, None, "cannot be read: %s" % e)
+        return
+    with csvfile:
+        reader = csv.DictReader(csvfile)
+        actual_headers = set(reader.fieldnames or ())
+        missing = sorted(set(expected_headers) - actual_headers)
+        extra = sorted(actual_headers - set(expected_headers))
+        if extra:
+            report.add('error', filename, 1, None, None, "unexpected header(s): %s" % ', '.join(extra))
+        if missing:
+            # The rows can't be checked without these columns
+            report.add('error', filename, 1, None, None, "missing expected header(s): %s" % ', '.join(missing))
+            return
+        for row in reader:
+            yield reader.line_num, row
+
+
+class DistrictDataChecks:
+    """Checks every district row the import would use, one row at a time as the file is read"""
+
+    def __init__(self, report, filename):
+        self.report = report
+        self.filename = filename
+        self.__first_line_for_stu_number = dict()
+        self.__placeholders = set(PLACEHOLDER_VALUES)
+
+    def check_row(self, line, row):
+        report, filename = self.report, self.filename
+        values = row.values()
+        if None in row:
+            # csv.DictReader puts the cells past the last header in a list under None; the import ignores them
+            report.add('warning', filename, line, None, None, "%d cell(s) more than there are headers, ignored" % len(row[None]))
+            values = [value for column, value in row.items() if column is not None]
+        # Most rows have no placeholders: find that out without a Python loop over the cells (short rows have None)
+        if None in values or not self.__placeholders.isdisjoint(map(str.strip, values)):
+            for column, value in row.items():
+                if isinstance(value, str) and value.strip() in PLACEHOLDER_VALUES:
+                    report.add('warning', filename, line, column, value, "placeholder value, should be empty")
+        # Rows the import skips
+        if row.get('School') == 'PreSchool' or not (row.get('Contact 1 Last Name') or row.get('Contact 2 Last Name')):
+            return
+        stu_number = row.get('SystemID')
+        if stu_number in self.__first_line_for_stu_number:
+            report.add('warning', filename, line, 'SystemID', stu_number,
+                       "duplicate SystemID (also on line %d), only the last row is used" % self.__first_line_for_stu_number[stu_number])
+        else:
+            self.__first_line_for_stu_number[stu_number] = line
+        try:
+            district_data_utils.dp_grade_for_district_record(row)
+        except (KeyError, ValueError) as e:
+            report.add('error', filename, line, 'Grade', row.get('Grade'), "invalid grade (%s)" % e)
+        if row.get('School') not in district_data_utils.DISTRICT_SCHOOL_MAPPING:
+            report.add('error', filename, line, 'School', row.get('School'),
+                       "unknown school, expected one of %s" % ', '.join(sorted(district_data_utils.DISTRICT_SCHOOL_MAPPING)))
+
+    def finish(self):
+        pass
+
+
+class DPReportChecks:
+    """Checks the DP report for the things DPData refuses to load, one row at a time as the file is read"""
+
+    def __init__(self, report, filename):
+        self.report = report
+        self.filename = filename
+        self.__first_line_for_other_id = dict()
+        self.__donorrecords = dict()
+        self.__includes_nomail = False
+        self.__donorrecord = itemgetter(*DP_REPORT_271_DONOR_HEADERS)
+
+    def check_row(self, line, row):
+        report, filename = self.report, self.filename
+        other_id = row.get('OTHER_ID')
+        if other_id in self.__first_line_for_other_id:
+            report.add('error', filename, line, 'OTHER_ID', other_id, "duplicate OTHER_ID (also on line %d)" % self.__first_line_for_other_id[other_id])
+        else:
+            self.__first_line_for_other_id[other_id] = line
+        yearto = row.get('YEARTO') or ''
+        if yearto:
+            try:
+                int(float(yearto.replace(",", '')))
+            except ValueError:
+                report.add('error', filename, line, 'YEARTO', yearto, "not a year")
+        donorrecord = self.__donorrecord(row)
+        donor_id = row.get('DONOR_ID')
+        if self.__donorrecords.setdefault(donor_id, donorrecord) != donorrecord:
+            report.add('error', filename, line, 'DONOR_ID', donor_id, "donor fields differ from an earlier row for the same donor")
+        if row.get('NOMAIL') == 'Y':
+            self.__includes_nomail = True
+
+    def finish(self):
+        if self.__first_line_for_other_id and not self.__includes_nomail:
+            self.report.add('error', self.filename, None, None, None, "must include \"NO MAIL\" donors (select 'Include \"NO MAIL\" Names')")
+
+
+def _validate_file(checks, expected_headers):
+    for line, row in _open_rows(checks.report, checks.filename, expected_headers):
+        checks.check_row(line, row)
+    checks.finish()
+
+
+def validate_district_data(report, filename):
+    """Check every district row the import would use, streaming through the file once"""
+    _validate_file(DistrictDataChecks(report, filename), district_data_utils.DISTRICT_DATA_HEADERS)
+
+
+def validate_dp_report(report, filename):
+    """Check the DP report for the things DPData refuses to load, streaming through the file once"""
+    _validate_file(DPReportChecks(report, filename), DP_REPORT_271_HEADERS)
+
+
+class InputValidation:
+    """The checks of both input files, fed by the loaders: pass dp_report_row_check and district_data_row_check
+    as their row_check, so the rows are validated in the pass that loads them instead of a second one"""
+
+    def __init__(self, dp_report_filename, district_data_filename):
+        self.report = ValidationReport()
+        self.dp_report_checks = DPReportChecks(self.report, dp_report_filename)
+        self.district_data_checks = DistrictDataChecks(self.report, district_data_filename)
+        self.dp_report_row_check = self.dp_report_checks.check_row
+        self.district_data_row_check = self.district_data_checks.check_row
+
+    def validate_dp_report_file(self):
+        """Check the DP report on its own, when it isn't loaded here (e.g. resuming from a checkpoint)"""
+        _validate_file(self.dp_report_checks, DP_REPORT_271_HEADERS)
+        self.dp_report_checks = None
+
+    def add_dp_report_problems(self, problems):
+        """Take the problems of a DP report that was checked elsewhere, e.g. in the worker process that loaded it"""
+        self.report.problems.extend(problems)
+        self.dp_report_checks = None
+
+    def finish(self):
+        """Run the checks that need the whole file, once the rows of both files have been checked"""
+        for checks in (self.dp_report_checks, self.district_data_checks):
+            if checks is not None:
+                checks.finish()
+
+
+@contextlib.contextmanager
+def validating(dp_report_filename, district_data_filename):
+    """Validate the input files while the body loads them, through the row checks of the InputValidation it gets.
+
+    Afterwards any problems are printed. If there are errors the script exits. If loading failed (e.g. on the
+    first of several problems), not every row was checked, so both files are validated in full, and the full
+    report is shown instead.
+    """
+    validation = InputValidation(dp_report_filename, district_data_filename)
+    try:
+        yield validation
+        validation.finish()
+    except (Exception, SystemExit):
+        report = ValidationReport()
+        validate_dp_report(report, dp_report_filename)
+        validate_district_data(report, district_data_filename)
+        if report.problems:
+            print(report.format())
+        if not report.errors():
+            raise
+        sys.exit(1)
+    if validation.report.problems:
+        print(validation.report.format())
+    if validation.report.errors():
+        sys.exit(1)
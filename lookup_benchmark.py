@@ -0,0 +1,95 @@
+from urllib.parse import urlencode
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from dpdata import DPData
+import utils
+
+
+def sample_requests(dp, count, seed):
+    """A mix of lookups by every supported key, drawn from the donors and students in the DP report"""
+    rng = random.Random(seed)
+    donors = list(dp.get_donors())
+    students = list(dp.get_students())
+    requests = []
+    for _ in range(count):
+        dp_donorrecord = rng.choice(donors)
+        kind = rng.randrange(6)
+        if kind == 0:
+            params = {'donor_id': dp_donorrecord['DONOR_ID']}
+        elif kind == 1:
+            params = {'match_key': dp.compute_match_key(dp_donorrecord)}
+        elif kind == 2:
+            params = {'first_name': dp_donorrecord['FIRST_NAME'], 'last_name': dp_donorrecord['LAST_NAME']}
+        elif kind == 3:
+            params = {'email': dp_donorrecord['EMAIL'] or 'nobody@example.com'}
+        elif kind == 4:
+            params = {'address_key': utils.address_key(dp_donorrecord['ADDRESS'], dp_donorrecord['ZIP'])}
+        else:
+            requests.append('/students?' + urlencode({'stu_number': rng.choice(students)['STU_NUMBER']}))
+            continue
+        requests.append('/donors?' + urlencode(params))
+    return requests
+
+
+async def run_client(host, port, paths, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for path in paths:
+            start = time.perf_counter()
+            writer.write(('GET %s HTTP/1.1\r\nHost: %s\r\n\r\n' % (path, host)).encode('latin-1'))
+            await writer.drain()
+            status_line = await reader.readline()
+            content_length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.lower() == 'content-length':
+                    content_length = int(value)
+            json.loads(await reader.readexactly(content_length))
+            latencies.append(time.perf_counter() - start)
+            if b' 200 ' not in status_line:
+                raise ValueError("%s failed: %s" % (path, status_line))
+    finally:
+        writer.close()
+
+
+async def run_benchmark(host, port, paths, concurrency):
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client(host, port, paths[i::concurrency], latencies) for i in range(concurrency)))
+    return time.perf_counter() - start, latencies
+
+
+def percentile(sorted_values, pct):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and latency benchmark for lookup_service.py")
+    parser.add_argument("--dp-report", help="the DP report the service was started with (used to pick lookup keys)", required=True)
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument("--requests", help="total number of lookups", type=int, default=10000)
+    parser.add_argument("--concurrency", help="number of concurrent keep-alive connections", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print("Input files:")
+    paths = sample_requests(DPData(args.dp_report), args.requests, args.seed)
+    elapsed, latencies = asyncio.run(run_benchmark(args.host, args.port, paths, args.concurrency))
+    latencies.sort()
+    print()
+    print("Requests:    %d over %d connections" % (len(latencies), args.concurrency))
+    print("Throughput:  %.0f requests/second" % (len(latencies) / elapsed))
+    print("Latency ms:  p50 %.2f, p90 %.2f, p99 %.2f, max %.2f" % tuple(
+        1000 * value for value in (percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99), latencies[-1])))
+
+
+if __name__ == '__main__':
+    main()
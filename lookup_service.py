@@ -0,0 +1,185 @@
+from collections import defaultdict
+from urllib.parse import parse_qs, urlsplit
+import argparse
+import asyncio
+import json
+
+from dpdata import DPData
+import district_data_import
+import district_data_utils
+import utils
+
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class DonorLookupIndex:
+    """In-memory indexes over a loaded DPData, built once at startup"""
+
+    def __init__(self, dp, school_year):
+        self.dp = dp
+        self.school_year = school_year
+        self.match_key_to_donor_ids = defaultdict(list)
+        self.name_to_donor_ids = defaultdict(list)
+        self.email_to_donor_ids = defaultdict(list)
+        self.address_key_to_donor_ids = defaultdict(list)
+        for dp_donorrecord in dp.get_donors():
+            donor_id = dp_donorrecord['DONOR_ID']
+            self.match_key_to_donor_ids[dp.compute_match_key(dp_donorrecord)].append(donor_id)
+            for first_name, last_name in ((dp_donorrecord['FIRST_NAME'], dp_donorrecord['LAST_NAME']),
+                                          (dp_donorrecord['SP_FNAME'], dp_donorrecord['SP_LNAME'])):
+                if last_name:
+                    self.name_to_donor_ids[(first_name.strip().upper(), last_name.strip().upper())].append(donor_id)
+                    self.name_to_donor_ids[('', last_name.strip().upper())].append(donor_id)
+            for email in set(utils.normalize_email(dp_donorrecord[field]) for field in ('EMAIL', 'SPOUSE_EMAIL', 'GUARD_EMAIL')):
+                if email:
+                    self.email_to_donor_ids[email].append(donor_id)
+            if dp_donorrecord['ADDRESS']:
+                self.address_key_to_donor_ids[utils.address_key(dp_donorrecord['ADDRESS'], dp_donorrecord['ZIP'])].append(donor_id)
+        # The importer keeps only the last donor for a duplicate match key
+        self.match_key_to_donor_id = dict((match_key, donor_ids[-1]) for match_key, donor_ids in self.match_key_to_donor_ids.items())
+
+    def donor_result(self, donor_id):
+        dp_donorrecord = dict(self.dp.get_donor(donor_id))
+        dp_donorrecord['students'] = self.dp.get_students_for_donor(donor_id)
+        return dp_donorrecord
+
+    def donors_result(self, donor_ids):
+        return [self.donor_result(donor_id) for donor_id in donor_ids]
+
+    def find_donors(self, params):
+        if 'donor_id' in params:
+            donor_ids = [params['donor_id']] if self.dp.has_donor(params['donor_id']) else []
+        elif 'match_key' in params:
+            donor_ids = self.match_key_to_donor_ids.get(params['match_key'], [])
+        elif 'last_name' in params:
+            donor_ids = self.name_to_donor_ids.get(
+                (params.get('first_name', '').strip().upper(), params['last_name'].strip().upper()), [])
+        elif 'email' in params:
+            donor_ids = self.email_to_donor_ids.get(utils.normalize_email(params['email']), [])
+        elif 'address_key' in params:
+            donor_ids = self.address_key_to_donor_ids.get(params['address_key'], [])
+        elif 'address' in params:
+            donor_ids = self.address_key_to_donor_ids.get(utils.address_key(params['address'], params.get('zip', '')), [])
+        else:
+            raise ValueError("Specify one of donor_id, match_key, last_name (and first_name), email, address_key or address (and zip)")
+        return self.donors_result(donor_ids)
+
+    def find_students(self, params):
+        if 'stu_number' not in params:
+            raise ValueError("Specify stu_number")
+        return self.dp.get_students_for_stu_number(params['stu_number'])
+
+    def explain_district_record(self, district_record):
+        """What the importer would do with this new district row (against the loaded, unmodified DP data)"""
+        district_record = district_data_utils.DistrictRecord(
+            dict((header, district_record.get(header, '')) for header in district_data_utils.DISTRICT_DATA_HEADERS))
+        stu_number = district_record.stu_number
+        result = {
+            'stu_number': stu_number,
+            'different_household': district_record.different_household,
+        }
+        dp_studentrecords = self.dp.get_students_for_stu_number(stu_number)
+        if dp_studentrecords:
+            # Returning student, the importer only updates the existing records
+            result['rule'] = 'existing-student'
+            result['donors'] = self.donors_result(sorted(set(student['DONOR_ID'] for student in dp_studentrecords)))
+            return result
+        rule, donor_id, match_key, dp_donorrecord, dp_alternate_donorrecord = district_data_import.match_district_record(
+            self.dp, self.match_key_to_donor_id, district_record, self.school_year)
+        result.update({'rule': rule, 'match_key': match_key})
+        if donor_id:
+            result['donors'] = [self.donor_result(donor_id)]
+        else:
+            result['new_donors'] = [dict(dp_donorrecord)] if dp_alternate_donorrecord is None else [dict(dp_alternate_donorrecord), dict(dp_donorrecord)]
+        return result
+
+
+class LookupService:
+    """Minimal HTTP/1.1 JSON server over a DonorLookupIndex. Supports keep-alive; all lookups are in-memory."""
+
+    def __init__(self, index):
+        self.index = index
+
+    def handle(self, method, path, body):
+        """Returns (status, json-able result) for one request"""
+        url = urlsplit(path)
+        params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        if url.path == '/health':
+            return 200, {'status': 'ok'}
+        if url.path == '/donors' and method == 'GET':
+            return 200, self.index.find_donors(params)
+        if url.path == '/students' and method == 'GET':
+            return 200, self.index.find_students(params)
+        if url.path == '/district-row':
+            if method != 'POST':
+                return 405, {'error': 'POST a json object with the district csv columns'}
+            district_record = json.loads(body.decode('utf-8') or '{}')
+            if not isinstance(district_record, dict) or not all(isinstance(value, str) for value in district_record.values()):
+                raise ValueError("POST a json object with the district csv columns as strings")
+            return 200, self.index.explain_district_record(district_record)
+        return 404, {'error': 'Unknown path %s' % url.path}
+
+    async def serve_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                try:
+                    status, result = self.handle(method, path, body)
+                except ValueError as e:
+                    status, result = 400, {'error': str(e)}
+                except Exception as e:
+                    status, result = 500, {'error': repr(e)}
+                payload = json.dumps(result).encode('utf-8')
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n' %
+                              (status, HTTP_REASONS[status], len(payload), 'keep-alive' if keep_alive else 'close')).encode('latin-1'))
+                writer.write(payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.serve_connection, host, port)
+        print("Listening on http://%s:%d" % (host, port))
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local lookup service over the donors and students in a DP report")
+    parser.add_argument("--dp-report",
+                        help="csv output from DP: Reports -> Report Center -> 271 Name Contacts Other -> Include \"NO MAIL\" Names -> run report -> export as .csv",
+                        required=True)
+    parser.add_argument("--school-year",
+                        help="school year to use for new families, e.g. SY2016-17",
+                        required=True)
+    parser.add_argument("--host", help="address to listen on (default: localhost only)", default='127.0.0.1')
+    parser.add_argument("--port", help="port to listen on", type=int, default=8008)
+    args = parser.parse_args()
+
+    print("Input files:")
+    index = DonorLookupIndex(DPData(args.dp_report), args.school_year)
+    try:
+        asyncio.run(LookupService(index).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print("Stopped")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+from collections import OrderedDict
+import contextlib
+import os
+import pickle
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: the memory use can't be measured there, so a memory limit always spills
+    resource = None
+
+import utils
+
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# Share of the limit at which the unmodified DP records are spilled: the import still grows after that (new
+# records, the match key index, the output rows), so it needs headroom
+SPILL_AT_SHARE = 0.6
+# DP report rows loaded between checks of the memory use
+CHECK_EVERY_ROWS = 5000
+
+# Set by spilled_records_in, for pickling SpilledRecords into checkpoints and restoring them
+_spill_files = threading.local()
+
+
+def parse_size(size):
+    """Bytes for a size such as 512M, 2G or 1500000"""
+    size = size.strip().upper().rstrip('B')
+    unit = SIZE_UNITS.get(size[-1:], 1)
+    if unit != 1:
+        size = size[:-1]
+    try:
+        return int(float(size) * unit)
+    except ValueError:
+        raise ValueError("Invalid size %r, expected e.g. 512M or 2G" % size)
+
+
+def format_size(size):
+    return '%.0f MB' % (size / SIZE_UNITS['M'])
+
+
+class SpilledRecords:
+    """Records keyed by id, kept in a sqlite file instead of in memory.
+
+    Supports the dict operations DPData uses on its unmodified records (get, set, in, items in insertion order).
+    Every get unpickles a new copy of the record, so the records must be treated as read-only. A deep copy is a
+    copy of the file, and checkpoints copy the file too (see spilled_records_in), so neither needs the records
+    in memory.
+    """
+
+    def __init__(self, filename, memory_budget=None, name=None):
+        self.filename = filename
+        self.name = name or os.path.splitext(os.path.basename(filename))[0]
+        self.__memory_budget = memory_budget
+        self.__connection = sqlite3.connect(filename)
+        # Scratch data: nothing to recover after a crash
+        self.__connection.execute('PRAGMA journal_mode=OFF')
+        self.__connection.execute('PRAGMA synchronous=OFF')
+        self.__connection.execute('CREATE TABLE IF NOT EXISTS records (position INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, record BLOB NOT NULL)')
+        self.__pending = []
+
+    def __flush(self):
+        if self.__pending:
+            with self.__connection:
+                self.__connection.executemany('INSERT OR REPLACE INTO records (id, record) VALUES (?, ?)', self.__pending)
+            self.__pending = []
+
+    def __setitem__(self, record_id, record):
+        # Written in batches, so loading a report doesn't take a transaction per record
+        self.__pending.append((record_id, pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)))
+        if len(self.__pending) >= 1000:
+            self.__flush()
+
+    def __getitem__(self, record_id):
+        self.__flush()
+        row = self.__connection.execute('SELECT record FROM records WHERE id = ?', (record_id,)).fetchone()
+        if row is None:
+            raise KeyError(record_id)
+        return pickle.loads(row[0])
+
+    def __contains__(self, record_id):
+        self.__flush()
+        return self.__connection.execute('SELECT 1 FROM records WHERE id = ?', (record_id,)).fetchone() is not None
+
+    def __len__(self):
+        self.__flush()
+        return self.__connection.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def items(self):
+        self.__flush()
+        for record_id, record in self.__connection.execute('SELECT id, record FROM records ORDER BY position'):
+            yield record_id, pickle.loads(record)
+
+    def close(self):
+        self.__flush()
+        self.__connection.close()
+
+    def __deepcopy__(self, memo):
+        # A copy of the file rather than of the records, so copying doesn't need their memory
+        self.__flush()
+        if self.__memory_budget is None:
+            return OrderedDict(self.items())
+        return self.__memory_budget.spilled_records(self.name, copy_of=self.filename)
+
+    def __reduce__(self):
+        destination = getattr(_spill_files, 'destination', None)
+        if destination is None:
+            # Pickled on its own (e.g. to another process): the records go into the pickle
+            return OrderedDict, (list(self.items()),)
+        directory, prefix, memory_budget = destination
+        self.__flush()
+        filename = '%s-%s' % (prefix, os.path.basename(self.filename))
+        with open(self.filename, 'rb') as inputfile, utils.atomic_open(os.path.join(directory, filename), 'wb') as outputfile:
+            shutil.copyfileobj(inputfile, outputfile)
+        return _restore_spilled_records, (filename, self.name)
+
+
+def _restore_spilled_records(filename, name):
+    destination = getattr(_spill_files, 'destination', None)
+    if destination is None:
+        raise pickle.UnpicklingError("Spilled records %s can only be restored within spilled_records_in" % filename)
+    directory, prefix, memory_budget = destination
+    if not os.path.exists(os.path.join(directory, filename)):
+        raise pickle.UnpicklingError("Spilled records %s are missing" % os.path.join(directory, filename))
+    if memory_budget is not None:
+        return memory_budget.spilled_records(name, copy_of=os.path.join(directory, filename))
+    # Without a memory limit they can just as well be in memory
+    store = SpilledRecords(os.path.join(directory, filename))
+    records = OrderedDict(store.items())
+    store.close()
+    return records
+
+
+@contextlib.contextmanager
+def spilled_records_in(directory, prefix, memory_budget=None):
+    """Within this, pickling a SpilledRecords copies its file to directory (named prefix-<its name>) instead of
+    putting the records into the pickle, e.g. for checkpoints. Unpickling restores it from the copy, as a new
+    SpilledRecords of memory_budget, or in memory if there is none."""
+    previous = getattr(_spill_files, 'destination', None)
+    _spill_files.destination = (directory, prefix, memory_budget)
+    try:
+        yield
+    finally:
+        _spill_files.destination = previous
+
+
+class MemoryBudget:
+    """Keeps an import within a memory limit by spilling cold data to temporary files.
+
+    The memory use of the process is checked while the DP report loads and after each import stage. Once it
+    passes SPILL_AT_SHARE of the limit, the unmodified copies of the DP records, which are only needed again to
+    find the changes when the output files are written, move to sqlite files (see SpilledRecords) in a
+    temporary directory, and so do the ones loaded after that.
+    """
+
+    def __init__(self, limit, temp_dir=None):
+        self.limit = limit
+        self.temp_dir = temp_dir
+        self.spilling = False
+        self.spilled_at = None
+        self.__spill_dir = None
+        self.__stores = []
+
+    def check(self, dp):
+        """Spill the unmodified records of dp if the memory use is getting close to the limit (or can't be
+        measured). Returns True if they are spilled."""
+        if not self.spilling:
+            usage = self.current_usage()
+            if usage is None or usage > self.limit * SPILL_AT_SHARE:
+                self.spilling = True
+                self.spilled_at = usage
+                dp.spill_unmodified_records(self)
+        return self.spilling
+
+    def spilled_records(self, name, copy_of=None):
+        """A new SpilledRecords in the spill directory (with the records of the sqlite file copy_of, if given),
+        removed again by close()"""
+        if self.__spill_dir is None:
+            self.__spill_dir = tempfile.mkdtemp(prefix='dp-import-spill-', dir=self.temp_dir)
+        # Numbered, as copies (see SpilledRecords.__deepcopy__) have the same name
+        filename = os.path.join(self.__spill_dir, '%s-%d.sqlite' % (name, len(self.__stores)))
+        if copy_of is not None:
+            shutil.copyfile(copy_of, filename)
+        store = SpilledRecords(filename, self, name)
+        self.__stores.append(store)
+        return store
+
+    @staticmethod
+    def current_usage():
+        """Memory in use by this process in bytes: the resident set on Linux, else the peak so far (or None)"""
+        try:
+            with open('/proc/self/statm') as statm:
+                return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError, AttributeError):
+            return MemoryBudget.peak_usage()
+
+    @staticmethod
+    def peak_usage():
+        """Peak memory use of this process so far in bytes, or None if it can't be told"""
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    def format_plan(self):
+        return "Memory limit %s: the unmodified DP records go to disk if the import uses more than %s" % (
+            format_size(self.limit), format_size(self.limit * SPILL_AT_SHARE))
+
+    def format_usage(self):
+        peak = self.peak_usage()
+        spilled = ""
+        if self.spilling:
+            spilled = ", the unmodified DP records were spilled to disk" + (
+                " at %s" % format_size(self.spilled_at) if self.spilled_at is not None else "")
+        if peak is None:
+            return "Memory limit %s%s" % (format_size(self.limit), spilled)
+        return "Peak memory use %s of the %s limit%s%s" % (format_size(peak), format_size(self.limit),
+                                                            "" if peak <= self.limit else " (OVER THE LIMIT)", spilled)
+
+    def close(self):
+        for store in self.__stores:
+            store.close()
+        self.__stores = []
+        if self.__spill_dir is not None:
+            shutil.rmtree(self.__spill_dir, ignore_errors=True)
+            self.__spill_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
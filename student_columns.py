@@ -0,0 +1,80 @@
+from datetime import datetime
+
+import numpy as np
+
+import district_data_utils
+
+
+def _parse_grade(grade):
+    try:
+        return int(grade)
+    except (TypeError, ValueError):
+        return None
+
+
+class StudentColumns:
+    """The DP student table as columns: GRADE as an integer array and SCHOOL as categorical codes.
+
+    Built from the live DPData student records; apply() writes the changed cells back to those records.
+    """
+
+    def __init__(self, dp, parse_grades=True):
+        self.records = list(dp.get_students())
+        count = len(self.records)
+        self.grade_strings = [studentrecord['GRADE'] for studentrecord in self.records]
+        # Grades are only needed (and only parsed by the row-by-row code) for the new-year grade advancement.
+        # A grade that isn't a number (e.g. ALUM) counts as no grade.
+        grades = [_parse_grade(grade) if parse_grades else None for grade in self.grade_strings]
+        self.has_grade = np.fromiter((grade is not None for grade in grades), dtype=bool, count=count)
+        self.grades = np.fromiter((grade or 0 for grade in grades), dtype=np.int64, count=count)
+        self.school_names, self.school_codes = np.unique(
+            np.array([studentrecord['SCHOOL'] for studentrecord in self.records], dtype=object), return_inverse=True)
+        self.school_names = list(self.school_names)
+        self.stu_numbers = [studentrecord['STU_NUMBER'] for studentrecord in self.records]
+
+    def school_mask(self, *schools):
+        codes = [self.school_names.index(school) for school in schools if school in self.school_names]
+        return np.isin(self.school_codes, codes)
+
+
+def update_existing_students_columnar(dp, district_records, new_year_import):
+    """Same result as district_data_import.update_existing_students, with the new-year grade advancement,
+    graduation and NOBSD rules done as bulk operations on StudentColumns"""
+    columns = StudentColumns(dp, parse_grades=new_year_import)
+    grades = columns.grades
+    if new_year_import:
+        # 0-8 move up a grade; -1 (old TK) and -2 (TK) both become kindergarten, which is set as the int 0
+        bumped = columns.has_grade & (grades >= 0) & (grades < 9)
+        to_kindergarten = columns.has_grade & ((grades == -1) | (grades == -2))
+        new_grades = np.where(bumped, grades + 1, 0)
+        # Graduation checks for the grade string '9', which is either a bumped 8th grader or an untouched '9'
+        is_grade_9 = np.where(bumped, new_grades == 9,
+                              np.fromiter((grade == '9' for grade in columns.grade_strings), dtype=bool, count=len(grades)))
+    else:
+        bumped = to_kindergarten = is_grade_9 = np.zeros(len(grades), dtype=bool)
+        new_grades = grades
+
+    returning = np.fromiter((stu_number in district_records for stu_number in columns.stu_numbers), dtype=bool, count=len(grades))
+    graduating = ~returning & is_grade_9 & columns.school_mask('BIS')
+    leaving = ~returning & ~graduating & ~columns.school_mask('ALUM', 'NOBSD')
+
+    # Materialize the results into the records
+    records = columns.records
+    for i in np.flatnonzero(bumped & ~returning):
+        records[i]['GRADE'] = str(new_grades[i])
+    for i in np.flatnonzero(to_kindergarten & ~returning):
+        records[i]['GRADE'] = 0
+    for i in np.flatnonzero(returning):
+        dp_studentrecord = records[i]
+        district_record = district_records[dp_studentrecord['STU_NUMBER']]
+        dp_studentrecord['GRADE'] = district_data_utils.dp_grade_for_district_record(district_record)
+        dp_studentrecord['SCHOOL'] = district_data_utils.district_school_to_dp_school(district_record['School'])
+        dp_studentrecord['PHOTO_OPT_OUT'] = district_record['Photo Opt Out']
+    yearto = str(datetime.now().year)
+    for i in np.flatnonzero(graduating):
+        records[i]['SCHOOL'] = 'ALUM'
+        records[i]['YEARTO'] = yearto
+    for i in np.flatnonzero(leaving):
+        #this student didn't return back to BSD
+        records[i]['SCHOOL'] = 'NOBSD'
+        records[i]['YEARTO'] = yearto
@@ -0,0 +1,49 @@
+import os
+
+import batch_import
+from dpdata import DPData
+import district_data_import
+import equivalence_harness
+
+
+def read_outputs(output_dir):
+    outputs = dict()
+    for filename in sorted(os.listdir(output_dir)):
+        if filename != 'script_output.txt':
+            with open(os.path.join(output_dir, filename)) as outputfile:
+                outputs[filename] = outputfile.read()
+    return outputs
+
+
+def test_copy_is_independent(tmp_path):
+    dp_report, district_data = equivalence_harness.write_synthetic_inputs(str(tmp_path), 2, 20)
+    dp = DPData(dp_report)
+    dp_copy = dp.copy()
+    donor_id = next(iter(dp.get_donors()))['DONOR_ID']
+    dp_copy.get_donor(donor_id)['LAST_NAME'] = 'Changed'
+    dp_copy.get_students_for_donor(donor_id)[0]['GRADE'] = 'ALUM'
+    assert dp_copy.gen_donor_id() == '-1'
+    assert dp.get_donor(donor_id)['LAST_NAME'] != 'Changed'
+    assert dp.get_students_for_donor(donor_id)[0]['GRADE'] != 'ALUM'
+    # The copy's generated ids don't use up the original's
+    assert dp.gen_donor_id() == '-1'
+
+
+def test_jobs_of_a_group_match_separate_runs(tmp_path):
+    dp_report, district_data = equivalence_harness.write_synthetic_inputs(str(tmp_path / 'inputs'), 3, 40)
+    jobs = [{'job': job_number, 'dp_report': dp_report, 'district_data': district_data, 'school_year': 'SY2024-25',
+             'new_year_import': new_year_import, 'split_parents': split_parents, 'output_dir': str(tmp_path / ('job%d' % job_number))}
+            for job_number, (new_year_import, split_parents) in enumerate([(True, False), (False, True), (True, False)], 1)]
+    results = batch_import.run_job_group(jobs)
+    assert [result['STATUS'] for result in results] == ['ok'] * 3
+    # The report is loaded once, for the first job
+    assert 'LOAD_SECONDS' in results[0] and 'LOAD_SECONDS' not in results[1] and 'LOAD_SECONDS' not in results[2]
+
+    for job in jobs:
+        output_dir = str(tmp_path / ('separate%d' % job['job']))
+        os.makedirs(output_dir)
+        dp = DPData(dp_report)
+        dp_messages = district_data_import.run_import(dp, district_data_import.load_district_data(district_data), job['school_year'],
+                                                      job['new_year_import'], job['split_parents'])
+        district_data_import.write_output_files(dp, dp_messages, output_dir)
+        assert read_outputs(job['output_dir']) == read_outputs(output_dir)
@@ -0,0 +1,42 @@
+import os
+import pickle
+
+import pytest
+
+import checkpoint
+from dpdata import DPData
+import equivalence_harness
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    return equivalence_harness.write_synthetic_inputs(str(tmp_path / 'inputs'), 3, 20)
+
+
+@pytest.mark.parametrize('contents', [
+    b'',
+    b'not a pickle',
+    # Truncated
+    pickle.dumps({'stage': 'grades-advanced', 'dp': list(range(100))})[:-20],
+    # A class that was renamed or a module that was removed since the checkpoint was saved
+    b'cdpdata\nOldDPData\n.',
+    b'cno_such_module\nDPData\n.',
+    # Saved state that no longer fits the class it is loaded into
+    b'cbuiltins\nlen\n(I1\nI2\ntR.',
+    pickle.dumps(['not', 'a', 'checkpoint']),
+], ids=['empty', 'garbage', 'truncated', 'renamed-class', 'removed-module', 'incompatible-state', 'not-a-dict'])
+def test_unreadable_checkpoint_is_stale(inputs, tmp_path, contents):
+    checkpoint_dir = str(tmp_path / 'checkpoints')
+    checkpoints = checkpoint.ImportCheckpoints(checkpoint_dir, inputs[0], inputs[1], 'SY2024-25', False, False)
+    dp = DPData(inputs[0])
+    checkpoints.save('loaded', dp, [])
+    checkpoints.save('grades-advanced', dp, [])
+    with open(os.path.join(checkpoint_dir, 'grades-advanced.pickle'), 'wb') as outputfile:
+        outputfile.write(contents)
+
+    assert checkpoints.load('grades-advanced') is None
+    stage, restored_dp, dp_messages = checkpoints.resume('grades-advanced')
+    # The stage is run again from the checkpoint before it
+    assert stage == 'loaded'
+    assert [donor['DONOR_ID'] for donor in restored_dp.get_donors()] == [donor['DONOR_ID'] for donor in dp.get_donors()]
+    assert not os.path.exists(os.path.join(checkpoint_dir, 'grades-advanced.pickle'))
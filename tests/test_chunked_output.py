@@ -0,0 +1,33 @@
+import os
+
+from dpdata import DPData
+import district_data_import
+import utils
+
+
+def write_chunks(directory, rows, chunk_rows):
+    filename = os.path.join(str(directory), '03-donor-updates.csv')
+    utils.ChunkedOutput(chunk_rows=chunk_rows).save_as_csv_chunks(filename, ['DONOR_ID'], [{'DONOR_ID': str(row)} for row in range(rows)])
+    return sorted(os.listdir(str(directory)))
+
+
+def test_chunks_of_a_bigger_run_are_removed(tmp_path):
+    filenames = write_chunks(tmp_path, 1001, 1)
+    assert len(filenames) == 1001 and '03-donor-updates-1001.csv' in filenames
+    assert write_chunks(tmp_path, 3, 1) == ['03-donor-updates-001.csv', '03-donor-updates-002.csv', '03-donor-updates-003.csv']
+
+
+def test_chunked_run_removes_the_unchunked_file(tmp_path):
+    (tmp_path / '03-donor-updates.csv').write_text('DONOR_ID\n1\n')
+    (tmp_path / '03-donor-updates-2024.txt').write_text('notes')
+    assert write_chunks(tmp_path, 2, 5) == ['03-donor-updates-001.csv', '03-donor-updates-2024.txt']
+
+
+def test_unchunked_run_removes_chunks_and_manifest(tmp_path):
+    for filename in [district_data_import.FILENAME_UPLOAD_MANIFEST, '01-student-updates-001.csv', '03-donor-updates-012.csv',
+                     '04-new-donors-1000.csv', 'notes-001.csv']:
+        (tmp_path / filename).write_text('')
+    district_data_import.write_output_files(DPData(None), [], str(tmp_path))
+    assert sorted(os.listdir(str(tmp_path))) == sorted([
+        district_data_import.FILENAME_STUDENT_UPDATES, district_data_import.FILENAME_NEWSTUDENT, district_data_import.FILENAME_DONOR_UPDATES,
+        district_data_import.FILENAME_NEWDONOR, district_data_import.FILENAME_DONOR_UPDATE_MESSAGES, 'notes-001.csv'])
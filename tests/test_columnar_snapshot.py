@@ -0,0 +1,19 @@
+import columnar_snapshot
+
+
+def test_string_ids_and_rows_with(tmp_path):
+    filename = str(tmp_path / 'dp.snapshot')
+    donors = [{'DONOR_ID': '5', 'LAST_NAME': 'Lee'}, {'DONOR_ID': '7', 'LAST_NAME': 'Garcia'}, {'DONOR_ID': '9', 'LAST_NAME': 'Lee'}]
+    students = [{'OTHER_ID': '1', 'DONOR_ID': '5', 'YEARTO': 2019}, {'OTHER_ID': '2', 'DONOR_ID': '9'}]
+    columnar_snapshot.write_snapshot(filename, donors, students)
+    with columnar_snapshot.ColumnarSnapshot(filename) as snapshot:
+        strings = sorted({'1', '2', '5', '7', '9', '2019', 'Lee', 'Garcia'})
+        assert [snapshot.string_id(string) for string in strings] == list(range(len(strings)))
+        # Before, between and after the stored strings
+        assert snapshot.string_id('') is None
+        assert snapshot.string_id('Smith') is None
+        assert snapshot.string_id('zzz') is None
+        assert snapshot.column(columnar_snapshot.TABLE_DONORS, 'LAST_NAME').rows_with('Lee') == [0, 2]
+        assert snapshot.column(columnar_snapshot.TABLE_STUDENTS, 'YEARTO').rows_with(2019) == [0]
+        assert snapshot.column(columnar_snapshot.TABLE_STUDENTS, 'YEARTO').rows_with('2019') == []
+        assert list(snapshot.records(columnar_snapshot.TABLE_STUDENTS)) == students
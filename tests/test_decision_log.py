@@ -0,0 +1,27 @@
+import json
+import sys
+
+import pytest
+
+import district_data_import
+import equivalence_harness
+
+
+def test_log_is_closed_with_its_summary_when_the_import_fails(tmp_path, monkeypatch):
+    dp_report, district_data = equivalence_harness.write_synthetic_inputs(str(tmp_path / 'inputs'), 2, 20)
+    log_filename = str(tmp_path / 'decisions.jsonl')
+
+    def failing_run_import(dp, district_records, *args, **kwargs):
+        kwargs['decision_log'].record('match', 'failing', 0.0)
+        raise RuntimeError("import failed")
+    monkeypatch.setattr(district_data_import, 'run_import', failing_run_import)
+    monkeypatch.setattr(sys, 'argv', ['district_data_import.py', '--dp-report', dp_report, '--district-data', district_data,
+                                      '--school-year', 'SY2024-25', '--mid-year-update', '--decision-log', log_filename])
+    monkeypatch.chdir(str(tmp_path))
+    with pytest.raises(RuntimeError):
+        district_data_import.main()
+
+    with open(log_filename) as logfile:
+        lines = [json.loads(line) for line in logfile]
+    assert lines[0]['rule'] == 'failing'
+    assert [rule['rule'] for rule in lines[-1]['summary']] == ['failing']
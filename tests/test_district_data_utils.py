@@ -0,0 +1,46 @@
+import district_data_utils
+
+
+def district_row(stu_number, **contacts):
+    row = dict.fromkeys(district_data_utils.DISTRICT_DATA_HEADERS, '')
+    row.update({
+        'SystemID': stu_number,
+        'Grade': '3',
+        'Contact 1 First Name': 'Ann',
+        'Contact 1 Last Name': 'Smith',
+        'Contact 1 Relationship': 'Mother',
+        'Contact 1 Street': '1 Main St',
+        'Contact 1 City': 'Springfield',
+        'Contact 1 Email': 'ann@example.com',
+        'Contact 2 First Name': 'Bob',
+        'Contact 2 Last Name': 'Smith',
+        'Contact 2 Relationship': 'Father',
+    })
+    row.update(contacts)
+    return row
+
+
+def test_siblings_share_their_household():
+    households = district_data_utils.DistrictHouseholds()
+    first = households.district_record(district_row('1'))
+    sibling = households.district_record(district_row('2', **{'Grade': '5'}))
+    other = households.district_record(district_row('3', **{'Contact 1 Email': 'ann@example.org'}))
+
+    assert sibling.stu_number == '2' and sibling['Grade'] == '5'
+    assert sibling.contact1 is first.contact1
+    assert sibling.candidate_donorrecord('2024-2025') is first.candidate_donorrecord('2024-2025')
+    assert other.contact1 is not first.contact1
+    assert other.candidate_donorrecord('2024-2025')['EMAIL'] == 'ann@example.org'
+    assert first.candidate_donorrecord('2024-2025')['EMAIL'] == 'ann@example.com'
+
+
+def test_households_match_separate_records():
+    households = district_data_utils.DistrictHouseholds()
+    rows = [district_row('1'), district_row('2'), district_row('3', **{'Contact 2 Street': '9 Elm St'})]
+    for row in rows:
+        grouped = households.district_record(row)
+        alone = district_data_utils.DistrictRecord(row)
+        for use_alternate in (False, True):
+            for swap_parents in (False, True):
+                assert (grouped.candidate_donorrecord('2024-2025', use_alternate, swap_parents)
+                        == alone.candidate_donorrecord('2024-2025', use_alternate, swap_parents))
@@ -0,0 +1,51 @@
+import csv
+import random
+
+import pytest
+
+from dpdata import DP_DONOR_UPDATE_HEADERS, DP_REPORT_271_HEADERS, DPData
+import dp_data_scrubber
+import equivalence_harness
+import external_sort
+import utils
+
+
+@pytest.fixture
+def dp_report(tmp_path):
+    dp_report, district_data = equivalence_harness.write_synthetic_inputs(str(tmp_path / 'inputs'), 4, 150)
+    return dp_report
+
+
+def shuffled_report(dp_report, filename):
+    """A copy of dp_report with its rows in random order, so most donors' rows are no longer together"""
+    with open(dp_report, newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        headers = reader.fieldnames
+        rows = list(reader)
+    random.Random(2).shuffle(rows)
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, headers)
+        writer.writeheader()
+        writer.writerows(rows)
+    return filename
+
+
+@pytest.mark.parametrize('new_year', [False, True])
+@pytest.mark.parametrize('shuffled', [False, True])
+def test_streaming_scrub_matches_dpdata_scrub(dp_report, tmp_path, new_year, shuffled):
+    # As the scrubber did before streaming: load everything into DPData and scrub that
+    dp = DPData(dp_report)
+    dp.scrub_data(new_year)
+    expected_count = dp.write_updated_donors_file(str(tmp_path / 'expected.csv'))
+    assert expected_count > 0
+
+    if shuffled:
+        dp_report = shuffled_report(dp_report, str(tmp_path / 'shuffled.csv'))
+        with pytest.raises(ValueError):
+            list(dp_data_scrubber.group_rows_by_donor(utils.iter_csv_file(dp_report, DP_REPORT_271_HEADERS)))
+    # Small runs, so a shuffled report is sorted through several files on disk
+    rows = external_sort.sorted_csv_rows(dp_report, 'DONOR_ID', DP_REPORT_271_HEADERS, rows_per_run=25, temp_dir=str(tmp_path))
+    count = utils.save_as_csv_rows(str(tmp_path / 'streamed.csv'), DP_DONOR_UPDATE_HEADERS,
+                                   dp_data_scrubber.scrub_report_rows(rows, new_year))
+    assert count == expected_count
+    assert equivalence_harness.compare_csv_files(str(tmp_path / 'expected.csv'), str(tmp_path / 'streamed.csv')) == []
@@ -0,0 +1,63 @@
+import pytest
+
+from dpdata import DPData
+import district_data_import
+import equivalence_harness
+
+
+def make_dp():
+    dp = DPData(None)
+    for donor_id, home_school in [('1', 'HOO'), ('2', 'BIS')]:
+        dp.add_donor({'DONOR_ID': donor_id, 'HOME_SCHOOL': home_school, 'NOMAIL': 'N'})
+    students = [('1', '10', '3', 'HOOVER', ''), ('1', '11', 'ALUM', 'ALUM', 2019),
+                ('2', '12', '8', 'BIS', ''), ('2', '13', 0, 'BIS', 2019)]
+    for other_id, (donor_id, stu_number, grade, school, yearto) in enumerate(students, 1):
+        dp.add_student({'DONOR_ID': donor_id, 'STU_NUMBER': stu_number, 'GRADE': grade, 'SCHOOL': school,
+                        'OTHER_ID': str(other_id), 'YEARTO': yearto})
+    return dp.snapshot().query()
+
+
+def stu_numbers(records):
+    return sorted(record['STU_NUMBER'] for record in records)
+
+
+def test_numeric_fields_match_strings_and_ints():
+    query = make_dp()
+    assert stu_numbers(query.students_where(YEARTO='2019')) == ['11', '13']
+    assert stu_numbers(query.students_where(YEARTO=2019)) == ['11', '13']
+    assert stu_numbers(query.students_where(GRADE='0')) == ['13']
+    assert stu_numbers(query.students_where(GRADE='ALUM')) == ['11']
+    assert query.count_students_where('YEARTO', '2019') == 2
+
+
+def test_range_queries():
+    query = make_dp()
+    assert stu_numbers(query.students_between('GRADE', '0', 5)) == ['10', '13']
+    assert stu_numbers(query.students_between('GRADE', low=4)) == ['12']
+    assert [record['DONOR_ID'] for record in query.donors_between('HOME_SCHOOL', 'C', 'Z')] == ['1']
+
+
+def test_bad_bounds_and_fields_are_value_errors():
+    query = make_dp()
+    with pytest.raises(ValueError, match='GRADE'):
+        query.students_between('GRADE', 'K', '5')
+    with pytest.raises(ValueError, match='HOME_SCHOOL'):
+        query.donors_between('HOME_SCHOOL', 1, 5)
+    with pytest.raises(ValueError, match='Unknown student field'):
+        query.students_where(FOO='1')
+    with pytest.raises(ValueError, match='Unknown donor field'):
+        query.donors_between('FOO', 1, 5)
+
+
+def test_snapshot_after_an_import(tmp_path):
+    dp_report, district_data = equivalence_harness.write_synthetic_inputs(str(tmp_path), 3, 40)
+    dp = DPData(dp_report)
+    district_data_import.run_import(dp, district_data_import.load_district_data(district_data), 'SY2024-25', True, False)
+    query = dp.snapshot().query()
+    students = list(dp.snapshot().get_students())
+    new_students = [record for record in students if 'YEARTO' not in record]
+    assert new_students
+    with_yearto = [record for record in students if record.get('YEARTO') not in (None, '')]
+    assert stu_numbers(query.students_between('YEARTO', 2000, 2030)) == stu_numbers(with_yearto)
+    assert len(query.students_where(YEARTO='')) == len(students) - len(with_yearto)
+    assert stu_numbers(query.students_where(YEARTO=2019)) == stu_numbers(record for record in with_yearto if int(record['YEARTO']) == 2019)
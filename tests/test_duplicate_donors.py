@@ -0,0 +1,53 @@
+from dpdata import DPData, DP_REPORT_271_DONOR_HEADERS
+import duplicate_donors
+
+
+def dp_with_donors(*donors):
+    dp = DPData(None)
+    for donor_id, fields in enumerate(donors, 1):
+        donorrecord = dict((header, '') for header in DP_REPORT_271_DONOR_HEADERS)
+        donorrecord.update({'DONOR_ID': str(donor_id), 'FIRST_NAME': 'First%d' % donor_id, 'LAST_NAME': 'Last%d' % donor_id})
+        donorrecord.update(fields)
+        dp.add_donor(donorrecord)
+    return dp
+
+
+def test_normalize_phone():
+    assert duplicate_donors.normalize_phone('(650) 555-0100') == '6505550100'
+    assert duplicate_donors.normalize_phone('+1 650.555.0100') == '6505550100'
+    assert duplicate_donors.normalize_phone('555-01') == ''
+    assert duplicate_donors.normalize_phone('') == ''
+
+
+def test_blocking_keys_normalize_emails_and_phones():
+    dp = dp_with_donors({'EMAIL': ' Jane@Example.com ', 'SPOUSE_EMAIL': '', 'MOBILE_PHONE': '650-555-0100', 'HOME_PHONE': '123'})
+    keys = duplicate_donors.blocking_keys(dp, dp.get_donor('1'))
+    assert ('email', 'jane@example.com') in keys
+    assert ('phone', '6505550100') in keys
+    assert [kind for kind, value in keys].count('phone') == 1
+    assert 'address' not in [kind for kind, value in keys]
+
+
+def test_clusters_are_transitive():
+    # 1 and 2 share an email, 2 and 3 a phone: all three are one cluster; 4 shares nothing
+    dp = dp_with_donors({'EMAIL': 'a@example.com'},
+                        {'SPOUSE_EMAIL': 'A@example.com ', 'HOME_PHONE': '650 555 0100'},
+                        {'MOBILE_PHONE': '(650) 555-0100'},
+                        {'EMAIL': 'b@example.com'})
+    clusters, skipped_blocks = duplicate_donors.find_duplicate_clusters(dp)
+    assert skipped_blocks == []
+    assert len(clusters) == 1
+    score, donor_ids, evidence = clusters[0]
+    assert donor_ids == ['1', '2', '3']
+    assert evidence == {'email': ['a@example.com'], 'phone': ['6505550100']}
+    # An email (3) and a phone (2) for two joins
+    assert score == 2.5
+
+
+def test_blocks_above_max_block_size_are_skipped():
+    # A shared office phone joins nobody, the shared email still does
+    dp = dp_with_donors(*([{'HOME_PHONE': '650-555-0199'}] * 4 + [{'HOME_PHONE': '650-555-0199', 'EMAIL': 'c@example.com'},
+                                                                {'EMAIL': 'c@example.com'}]))
+    clusters, skipped_blocks = duplicate_donors.find_duplicate_clusters(dp, max_block_size=3)
+    assert skipped_blocks == [('phone', '6505550199', 5)]
+    assert [donor_ids for score, donor_ids, evidence in clusters] == [['5', '6']]
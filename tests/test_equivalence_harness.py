@@ -0,0 +1,30 @@
+import csv
+
+import equivalence_harness
+
+
+def test_synthetic_ids_are_unique_for_many_families(tmp_path):
+    dp_report, district_data = equivalence_harness.write_synthetic_inputs(str(tmp_path), 1, 3500)
+    with open(dp_report, newline='') as csvfile:
+        dp_rows = list(csv.DictReader(csvfile))
+    with open(district_data, newline='') as csvfile:
+        district_rows = list(csv.DictReader(csvfile))
+    # Every donor has one set of donor fields, and a student number belongs to one student
+    donor_names = dict()
+    students = dict()
+    for row in dp_rows:
+        assert donor_names.setdefault(row['DONOR_ID'], (row['FIRST_NAME'], row['LAST_NAME'])) == (row['FIRST_NAME'], row['LAST_NAME'])
+        assert students.setdefault((row['STU_NUMBER'], row['DONOR_ID']), row['STU_FNAME']) == row['STU_FNAME']
+    assert not set(donor_names) & {row['STU_NUMBER'] for row in dp_rows}
+    system_ids = [row['SystemID'] for row in district_rows]
+    assert len(system_ids) == len(set(system_ids))
+
+
+def test_failing_engine_is_a_failed_case(tmp_path):
+    dp_report, district_data = equivalence_harness.write_synthetic_inputs(str(tmp_path / 'inputs'), 1, 20)
+    engine = equivalence_harness.Engine('baseline', equivalence_harness.__file__.replace('equivalence_harness', 'district_data_import'), [])
+    broken = equivalence_harness.Engine('candidate', engine.script, ['--no-such-option'])
+    baseline_seconds, candidate_seconds, differences = equivalence_harness.run_case(
+        engine, broken, dp_report, district_data, ['--school-year', 'SY2024-25', '--mid-year-update'], str(tmp_path / 'case'), 1)
+    assert baseline_seconds is not None and candidate_seconds is None
+    assert list(differences) == ['candidate run']
@@ -0,0 +1,79 @@
+import csv
+import os
+import random
+
+import pytest
+
+import external_sort
+
+
+def write_csv(filename, headers, rows):
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(headers)
+        writer.writerows(rows)
+    return filename
+
+
+@pytest.fixture
+def shuffled_file(tmp_path):
+    # Several rows per key, numbered in file order, to check that the sort is stable
+    rng = random.Random(1)
+    keys = [str(rng.randint(1, 30)) for _ in range(60)] + ['', 'abc', '-4']
+    rng.shuffle(keys)
+    return write_csv(str(tmp_path / 'input.csv'), ['DONOR_ID', 'LINE'], [(key, str(line)) for line, key in enumerate(keys)])
+
+
+@pytest.fixture
+def written_runs(monkeypatch):
+    """The number of rows of each run written to disk"""
+    runs = []
+    write_run = external_sort._write_run
+
+    def counting_write_run(directory, headers, rows):
+        rows = list(rows)
+        runs.append(len(rows))
+        return write_run(directory, headers, rows)
+    monkeypatch.setattr(external_sort, '_write_run', counting_write_run)
+    return runs
+
+
+def expected_order(filename):
+    with open(filename, newline='') as csvfile:
+        rows = list(csv.DictReader(csvfile))
+    return sorted(rows, key=lambda row: external_sort.sort_key(row['DONOR_ID']))
+
+
+def test_sort_key_orders_numbers_first_then_text():
+    values = ['10', 'abc', '9', '', '-1', '2', 'ABC']
+    assert sorted(values, key=external_sort.sort_key) == ['-1', '2', '9', '10', '', 'ABC', 'abc']
+
+
+def test_sorts_in_runs_of_rows_per_run(shuffled_file, written_runs, tmp_path):
+    rows = list(external_sort.sorted_csv_rows(shuffled_file, 'DONOR_ID', rows_per_run=10, temp_dir=str(tmp_path)))
+    assert rows == expected_order(shuffled_file)
+    assert written_runs == [10, 10, 10, 10, 10, 10, 3]
+    # The runs are removed afterwards
+    assert not [name for name in os.listdir(str(tmp_path)) if name.startswith('external-sort-')]
+
+
+def test_merges_in_several_passes_above_the_fan_in(shuffled_file, written_runs, monkeypatch):
+    monkeypatch.setattr(external_sort, 'MAX_MERGE_FAN_IN', 3)
+    rows = list(external_sort.sorted_csv_rows(shuffled_file, 'DONOR_ID', rows_per_run=4))
+    assert rows == expected_order(shuffled_file)
+    # 16 runs, merged into 6 and then 2 intermediate runs before the final merge
+    assert len(written_runs) == 16 + 6 + 2
+    assert written_runs[16:] == [12, 12, 12, 12, 12, 3, 36, 27]
+
+
+def test_sorted_file_is_streamed_without_runs(tmp_path, written_runs):
+    filename = write_csv(str(tmp_path / 'sorted.csv'), ['DONOR_ID', 'LINE'], [('2', '0'), ('2', '1'), ('10', '2'), ('x', '3')])
+    assert external_sort.is_sorted_csv_file(filename, 'DONOR_ID')
+    rows = list(external_sort.sorted_csv_rows(filename, 'DONOR_ID', rows_per_run=1))
+    assert [row['LINE'] for row in rows] == ['0', '1', '2', '3']
+    assert written_runs == []
+
+
+def test_unsorted_file_is_detected(tmp_path):
+    filename = write_csv(str(tmp_path / 'unsorted.csv'), ['DONOR_ID'], [('9',), ('10',), ('x',), ('3',)])
+    assert not external_sort.is_sorted_csv_file(filename, 'DONOR_ID')
@@ -0,0 +1,62 @@
+from concurrent.futures import ThreadPoolExecutor
+import pickle
+
+from dpdata import DPData
+from id_allocator import IdAllocator
+
+
+def test_single_thread_counts_up():
+    allocator = IdAllocator(block_size=4)
+    assert [allocator.next_value('DONOR_ID') for _ in range(6)] == [1, 2, 3, 4, 5, 6]
+    assert allocator.next_value('OTHER_ID') == 1
+
+
+def test_threads_never_share_values():
+    allocator = IdAllocator(block_size=8)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        blocks = list(executor.map(lambda _: [allocator.next_value('DONOR_ID') for _ in range(100)], range(8)))
+    values = [value for block in blocks for value in block]
+    assert len(values) == len(set(values)) == 800
+
+
+def test_reset_applies_to_every_thread():
+    allocator = IdAllocator(block_size=16)
+    with ThreadPoolExecutor(max_workers=1) as worker:
+        assert worker.submit(allocator.next_value, 'DONOR_ID').result() == 1
+        assert allocator.next_value('DONOR_ID') == 17
+        allocator.reset('DONOR_ID', 100)
+        # Neither thread carries on in the block it had before the reset
+        assert worker.submit(allocator.next_value, 'DONOR_ID').result() == 101
+        assert allocator.next_value('DONOR_ID') == 117
+
+
+def test_pickle_keeps_the_remaining_block():
+    allocator = IdAllocator(block_size=16)
+    allocator.next_value('OTHER_ID')
+    restored = pickle.loads(pickle.dumps(allocator))
+    assert [restored.next_value('OTHER_ID') for _ in range(2)] == [2, 3]
+
+
+def test_renumber_generated_ids_after_concurrent_creation():
+    dp = DPData(None, IdAllocator(block_size=4))
+
+    def create_donor(name):
+        donorrecord = {'DONOR_ID': dp.gen_donor_id(), 'LAST_NAME': name, 'FIRST_NAME': ''}
+        studentrecord = dict(donorrecord, OTHER_ID=dp.gen_other_id(), STU_NUMBER=name)
+        return donorrecord, studentrecord
+
+    names = ['Donor%d' % i for i in range(10)]
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        created = list(executor.map(create_donor, names))
+    # Merge in a deterministic order
+    for donorrecord, studentrecord in created:
+        dp.add_donor(donorrecord)
+        dp.add_student(studentrecord)
+    dp.renumber_generated_ids()
+
+    assert [donorrecord['DONOR_ID'] for donorrecord in dp.get_donors()] == [str(-i) for i in range(1, 11)]
+    assert [studentrecord['OTHER_ID'] for studentrecord in dp.get_students()] == [str(-i) for i in range(1, 11)]
+    for donorrecord in dp.get_donors():
+        assert [studentrecord['STU_NUMBER'] for studentrecord in dp.get_students_for_donor(donorrecord['DONOR_ID'])] == \
+            [donorrecord['LAST_NAME']]
+    assert dp.gen_donor_id() == '-11'
@@ -0,0 +1,71 @@
+import csv
+
+import pytest
+
+from dpdata import DPData
+import district_data_import
+import equivalence_harness
+import input_validator
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    equivalence_harness.write_synthetic_inputs(str(tmp_path), 4, 50)
+    return str(tmp_path / 'dp.csv'), str(tmp_path / 'district.csv')
+
+
+def rewrite_rows(filename, changes):
+    """Set row[column] = value for each (row index, column, value) in changes"""
+    with open(filename, newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        fieldnames = reader.fieldnames
+        rows = list(reader)
+    for index, column, value in changes:
+        rows[index][column] = value
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def load(dp_report, district_data):
+    with input_validator.validating(dp_report, district_data) as validation:
+        DPData(dp_report, row_check=validation.dp_report_row_check)
+        district_data_import.load_district_data(district_data, validation.district_data_row_check)
+    return validation.report
+
+
+def test_rows_are_checked_while_loading(inputs):
+    dp_report, district_data = inputs
+    rewrite_rows(district_data, [(0, 'Contact 1 Email', '#N/A')])
+    report = load(dp_report, district_data)
+    assert [(problem.line, problem.column) for problem in report.warnings()] == [(2, 'Contact 1 Email')]
+    # The same as validating the files on their own
+    separate_report = input_validator.ValidationReport()
+    input_validator.validate_dp_report(separate_report, dp_report)
+    input_validator.validate_district_data(separate_report, district_data)
+    assert report.problems == separate_report.problems
+
+
+def test_load_failure_reports_every_problem(inputs, capsys):
+    dp_report, district_data = inputs
+    rewrite_rows(dp_report, [(3, 'YEARTO', 'soon')])
+    rewrite_rows(district_data, [(1, 'School', 'Nowhere'), (2, 'Grade', 'ZZ')])
+    with pytest.raises(SystemExit) as exit_info:
+        load(dp_report, district_data)
+    assert exit_info.value.code == 1
+    output = capsys.readouterr().out
+    assert "3 error(s)" in output
+    assert "[YEARTO='soon']" in output and "[School='Nowhere']" in output and "[Grade='ZZ']" in output
+
+
+def test_overlong_row_is_a_warning(inputs):
+    dp_report, district_data = inputs
+    with open(district_data) as csvfile:
+        lines = csvfile.read().splitlines()
+    lines[2] += ',extra,-'
+    with open(district_data, 'w') as csvfile:
+        csvfile.write('\n'.join(lines) + '\n')
+    report = load(dp_report, district_data)
+    assert report.errors() == []
+    assert [(problem.line, problem.message) for problem in report.warnings()] == [(3, "2 cell(s) more than there are headers, ignored")]
@@ -0,0 +1,107 @@
+import asyncio
+import csv
+import json
+
+import pytest
+
+from dpdata import DP_REPORT_271_HEADERS, DPData
+import district_data_utils
+from lookup_service import DonorLookupIndex, LookupService
+import utils
+
+
+def dp_row(donor_id, other_id, stu_number, first_name, last_name, email, address, nomail='N'):
+    row = dict.fromkeys(DP_REPORT_271_HEADERS, '')
+    row.update({'DONOR_ID': donor_id, 'OTHER_ID': other_id, 'STU_NUMBER': stu_number, 'FIRST_NAME': first_name,
+                'LAST_NAME': last_name, 'EMAIL': email, 'ADDRESS': address, 'ZIP': '94010', 'NOMAIL': nomail,
+                'STU_FNAME': 'Kid', 'STU_LNAME': last_name, 'GRADE': '3'})
+    return row
+
+
+def district_row(stu_number, first_name, last_name, address):
+    row = dict.fromkeys(district_data_utils.DISTRICT_DATA_HEADERS, '')
+    row.update({'SystemID': stu_number, 'Student First Name': 'Kid', 'Student Last Name': last_name, 'Grade': '2',
+                'School': 'LINCOLN', 'Contact 1 First Name': first_name, 'Contact 1 Last Name': last_name,
+                'Contact 1 Relationship': 'Father', 'Contact 1 Street': address, 'Contact 1 City': 'Burlingame',
+                'Contact 1 State': 'CA', 'Contact 1 Zip': '94010'})
+    return row
+
+
+@pytest.fixture
+def index(tmp_path):
+    dp_report = str(tmp_path / 'dp.csv')
+    with open(dp_report, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, DP_REPORT_271_HEADERS)
+        writer.writeheader()
+        writer.writerow(dp_row('100', '500', '9001', 'John', 'Smith', 'John.Smith@Example.com', '1 Main St'))
+        writer.writerow(dp_row('101', '501', '9002', 'Mary', 'Jones', '', '9 Elm St', nomail='Y'))
+    return DonorLookupIndex(DPData(dp_report), 'SY2024-25')
+
+
+def donor_ids(donors):
+    return [donor['DONOR_ID'] for donor in donors]
+
+
+def test_find_donors_by_each_key(index):
+    john = index.dp.get_donor('100')
+    assert donor_ids(index.find_donors({'donor_id': '100'})) == ['100']
+    assert donor_ids(index.find_donors({'donor_id': '999'})) == []
+    assert donor_ids(index.find_donors({'match_key': index.dp.compute_match_key(john)})) == ['100']
+    assert donor_ids(index.find_donors({'last_name': ' smith', 'first_name': 'JOHN'})) == ['100']
+    assert donor_ids(index.find_donors({'last_name': 'Jones'})) == ['101']
+    assert donor_ids(index.find_donors({'email': 'john.smith@example.com'})) == ['100']
+    assert donor_ids(index.find_donors({'address_key': utils.address_key('9 Elm St', '94010')})) == ['101']
+    assert donor_ids(index.find_donors({'address': '1 Main St', 'zip': '94010'})) == ['100']
+    # The students come along with the donor
+    assert [student['STU_NUMBER'] for student in index.find_donors({'donor_id': '100'})[0]['students']] == ['9001']
+    with pytest.raises(ValueError):
+        index.find_donors({'zip': '94010'})
+
+
+def test_explain_returning_student(index):
+    result = index.explain_district_record(district_row('9001', 'John', 'Smith', '1 Main St'))
+    assert result['rule'] == 'existing-student'
+    assert donor_ids(result['donors']) == ['100']
+
+
+def test_explain_new_student(index):
+    # A new sibling in an existing family matches the donor
+    result = index.explain_district_record(district_row('9003', 'John', 'Smith', '1 Main St'))
+    assert result['rule'] == 'match'
+    assert donor_ids(result['donors']) == ['100']
+    # A new family gets a new donor
+    result = index.explain_district_record(district_row('9004', 'Ann', 'Lee', '5 Oak St'))
+    assert result['rule'] == 'new-donor'
+    assert [(donor['FIRST_NAME'], donor['LAST_NAME']) for donor in result['new_donors']] == [('Ann', 'Lee')]
+
+
+def request(service, method, path, body=b''):
+    """Send one request to service over a real connection, returning (status, decoded json)"""
+    async def exchange():
+        server = await asyncio.start_server(service.serve_connection, '127.0.0.1', 0)
+        async with server:
+            reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+            writer.write(('%s %s HTTP/1.1\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % (method, path, len(body))).encode('latin-1') + body)
+            response = await reader.read()
+            writer.close()
+        return response
+    head, _, payload = asyncio.run(exchange()).partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(payload.decode('utf-8'))
+
+
+def test_http_status_codes(index):
+    service = LookupService(index)
+    status, result = request(service, 'GET', '/donors?last_name=Smith&first_name=John')
+    assert status == 200 and donor_ids(result) == ['100']
+    status, result = request(service, 'POST', '/district-row', json.dumps(district_row('9001', 'John', 'Smith', '1 Main St')).encode('utf-8'))
+    assert status == 200 and result['rule'] == 'existing-student'
+    # Bad requests
+    assert request(service, 'GET', '/donors')[0] == 400
+    assert request(service, 'GET', '/students')[0] == 400
+    for body in [b'[1, 2]', b'"SystemID"', b'42', b'{"SystemID": 9001}', b'{not json']:
+        status, result = request(service, 'POST', '/district-row', body)
+        assert status == 400, body
+    # Unknown paths and wrong methods
+    assert request(service, 'GET', '/nothing-here')[0] == 404
+    assert request(service, 'POST', '/donors')[0] == 404
+    assert request(service, 'GET', '/district-row')[0] == 405
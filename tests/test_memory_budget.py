@@ -0,0 +1,117 @@
+from collections import OrderedDict
+import os
+import sys
+import tempfile
+
+import pytest
+
+import checkpoint
+from dpdata import DPData
+import district_data_import
+import equivalence_harness
+import memory_budget
+from memory_budget import MemoryBudget, SpilledRecords
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    return equivalence_harness.write_synthetic_inputs(str(tmp_path / 'inputs'), 2, 100)
+
+
+@pytest.fixture
+def budget(tmp_path):
+    # Always over a limit of one byte, so everything is spilled
+    with MemoryBudget(1, temp_dir=str(tmp_path)) as budget:
+        yield budget
+
+
+def import_outputs(dp, district_data, output_dir):
+    district_records = district_data_import.load_district_data(district_data)
+    dp_messages = district_data_import.run_import(dp, district_records, 'SY2024-25', False, False)
+    os.makedirs(output_dir)
+    district_data_import.write_output_files(dp, dp_messages, output_dir)
+    outputs = dict()
+    for filename in sorted(os.listdir(output_dir)):
+        with open(os.path.join(output_dir, filename)) as outputfile:
+            outputs[filename] = outputfile.read()
+    return outputs
+
+
+def unmodified_records(dp):
+    return dp._DPData__unmodified_donorrecords, dp._DPData__unmodified_studentrecords
+
+
+def test_parse_size():
+    assert memory_budget.parse_size('512M') == 512 * 1024 ** 2
+    assert memory_budget.parse_size('1.5g') == int(1.5 * 1024 ** 3)
+    assert memory_budget.parse_size('1500000') == 1500000
+    with pytest.raises(ValueError):
+        memory_budget.parse_size('lots')
+
+
+def test_no_spilling_below_the_limit(inputs, tmp_path):
+    with MemoryBudget(1024 ** 4, temp_dir=str(tmp_path)) as budget:
+        dp = DPData(inputs[0], memory_budget=budget)
+        assert not budget.check(dp)
+    assert all(isinstance(records, OrderedDict) for records in unmodified_records(dp))
+
+
+def test_spilled_import_has_the_same_outputs(inputs, budget, tmp_path):
+    dp = DPData(inputs[0], memory_budget=budget)
+    assert budget.spilling
+    assert all(isinstance(records, SpilledRecords) for records in unmodified_records(dp))
+    expected = import_outputs(DPData(inputs[0]), inputs[1], str(tmp_path / 'expected'))
+    assert import_outputs(dp, inputs[1], str(tmp_path / 'spilled')) == expected
+
+
+def test_records_loaded_in_memory_are_moved_when_spilling(inputs, budget):
+    dp = DPData(inputs[0])
+    donorrecords, studentrecords = [dict(records) for records in unmodified_records(dp)]
+    budget.check(dp)
+    assert [dict(records.items()) for records in unmodified_records(dp)] == [donorrecords, studentrecords]
+
+
+def test_copy_copies_the_spill_files(inputs, budget):
+    dp = DPData(inputs[0], memory_budget=budget)
+    dp_copy = dp.copy()
+    for records, copied_records in zip(unmodified_records(dp), unmodified_records(dp_copy)):
+        assert isinstance(copied_records, SpilledRecords)
+        assert copied_records.filename != records.filename
+        assert list(copied_records.items()) == list(records.items())
+
+
+def test_checkpoints_keep_spilled_records_on_disk(inputs, budget, tmp_path):
+    checkpoint_dir = str(tmp_path / 'checkpoints')
+    dp = DPData(inputs[0], memory_budget=budget)
+    checkpoints = checkpoint.ImportCheckpoints(checkpoint_dir, inputs[0], inputs[1], 'SY2024-25', False, False, budget=budget)
+    checkpoints.save('loaded', dp, [])
+    assert sorted(name for name in os.listdir(checkpoint_dir) if name.endswith('.sqlite')) == \
+        ['loaded-unmodified-donors-0.sqlite', 'loaded-unmodified-students-1.sqlite']
+
+    expected = [list(records.items()) for records in unmodified_records(dp)]
+    restored_dp, dp_messages = checkpoints.load('loaded')
+    assert all(isinstance(records, SpilledRecords) for records in unmodified_records(restored_dp))
+    assert [list(records.items()) for records in unmodified_records(restored_dp)] == expected
+
+    # Without a memory limit the records are restored into memory
+    checkpoints = checkpoint.ImportCheckpoints(checkpoint_dir, inputs[0], inputs[1], 'SY2024-25', False, False)
+    restored_dp, dp_messages = checkpoints.load('loaded')
+    assert [list(records.items()) for records in unmodified_records(restored_dp)] == expected
+    assert all(isinstance(records, OrderedDict) for records in unmodified_records(restored_dp))
+
+
+def test_spill_directory_is_removed_when_the_import_fails(inputs, tmp_path, monkeypatch):
+    spill_parent = tmp_path / 'spill'
+    spill_parent.mkdir()
+    monkeypatch.setattr(tempfile, 'tempdir', str(spill_parent))
+
+    def failing_run_import(dp, *args, **kwargs):
+        assert os.listdir(str(spill_parent))
+        raise RuntimeError("import failed")
+    monkeypatch.setattr(district_data_import, 'run_import', failing_run_import)
+    monkeypatch.setattr(sys, 'argv', ['district_data_import.py', '--dp-report', inputs[0], '--district-data', inputs[1],
+                                      '--school-year', 'SY2024-25', '--mid-year-update', '--memory-limit', '1'])
+    monkeypatch.chdir(str(tmp_path))
+    with pytest.raises(RuntimeError):
+        district_data_import.main()
+    assert os.listdir(str(spill_parent)) == []
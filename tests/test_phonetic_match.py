@@ -0,0 +1,25 @@
+from dpdata import DPData
+import district_data_import
+import equivalence_harness
+
+
+def test_names_are_indexed_only_for_phonetic_matching(tmp_path):
+    dp_report, district_data = equivalence_harness.write_synthetic_inputs(str(tmp_path), 5, 40)
+    dp = DPData(dp_report)
+    district_data_import.run_import(dp, district_data_import.load_district_data(district_data), 'SY2024-25', False, False)
+    assert dp._DPData__phonetic_name_to_donor_ids is None
+
+    dp = DPData(dp_report)
+    district_data_import.run_import(dp, district_data_import.load_district_data(district_data), 'SY2024-25', False, False,
+                                    phonetic_match=True)
+    assert dp._DPData__phonetic_name_to_donor_ids is not None
+
+
+def test_matches_donors_added_before_and_after_the_first_lookup():
+    dp = DPData(None)
+    dp.add_donor({'DONOR_ID': '1', 'FIRST_NAME': 'Jon', 'LAST_NAME': 'Schmitt'})
+    dp.add_donor({'DONOR_ID': '2', 'FIRST_NAME': 'Mary', 'LAST_NAME': 'Jones', 'SP_FNAME': 'Peter', 'SP_LNAME': 'Brown'})
+    assert [donor['DONOR_ID'] for donor in dp.find_phonetic_matches('Schmidt', 'John')] == ['1']
+    dp.add_donor({'DONOR_ID': '3', 'FIRST_NAME': 'Johnny', 'LAST_NAME': 'Schmid'})
+    assert [donor['DONOR_ID'] for donor in dp.find_phonetic_matches('Schmidt', 'John')] == ['1', '3']
+    assert [donor['DONOR_ID'] for donor in dp.find_phonetic_matches('Braun', 'Pieter')] == ['2']
@@ -0,0 +1,58 @@
+import os
+
+import district_data_import
+import equivalence_harness
+import watch_import
+
+
+def read_outputs(output_dir):
+    outputs = dict()
+    for filename in os.listdir(output_dir):
+        with open(os.path.join(output_dir, filename)) as outputfile:
+            outputs[filename] = outputfile.read()
+    return outputs
+
+
+def test_changed_district_file_is_run_once_and_replaces_the_outputs(tmp_path, monkeypatch):
+    dp_report, district_data = equivalence_harness.write_synthetic_inputs(str(tmp_path / 'inputs'), 2, 30)
+    watch_dir = tmp_path / 'watch'
+    watch_dir.mkdir()
+    with open(district_data) as csvfile:
+        lines = csvfile.read().splitlines(True)
+    (watch_dir / 'district.csv').write_text(''.join(lines[:-5]))
+
+    runs = []
+    run_import = district_data_import.run_import
+
+    def counting_run_import(*args, **kwargs):
+        runs.append(args[1])
+        return run_import(*args, **kwargs)
+    monkeypatch.setattr(district_data_import, 'run_import', counting_run_import)
+    replaced = []
+    os_replace = os.replace
+
+    def recording_replace(source, destination):
+        replaced.append(os.path.basename(destination))
+        os_replace(source, destination)
+    monkeypatch.setattr(os, 'replace', recording_replace)
+
+    output_dir = tmp_path / 'output'
+    watcher = watch_import.ImportWatcher(dp_report, str(watch_dir), str(output_dir), 'SY2024-25', False, False)
+    # A new file is run once it has been stable for a poll
+    watcher.poll()
+    assert runs == []
+    watcher.poll()
+    watcher.poll()
+    assert len(runs) == 1
+    first_outputs = read_outputs(str(output_dir / 'district'))
+
+    (watch_dir / 'district.csv').write_text(''.join(lines))
+    replaced.clear()
+    watcher.poll()
+    watcher.poll()
+    watcher.poll()
+    assert len(runs) == 2 and len(runs[1]) == len(runs[0]) + 5
+    assert read_outputs(str(output_dir / 'district')) != first_outputs
+    # Every output file was written to a temp file and renamed over the previous one
+    assert sorted(replaced) == sorted(first_outputs)
+    assert not [filename for filename in os.listdir(str(output_dir / 'district')) if filename.endswith('.tmp')]
@@ -1,9 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 import csv
 import datetime
+import functools
+import hashlib
+import operator
+import os
+import re
 import sys
 
 TODAY_STR = datetime.date.today().strftime('%m/%d/%Y')
 
+# Spaces and dashes are dropped when comparing names and addresses, as they vary a lot between sources
+KEY_PART_DELETIONS = str.maketrans('', '', ' -')
+# Entries per memoized key function: about the distinct names and addresses of a large district's import, and
+# bounded so long-running processes (e.g. lookup_service.py, watch_import.py) don't grow without limit
+KEY_CACHE_SIZE = 2 ** 16
+
 
 def validate_headers(filename, expected, actual):
     expected_set = set(expected)
@@ -18,58 +31,231 @@ def validate_headers(filename, expected, actual):
         sys.exit(1)
 
 
-def load_csv_file(filename, expected_headers):
+def iter_csv_file(filename, expected_headers, row_check=None):
+    """Like load_csv_file, but yields the rows one at a time instead of reading them all into memory"""
     if not filename.endswith('.csv'):
         print("%s must be a csv file" % (filename))
         sys.exit(1)
-    res = []
+    count = 0
     with open(filename, 'r') as csvfile:
         reader = csv.DictReader(csvfile)
         validate_headers(filename, expected_headers, reader.fieldnames)
         for row in reader:
-            res.append(row)
-    print("    %s: Number of input records read = %d" % (filename, len(res)))
-    return res
+            count += 1
+            if row_check is not None:
+                row_check(reader.line_num, row)
+            yield row
+    print("    %s: Number of input records read = %d" % (filename, count))
+
+
+def load_csv_file(filename, expected_headers, row_check=None):
+    """The rows of a csv file as dicts, after checking it has the expected headers. row_check(line, row) is
+    called for every row as it is read, e.g. to validate the rows in the same pass (see input_validator)."""
+    return list(iter_csv_file(filename, expected_headers, row_check))
+
 
+@contextlib.contextmanager
+def atomic_open(filename, mode='w'):
+    """Open filename for writing. The data goes to a temp file that only replaces filename once fully written,
+    so readers never see a partially written file."""
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    try:
+        with open(tmp_filename, mode) as outputfile:
+            yield outputfile
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
 
-def save_as_csv_file(filename, header_fields, data):
-    with open(filename, 'w') as outputfile:
+
+def _csv_row_writer(outputfile, header_fields, dict_rows):
+    """Writes the header row and returns the function that writes a data row, either a dict (as csv.DictWriter)
+    or a sequence of values in header_fields order (as csv.writer)"""
+    if dict_rows:
         writer = csv.DictWriter(outputfile, header_fields)
         writer.writeheader()
+    else:
+        writer = csv.writer(outputfile)
+        writer.writerow(header_fields)
+    return writer.writerow
+
+
+def save_as_csv_file(filename, header_fields, data, chunked_output=None, dict_rows=True):
+    # data may be any iterable, so rows can be streamed straight to the file
+    if chunked_output is not None:
+        return chunked_output.save_as_csv_chunks(filename, header_fields, data, dict_rows)
+    count = 0
+    with atomic_open(filename) as outputfile:
+        writerow = _csv_row_writer(outputfile, header_fields, dict_rows)
+        for record in data:
+            writerow(record)
+            count += 1
+    print("    %s: Number of output records for upload = %d" % (filename, count))
+    return count
+
+
+def save_as_csv_rows(filename, header_fields, rows, chunked_output=None):
+    """Like save_as_csv_file, for rows that are sequences of values in header_fields order (e.g. built by a
+    RowProjector), so they are written as they are instead of being re-mapped by key"""
+    return save_as_csv_file(filename, header_fields, rows, chunked_output, dict_rows=False)
+
+
+class RowProjector:
+    """An output schema compiled once into a positional row builder.
+
+    Calling it with a record returns the record's values for header_fields, in order, as a tuple. This is a single
+    operator.itemgetter call, instead of a filtered dict copy per row that csv.DictWriter then maps back to the
+    header order. Fields missing from the record are empty, as with csv.DictWriter (records created from the
+    district data don't have every DP field, e.g. YEARTO).
+    """
+
+    def __init__(self, header_fields):
+        self.header_fields = list(header_fields)
+        if len(self.header_fields) == 1:
+            getter = operator.itemgetter(self.header_fields[0])
+            self.__getter = lambda record: (getter(record),)
+        else:
+            self.__getter = operator.itemgetter(*self.header_fields)
+        self.__empty_values = ('',) * len(self.header_fields)
+
+    def __call__(self, record):
+        try:
+            return self.__getter(record)
+        except KeyError:
+            return tuple(map(record.get, self.header_fields, self.__empty_values))
+
+
+class _LineList(list):
+    """A file-like list for csv writers, which write each row with a single write() call"""
+    write = list.append
+
+
+class ChunkedOutput:
+    """Splits csv output files into chunks of at most chunk_rows rows and/or chunk_bytes bytes.
+
+    Every chunk has the header row, so chunks can be uploaded (and retried) independently. Chunks are written
+    in parallel while the next one is being built, and each is recorded in the manifest with its row count
+    and sha256.
+    """
+    MANIFEST_HEADERS = ['FILE', 'CHUNK', 'CHUNK_FILE', 'ROWS', 'BYTES', 'SHA256']
+
+    def __init__(self, chunk_rows=None, chunk_bytes=None, max_workers=None):
+        if not chunk_rows and not chunk_bytes:
+            raise ValueError("chunk_rows or chunk_bytes required")
+        self.chunk_rows = chunk_rows
+        self.chunk_bytes = chunk_bytes
+        self.max_workers = max_workers
+        self.manifest = []
+
+    @staticmethod
+    def chunk_filename(filename, chunk):
+        root, ext = os.path.splitext(filename)
+        return '%s-%03d%s' % (root, chunk, ext)
+
+    @staticmethod
+    def remove_stale_chunks(filename, chunk_filenames=()):
+        """Remove the chunks of filename (named by chunk_filename, at any chunk number) other than chunk_filenames,
+        e.g. left over from an earlier, bigger or chunked run, so they can't be uploaded by mistake"""
+        directory = os.path.dirname(filename)
+        root, ext = os.path.splitext(os.path.basename(filename))
+        pattern = re.compile(re.escape(root) + r'-\d{3,}' + re.escape(ext) + '$')
+        for name in os.listdir(directory or '.'):
+            stale_filename = os.path.join(directory, name)
+            if pattern.match(name) and stale_filename not in chunk_filenames:
+                os.remove(stale_filename)
+
+    def __chunks(self, header_fields, data, dict_rows):
+        """Yields (csv text, row count) per chunk; a file without rows still gets one chunk with the header"""
+        lines = _LineList()
+        writerow = _csv_row_writer(lines, header_fields, dict_rows)
+        header = lines.pop()
+        header_size = len(header.encode())
+        chunk_lines, chunk_size = [header], header_size
+        chunks = 0
         for record in data:
-            writer.writerow(record)
-    print("    %s: Number of output records for upload = %d" % (filename, len(data)))
+            writerow(record)
+            line = lines.pop()
+            line_size = len(line.encode())
+            if self.chunk_bytes and len(chunk_lines) > 1 and chunk_size + line_size > self.chunk_bytes:
+                yield ''.join(chunk_lines), len(chunk_lines) - 1
+                chunks += 1
+                chunk_lines, chunk_size = [header], header_size
+            chunk_lines.append(line)
+            chunk_size += line_size
+            if len(chunk_lines) - 1 == self.chunk_rows:
+                yield ''.join(chunk_lines), len(chunk_lines) - 1
+                chunks += 1
+                chunk_lines, chunk_size = [header], header_size
+        if len(chunk_lines) > 1 or not chunks:
+            yield ''.join(chunk_lines), len(chunk_lines) - 1
+
+    @staticmethod
+    def __write_chunk(chunk_filename, text):
+        with atomic_open(chunk_filename) as outputfile:
+            outputfile.write(text)
+        # Checksum what actually ended up on disk
+        with open(chunk_filename, 'rb') as chunkfile:
+            content = chunkfile.read()
+        return len(content), hashlib.sha256(content).hexdigest()
+
+    def save_as_csv_chunks(self, filename, header_fields, data, dict_rows=True):
+        futures = []
+        count = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for chunk, (text, rows) in enumerate(self.__chunks(header_fields, data, dict_rows), start=1):
+                chunk_filename = self.chunk_filename(filename, chunk)
+                futures.append((chunk, chunk_filename, rows, executor.submit(self.__write_chunk, chunk_filename, text)))
+                count += rows
+        chunk_filenames = set()
+        for chunk, chunk_filename, rows, future in futures:
+            size, sha256 = future.result()
+            chunk_filenames.add(chunk_filename)
+            self.manifest.append({'FILE': os.path.basename(filename), 'CHUNK': chunk, 'CHUNK_FILE': os.path.basename(chunk_filename),
+                                  'ROWS': rows, 'BYTES': size, 'SHA256': sha256})
+        self.remove_stale_chunks(filename, chunk_filenames)
+        # The whole file from an earlier unchunked run would be uploaded on top of the chunks
+        if os.path.exists(filename):
+            os.remove(filename)
+        print("    %s: Number of output records for upload = %d, in %d chunk(s)" % (filename, count, len(futures)))
+        return count
+
+    def write_manifest(self, filename):
+        with atomic_open(filename) as outputfile:
+            writer = csv.DictWriter(outputfile, self.MANIFEST_HEADERS)
+            writer.writeheader()
+            writer.writerows(self.manifest)
+        print("    %s: Manifest of %d chunk(s)" % (filename, len(self.manifest)))
 
 
 def save_as_text_file(filename, messages):
-    with open(filename, 'w') as outputfile:
+    with atomic_open(filename) as outputfile:
         for message in messages:
             outputfile.write(message)
     print("    %s: Number of output messages = %d" % (filename, len(messages)))
+    return len(messages)
 
 
 def modified_fields(old_dict, new_dict):
-    fields = []
-
-    removed_keys = set(old_dict.keys()).difference(new_dict.keys())
-    if len(removed_keys) > 0:
-        raise ValueError('Keys in old dict but not new dict: %s' % str(removed_keys))
+    if old_dict.keys() != new_dict.keys():
+        removed_keys = set(old_dict.keys()).difference(new_dict.keys())
+        if len(removed_keys) > 0:
+            raise ValueError('Keys in old dict but not new dict: %s' % str(removed_keys))
 
-    added_keys = set(new_dict.keys()).difference(old_dict.keys())
-    if len(added_keys) > 0:
+        added_keys = set(new_dict.keys()).difference(old_dict.keys())
         raise ValueError('Keys in new dict but not old dict: %s' % str(added_keys))
 
-    for key in old_dict.keys():
-        if old_dict[key] != new_dict[key]:
-            fields.append(key)
-    return fields
+    return [key for key, value in old_dict.items() if value != new_dict[key]]
 
 
 def list_with_mods(l, add=[], remove=[]):
     res = l + add
-    for v in remove:
-        res.remove(v)
-    return res
+    missing = set(remove).difference(res)
+    if missing:
+        raise ValueError('Not in list: %s' % str(missing))
+    # One pass instead of a list.remove() per field
+    remove = set(remove)
+    return [v for v in res if v not in remove]
 
 
 def dict_filtered_copy(dict_to_copy, keys_to_copy):
@@ -81,3 +267,39 @@ def dict_filtered_copy(dict_to_copy, keys_to_copy):
 
 def normalize_email(email):
     return email.lower().strip()
+
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def normalize_key_part(value, chars_to_compare):
+    """value without spaces and dashes, trimmed to chars_to_compare, uppercased and padded to chars_to_compare"""
+    return value.translate(KEY_PART_DELETIONS)[:chars_to_compare].upper().ljust(chars_to_compare)
+
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def address_key(street, zip):
+    """Key for comparing addresses: first 8 chars of street without spaces/dashes (padded), plus the first 5 chars of zip.
+    Memoized, as the same addresses come up for every sibling and every pass."""
+    return normalize_key_part(street, 8) + zip[:5]
+
+
+SOUNDEX_CODES = dict((letter, str(code)) for code, letters in enumerate(['AEIOUYHW', 'BFPV', 'CGJKQSXZ', 'DT', 'L', 'MN', 'R'])
+                     for letter in letters)
+
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def soundex(name):
+    """American Soundex code of a name (e.g. 'S530' for both Schmidt and Schmitt), '' if it has no letters.
+    Only the letters A-Z count, so spaces, dashes and accents are ignored."""
+    letters = [letter for letter in name.upper() if 'A' <= letter <= 'Z']
+    if not letters:
+        return ''
+    code = letters[0]
+    previous = SOUNDEX_CODES[letters[0]]
+    for letter in letters[1:]:
+        digit = SOUNDEX_CODES[letter]
+        if digit != '0' and digit != previous:
+            code += digit
+        # H and W don't separate letters with the same code, vowels do
+        if letter not in 'HW':
+            previous = digit
+    return (code + '000')[:4]
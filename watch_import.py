@@ -0,0 +1,127 @@
+import argparse
+import glob
+import os
+import time
+
+from dpdata import DPData
+import district_data_import
+
+
+def file_signature(filename):
+    """(mtime, size) of filename, or None if it has gone away"""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class ImportWatcher:
+    """Keeps the DP report loaded and re-runs the import whenever a district file is added or changed."""
+
+    def __init__(self, dp_report, watch_dir, output_dir, school_year, new_year_import, split_parents):
+        self.dp_report = dp_report
+        self.watch_dir = watch_dir
+        self.output_dir = output_dir
+        self.school_year = school_year
+        self.new_year_import = new_year_import
+        self.split_parents = split_parents
+        self.__dp = None
+        self.__match_key_to_donor_id = None
+        self.__dp_report_signature = None
+        # district filename -> signature of the last version we ran the import for
+        self.__processed = dict()
+        # district filename -> signature seen on the previous poll (to wait for copies to finish)
+        self.__pending = dict()
+
+    def __load_baseline(self):
+        print("Loading DP report:")
+        self.__dp = DPData(self.dp_report)
+        self.__match_key_to_donor_id = district_data_import.build_match_key_index(self.__dp)
+        self.__dp_report_signature = file_signature(self.dp_report)
+        # Every district file has to be redone against the new baseline
+        self.__processed.clear()
+
+    def __district_files(self):
+        dp_report = os.path.realpath(self.dp_report)
+        return [filename for filename in sorted(glob.glob(os.path.join(self.watch_dir, '*.csv')))
+                if os.path.realpath(filename) != dp_report]
+
+    def __run(self, district_data_filename):
+        name = os.path.splitext(os.path.basename(district_data_filename))[0]
+        output_dir = os.path.join(self.output_dir, name)
+        os.makedirs(output_dir, exist_ok=True)
+        print()
+        print("Running import for %s:" % district_data_filename)
+        start = time.perf_counter()
+        try:
+            district_records = district_data_import.load_district_data(district_data_filename)
+            dp = self.__dp.copy()
+            dp_messages = district_data_import.run_import(dp, district_records, self.school_year,
+                                                          self.new_year_import, self.split_parents,
+                                                          dict(self.__match_key_to_donor_id))
+            print("Output files:")
+            district_data_import.write_output_files(dp, dp_messages, output_dir)
+        except (Exception, SystemExit) as e:
+            # Most likely a bad district file; keep watching for a corrected one
+            print("Import for %s failed: %s" % (district_data_filename, e))
+            return
+        print("Finished %s in %.2f seconds" % (district_data_filename, time.perf_counter() - start))
+
+    def poll(self):
+        """Check the inputs once, re-running the import for anything new or changed"""
+        dp_report_signature = file_signature(self.dp_report)
+        if dp_report_signature is None:
+            print("Waiting for %s" % self.dp_report)
+            return
+        if self.__dp is None or dp_report_signature != self.__dp_report_signature:
+            self.__load_baseline()
+
+        for filename in self.__district_files():
+            signature = file_signature(filename)
+            if signature is None or self.__processed.get(filename) == signature:
+                continue
+            if self.__pending.get(filename) != signature:
+                # New or still being written; wait for it to be stable for one poll interval
+                self.__pending[filename] = signature
+                continue
+            del self.__pending[filename]
+            self.__processed[filename] = signature
+            self.__run(filename)
+
+    def watch(self, poll_seconds):
+        print("Watching %s for district data files (Ctrl-C to stop)" % self.watch_dir)
+        try:
+            while True:
+                self.poll()
+                time.sleep(poll_seconds)
+        except KeyboardInterrupt:
+            print("Stopped watching")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-runs the district data import whenever district files change")
+    parser.add_argument("--dp-report",
+                        help="csv output from DP: Reports -> Report Center -> 271 Name Contacts Other -> Include \"NO MAIL\" Names -> run report -> export as .csv",
+                        required=True)
+    parser.add_argument("--watch-dir", help="directory where district data csv files are dropped", required=True)
+    parser.add_argument("--output-dir",
+                        help="directory for generated files, one subdirectory per district file (default: current directory)",
+                        default='.')
+    parser.add_argument("--school-year",
+                        help="school year to use for new families, e.g. SY2016-17",
+                        required=True)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--new-year-import", help="specify that this is a beginning-of-year import, in which missing 8th graders will be graduated", action="store_true")
+    group.add_argument("--mid-year-update", help="specify that this is a mid-year update", action="store_true")
+    parser.add_argument("--split-parents", help="Split existing household if parents have two different addresses.", required=False, action='store_true')
+    parser.add_argument("--poll-seconds", help="how often to check for changed files", type=float, default=2.0)
+    args = parser.parse_args()
+
+    watcher = ImportWatcher(args.dp_report, args.watch_dir, args.output_dir, args.school_year,
+                            args.new_year_import, args.split_parents)
+    watcher.watch(args.poll_seconds)
+
+
+if __name__ == '__main__':
+    main()